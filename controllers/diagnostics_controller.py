@@ -3,21 +3,18 @@ import subprocess
 import json
 import logging
 from flask import render_template, jsonify
-from models.newpipeline import convert_to_wsl_path
+from utils.executor import BACKEND, kill_run
+from utils.run_paths import get_run_dir
 
 def index():
     return render_template("diagnostics.html")
 
 def run_diagnostics():
     script_path = os.path.abspath(os.path.join("pipeline_runs", "scripts", "check_tools.sh"))
-    wsl_path = convert_to_wsl_path(script_path)
-    
-    # Ensure executable
-    subprocess.run(["wsl", "chmod", "+x", wsl_path], capture_output=True)
 
     try:
         result = subprocess.run(
-            ["wsl", "bash", wsl_path],
+            BACKEND.command(script_path),
             capture_output=True,
             text=True,
             encoding='utf-8',
@@ -53,22 +50,29 @@ def run_diagnostics():
 # -----------------------------
 import uuid
 import shutil
-from threading import Thread
 from flask import session, url_for
 from models.newpipeline import run_pipeline_async as run_specific_tool_pipeline
+from models import job_queue, run_state
+from models.error_monitor import ErrorMonitor
 
-PIPELINE_RUNS_DIR = "pipeline_runs"
 DIAG_DIR = "diag_file"
 
-def safe_username(email: str) -> str:
-    return email.replace("@", "_").replace(".", "_")
+def run_diagnostic_job(job):
+    """Job queue handler for the diagnostics test pipeline.
+
+    A job interrupted by a restart runs again from scratch in the same
+    folder, after the stages it left running have been stopped.
+    """
+    payload = job["payload"]
+    if job["attempts"] > 1:
+        kill_run(payload["output_dir"], wait=True)
+    monitor = ErrorMonitor(payload["output_dir"], payload["output_file"]).start()
+    try:
+        run_specific_tool_pipeline(**payload, allocation=job.get("allocation"))
+    finally:
+        monitor.stop()
 
-def get_run_dir(username: str, run_id: str) -> str:
-    return os.path.join(
-        PIPELINE_RUNS_DIR,
-        safe_username(username),
-        run_id
-    )
+job_queue.register("diagnostic", run_diagnostic_job)
 
 def run_test_pipeline():
     if "user" not in session:
@@ -106,11 +110,10 @@ def run_test_pipeline():
         "blast_db_path": ""
     }
 
-    # Launch Pipeline
-    Thread(
-        target=run_specific_tool_pipeline,
-        kwargs=params
-    ).start()
+    # Queue Pipeline
+    run_state.set_status(output_dir, "queued")
+    if not job_queue.enqueue(run_id, username, "diagnostic", params, threads=params["threads"]):
+        return jsonify({"error": "Could not queue the test pipeline"}), 500
 
     return jsonify({"success": True, "run_id": run_id})
 
@@ -124,14 +127,12 @@ def check_run_status(run_id):
     if not os.path.exists(run_dir):
         return jsonify({"status": "not_found"}), 404
         
-    status = "running"
-    if os.path.exists(os.path.join(run_dir, "PIPELINE_DONE")):
+    status = run_state.read_status(run_dir) or "running"
+    if status == "completed":
         status = "success"
-    elif os.path.exists(os.path.join(run_dir, "PIPELINE_ABORTED")):
-        status = "failed"
-    elif os.path.exists(os.path.join(run_dir, "CANCEL")):
-        status = "cancelled"
-        
+    elif status == "queued":
+        status = "running"
+
     return jsonify({"status": status})
 
 def cleanup_run(run_id):
@@ -1,8 +1,10 @@
 from flask import render_template, request, flash, redirect, url_for, session, jsonify
 from utils.blast_utils import run_blast_pipeline
 from utils.mailer import send_run_completion_email, send_run_start_email
-from models.db import get_db_connection
-import threading
+from models.db import get_db_connection, db_connection, get_run_by_id, save_stage_metrics
+from models.stage_metrics import load_metrics
+from models import job_queue, run_manifest, run_archive, artifact_digests
+from utils.log_tail import read_log_chunk, log_size
 import uuid
 import datetime
 import os
@@ -11,6 +13,8 @@ import traceback
 
 import traceback
 
+BLAST_LOG_TAIL_BYTES = 2048
+
 def safe_username(email: str) -> str:
     return email.replace("@", "_").replace(".", "_")
 
@@ -18,47 +22,52 @@ def index():
     return render_template("fasta_compare.html")
 
 
-def run_blast_async_worker(run_id, user_email, query_content, base_dir, output_file, query_filename, run_url):
+def set_blast_status(run_id, status):
+    """Records a BLAST run's status. Each update checks a connection out of
+    the pool briefly instead of holding one for the whole search."""
+    with db_connection() as connection:
+        if not connection:
+            return
+        cursor = connection.cursor()
+        if status == 'running':
+            cursor.execute("UPDATE pipeline_runs SET status = 'running' WHERE run_id = %s", (run_id,))
+        else:
+            cursor.execute("UPDATE pipeline_runs SET status = %s, end_time = NOW() WHERE run_id = %s", (status, run_id))
+        connection.commit()
+        cursor.close()
+
+
+def run_blast_async_worker(run_id, user_email, base_dir, output_file, query_filename, run_url, allocation=None):
     """
     Background worker to run BLAST pipeline.
     """
-    connection = get_db_connection()
     try:
         # 1. Update status to RUNNING
-        if connection:
-            cursor = connection.cursor()
-            cursor.execute("UPDATE pipeline_runs SET status = 'running' WHERE run_id = %s", (run_id,))
-            connection.commit()
-            cursor.close()
+        set_blast_status(run_id, 'running')
 
 
         # 1.5 Send Start Email
         if user_email:
             send_run_start_email(user_email, run_id, tool_name="BLAST", run_url=run_url)
 
-        # 2. Prepare files
+        # 2. Query was saved at submission
         query_path = os.path.join(base_dir, "query.fasta")
-        with open(query_path, "w", encoding="utf-8") as f:
-            f.write(query_content)
 
         # 3. Run Pipeline
-        # Note: default threads=4, max_hits=10. Could be parameterized.
+        # Note: threads come from the core allocator (4 requested), max_hits=10.
         blast_db_path = os.path.join(os.getcwd(), "blast_db", "reference")
         
         run_blast_pipeline(
             query_fasta=query_path,
             output_dir=base_dir,
             blast_db_path=blast_db_path,
-            threads=4,
-            output_file=output_file
+            threads=allocation.threads if allocation else 4,
+            output_file=output_file,
+            cpus=allocation.cpus if allocation else None
         )
 
         # 4. Update status to COMPLETED
-        if connection:
-            cursor = connection.cursor()
-            cursor.execute("UPDATE pipeline_runs SET status = 'completed', end_time = NOW() WHERE run_id = %s", (run_id,))
-            connection.commit()
-            cursor.close()
+        set_blast_status(run_id, 'completed')
 
         # 5. Send Email
         if user_email:
@@ -73,18 +82,32 @@ def run_blast_async_worker(run_id, user_email, query_content, base_dir, output_f
             f.write(f"\n[FATAL ERROR] {str(e)}\n")
 
         # Update status to FAILED
-        if connection:
-            cursor = connection.cursor()
-            cursor.execute("UPDATE pipeline_runs SET status = 'failed', end_time = NOW() WHERE run_id = %s", (run_id,))
-            connection.commit()
-            cursor.close()
+        set_blast_status(run_id, 'failed')
             
         if user_email:
             send_run_completion_email(user_email, run_id, "failed", tool_name="BLAST")
 
     finally:
-        if connection and connection.is_connected():
-            connection.close()
+        save_stage_metrics(run_id, load_metrics(base_dir)["stages"])
+        run_manifest.write_manifest(base_dir, get_run_by_id(run_id))
+        run_archive.schedule(base_dir)
+        artifact_digests.schedule(base_dir)
+
+
+def run_blast_job(job):
+    """Job queue handler for BLAST runs."""
+    payload = job["payload"]
+    run_blast_async_worker(
+        job["run_id"],
+        job["user_email"],
+        payload["base_dir"],
+        payload["output_file"],
+        payload["query_filename"],
+        payload["run_url"],
+        allocation=job.get("allocation")
+    )
+
+job_queue.register("blast", run_blast_job)
 
 
 def compare():
@@ -125,19 +148,29 @@ def compare():
     os.makedirs(base_dir, exist_ok=True)
     output_file = os.path.join(base_dir, "blast.log")
 
-    # Read Content (small files assumed, else stream)
-    content = file1.read().decode("utf-8")
+    # Save the query now so the queued job survives a restart
+    with open(os.path.join(base_dir, "query.fasta"), "w", encoding="utf-8") as f:
+        f.write(file1.read().decode("utf-8"))
 
-    # Generate external URL for email before threading (requires request context)
+    # Generate external URL for email before queueing (requires request context)
     run_url = url_for('blast_result', run_id=run_id, _external=True)
 
-    # Start Background Thread
-    thread = threading.Thread(
-        target=run_blast_async_worker,
-        args=(run_id, user_email, content, base_dir, output_file, file1.filename, run_url)
+    # Queue Background Job
+    queued = job_queue.enqueue(
+        run_id,
+        user_email,
+        "blast",
+        {
+            "base_dir": base_dir,
+            "output_file": output_file,
+            "query_filename": file1.filename,
+            "run_url": run_url
+        },
+        threads=4
     )
-    thread.daemon = True
-    thread.start()
+    if not queued:
+        flash("Could not queue the BLAST run. Please try again.", "error")
+        return redirect(url_for('index'))
 
     # Redirect to Status Page
     return redirect(url_for('blast_status', run_id=run_id))
@@ -245,8 +278,6 @@ def blast_status_api(run_id):
         connection.close()
         
         if run:
-            # Fetch real-time logs
-            log_content = ""
             # Get path using owner email
             base_dir = os.path.join(os.getcwd(), "pipeline_runs", safe_username(run['user_email'] if 'user_email' in run else session.get('user')), run_id)
             if not os.path.exists(base_dir):
@@ -254,22 +285,27 @@ def blast_status_api(run_id):
                  if os.path.exists(legacy_dir):
                      base_dir = legacy_dir
             
+            # Only the log written after ?offset=N (the last 2 KB on the first poll)
             log_file = os.path.join(base_dir, "blast.log")
-            if os.path.exists(log_file):
-                try:
-                    with open(log_file, "r") as f:
-                        # Read last 2KB to avoid huge payloads
-                        f.seek(0, 2)
-                        size = f.tell()
-                        f.seek(max(size - 2048, 0))
-                        log_content = f.read()
-                except:
-                    pass
-
-            return jsonify({"status": run['status'], "log": log_content})
-    
+            offset = request.args.get("offset", type=int)
+            if offset is None:
+                offset = max(log_size(log_file) - BLAST_LOG_TAIL_BYTES, 0)
+            chunk = read_log_chunk(log_file, offset, final=run['status'] not in ('pending', 'running'))
+
+            queue_position = job_queue.queue_position(run_id) if run['status'] == 'pending' else None
+            chunk.update(status=run['status'], queue_position=queue_position)
+            return jsonify(chunk)
+
     return jsonify({"status": "unknown"}), 404
 
+def blast_run_status(run_id):
+    """{"status", "queue_position"} for the live events stream ('pending' is reported as 'queued')."""
+    run = get_run_by_id(run_id)
+    status = run['status'] if run else "unknown"
+    if status == 'pending':
+        return {"status": "queued", "queue_position": job_queue.queue_position(run_id)}
+    return {"status": status, "queue_position": None}
+
 def download_blast_csv(run_id):
     """
     Converts and downloads the BLAST results as CSV.
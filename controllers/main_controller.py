@@ -1,25 +1,39 @@
-from flask import render_template, request, redirect, url_for, session, send_file
-from models.db import get_db_connection, get_run_by_id
+from flask import render_template, request, redirect, url_for, session, send_file, flash, jsonify, Response
+from models.db import get_db_connection, get_run_by_id, save_stage_metrics
+from models.stage_metrics import load_metrics
+from models import run_state
+from models import error_monitor
+from models import progress
+from models import run_manifest
+from models import run_archive
+from models import artifact_digests
+from models import run_export
+from models import stage_cache
+from models.error_monitor import ErrorMonitor
 from datetime import datetime
 import traceback
+import threading
 import os
 import uuid
-from threading import Thread
-import subprocess
 from models.pipeline import run_pipeline_async
 from models.newpipeline import run_pipeline_async as run_specific_tool_pipeline
 import shutil
 import re
-
-import re
-
-ANSI_ESCAPE = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
+import json
+from utils.executor import kill_run
+from utils.log_tail import read_log_chunk, line_end
+from utils.log_sink import ANSI_ESCAPE, events_path
+from utils import run_tailer
+from utils.run_paths import get_run_dir
+from controllers import fasta_controller
+from models import job_queue
+from models.core_allocator import ALLOCATOR
 
 def strip_ansi(text: str) -> str:
     return ANSI_ESCAPE.sub('', text)
 
 def terminate_pipeline(username: str, run_id: str) -> bool:
-    """Helper to terminate a running pipeline (WSL process + flag file)."""
+    """Helper to terminate a running pipeline (flag file + its own process groups)."""
     run_dir = get_run_dir(username, run_id)
     if not os.path.exists(run_dir):
         return False
@@ -28,12 +42,14 @@ def terminate_pipeline(username: str, run_id: str) -> bool:
     cancel_file = os.path.join(run_dir, "CANCEL")
     with open(cancel_file, "w") as f:
         f.write("PIPELINE ABORTED BY USER\n")
- 
-    subprocess.run(
-        ["wsl", "--terminate", "Ubuntu"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    )
+
+    # Not started yet: just take it off the queue
+    if job_queue.cancel_queued(run_id):
+        log_run_end(run_id, 'cancelled')
+        return True
+
+    # Signal only this run's stages; the scheduler then frees its worker and cores
+    kill_run(run_dir)
     return True
 
 ALL_TOOLS = {
@@ -47,18 +63,6 @@ ALL_TOOLS = {
     "fastqc"
 }
 
-PIPELINE_RUNS_DIR = "pipeline_runs"
-
-def safe_username(email: str) -> str:
-    return email.replace("@", "_").replace(".", "_")
-
-def get_run_dir(username: str, run_id: str) -> str:
-    return os.path.join(
-        PIPELINE_RUNS_DIR,
-        safe_username(username),
-        run_id
-    )
-
 def log_run_start(run_id, user_email):
     """Logs the start of a pipeline run to the database."""
     conn = get_db_connection()
@@ -67,7 +71,7 @@ def log_run_start(run_id, user_email):
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO pipeline_runs (run_id, user_email, status, start_time, run_type) VALUES (%s, %s, %s, %s, 'analysis')",
-                (run_id, user_email, 'running', datetime.now())
+                (run_id, user_email, 'queued', datetime.now())
             )
             conn.commit()
             cursor.close()
@@ -75,6 +79,22 @@ def log_run_start(run_id, user_email):
         except Exception as e:
             print(f"Failed to log run start: {e}")
 
+def log_run_status(run_id, status):
+    """Moves an unfinished run between 'queued' and 'running' in the database."""
+    conn = get_db_connection()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE pipeline_runs SET status = %s, end_time = NULL WHERE run_id = %s",
+                (status, run_id)
+            )
+            conn.commit()
+            cursor.close()
+            conn.close()
+        except Exception as e:
+            print(f"Failed to log run status: {e}")
+
 def log_run_end(run_id, status):
     """Logs the end of a pipeline run to the database."""
     conn = get_db_connection()
@@ -95,42 +115,38 @@ from utils.mailer import send_run_completion_email, send_run_start_email
 
 # ... existing code ...
 
-def run_pipeline_wrapper(run_id, user_email, mode, *args):
+def run_pipeline_wrapper(run_id, user_email, mode, *args, resume=False, allocation=None):
     """Wraps the pipeline execution to handle DB logging."""
     final_status = 'failed' # Default
-    
+    log_run_status(run_id, 'running')
+
     # Send Start Email
     host_url = os.environ.get("APP_URL", "http://localhost:5000")
     run_url = f"{host_url}/status/{run_id}"
     send_run_start_email(user_email, run_id, tool_name="Pipeline", run_url=run_url)
 
+    # Watches the log for fatal tool errors while the run is going
+    monitor = ErrorMonitor(args[1], args[4]).start()
+
     try:
         if mode == "single":
              # args format for single: input_fastq_path, output_dir, genome_size, threads, log_file, min_length, keep_percent, selected_tools
-             run_specific_tool_pipeline(*args)
+             result = run_specific_tool_pipeline(*args, resume=resume, allocation=allocation)
         else:
              # args format for full: input_fastq_path, output_dir, genome_size, threads, log_file, min_length, keep_percent
-             run_pipeline_async(*args)
-        
-        # Determine final status
+             result = run_pipeline_async(*args, resume=resume, allocation=allocation)
+
+        # Determine final status: the engine's result, else its state.json
         # The args[1] is always output_dir in both calls above
-        output_dir = args[1]
-        
-        if os.path.exists(os.path.join(output_dir, "CANCEL")) or os.path.exists(os.path.join(output_dir, "PIPELINE_ABORTED")):
-            final_status = 'cancelled'
-        elif os.path.exists(os.path.join(output_dir, "PIPELINE_DONE")):
-            final_status = 'completed'
-        else:
-             # Fallback
-             log_path = os.path.join(output_dir, "pipeline_output.log")
-             if os.path.exists(log_path):
-                 with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-                     content = f.read()
-                     if "PIPELINE FINISHED" in content:
-                         final_status = 'completed'
-             
-             if not os.path.exists(os.path.join(output_dir, "PIPELINE_DONE")) and final_status != 'completed':
-                  final_status = 'failed'
+        monitor.stop()
+        if monitor.fatal:
+            # Stopped through the cancel path, but it is a failure
+            result = 'failed'
+            run_state.finish_run(args[1], 'failed', error=monitor.fatal["line"])
+        elif result not in run_state.TERMINAL_STATES:
+            result = run_state.read_status(args[1])
+        if result in run_state.TERMINAL_STATES:
+            final_status = result
 
     except Exception as e:
         print(f"Pipeline wrapper error: {e}")
@@ -138,16 +154,80 @@ def run_pipeline_wrapper(run_id, user_email, mode, *args):
         final_status = 'failed'
     
     finally:
+        # The engine is done with its cores: hand them to the runs still going
+        if allocation:
+            ALLOCATOR.release(allocation)
+        monitor.stop()
         # 1. Log to DB
         log_run_end(run_id, final_status)
-        
-        # 2. Send Email Notification
-        # Construct URL (Assuming standard port 5000 if not set in env)
-        host_url = os.environ.get("APP_URL", "http://localhost:5000")
-        run_url = f"{host_url}/status/{run_id}"
-        
-        print(f"Sending completion email for run {run_id} ({final_status})")
-        send_run_completion_email(user_email, run_id, final_status, run_url=run_url)
+        # 2. The rest does not need the job's worker slot (args[1] is the output dir)
+        threading.Thread(
+            target=finish_run_tasks,
+            args=(run_id, user_email, args[1], final_status),
+            daemon=True
+        ).start()
+
+def finish_run_tasks(run_id, user_email, output_dir, final_status):
+    """Bookkeeping after a run has ended: stage metrics, manifest, archive
+    and digests, then the completion email."""
+    try:
+        save_stage_metrics(run_id, load_metrics(output_dir)["stages"])
+        run_manifest.write_manifest(output_dir, get_run_by_id(run_id))
+        run_archive.schedule(output_dir)
+        artifact_digests.schedule(output_dir)
+    except Exception as e:
+        print(f"Could not record the end of run {run_id}: {e}")
+        traceback.print_exc()
+
+    # Send Email Notification
+    # Construct URL (Assuming standard port 5000 if not set in env)
+    host_url = os.environ.get("APP_URL", "http://localhost:5000")
+    run_url = f"{host_url}/status/{run_id}"
+
+    print(f"Sending completion email for run {run_id} ({final_status})")
+    send_run_completion_email(user_email, run_id, final_status, run_url=run_url)
+
+def run_analysis_job(job):
+    """Job queue handler for analysis runs.
+
+    A job that was interrupted by a restart (second attempt) resumes from
+    its checkpoints instead of starting over, once the stages it left
+    running (in their own process groups) have been stopped.
+    """
+    payload = job["payload"]
+    if job["attempts"] > 1:
+        kill_run(payload["args"][1], wait=True)
+    resume = payload.get("resume", False) or job["attempts"] > 1
+    run_pipeline_wrapper(
+        job["run_id"], job["user_email"], payload["mode"], *payload["args"],
+        resume=resume, allocation=job.get("allocation")
+    )
+
+job_queue.register("analysis", run_analysis_job)
+
+def queue_run(run_id, username, mode, args, threads, resume=False):
+    """Puts an analysis run on the job queue. Returns False if that failed."""
+    run_state.set_status(args[1], "queued")
+    return job_queue.enqueue(
+        run_id,
+        username,
+        "analysis",
+        {"mode": mode, "args": args, "resume": resume},
+        threads=threads
+    )
+
+RUN_PARAMS_FILE = "run_params.json"
+
+def save_run_params(output_dir, params):
+    with open(os.path.join(output_dir, RUN_PARAMS_FILE), "w", encoding="utf-8") as f:
+        json.dump(params, f, indent=2)
+
+def load_run_params(output_dir):
+    try:
+        with open(os.path.join(output_dir, RUN_PARAMS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
 # -----------------------------
 # INDEX / SUBMIT PIPELINE
@@ -174,7 +254,8 @@ def index():
             )
 
         input_fastq_path = os.path.join(output_dir, input_fastq_file.filename)
-        input_fastq_file.save(input_fastq_path)
+        # Hashed while it is written, for the stage cache
+        stage_cache.save_upload(input_fastq_file.stream, input_fastq_path)
 
         # Parameters
         genome_size = request.form.get("genome_size")
@@ -217,49 +298,79 @@ def index():
         # Log file
         log_file = os.path.join(output_dir, "pipeline_output.log")
 
+        # Keep the submission so the run can be resumed later
+        save_run_params(output_dir, {
+            "mode": mode,
+            "input_fastq": input_fastq_file.filename,
+            "genome_size": genome_size,
+            "threads": threads,
+            "min_length": min_length,
+            "keep_percent": keep_percent,
+            "selected_tools": selected_tools
+        })
+
         # Launch pipeline
         log_run_start(run_id, username)
 
-        if mode == "full":
-            Thread(
-                target=run_pipeline_wrapper,
-                args=(
-                    run_id,
-                    username,
-                    "full",
-                    input_fastq_path,
-                    output_dir,
-                    genome_size,
-                    threads,
-                    log_file,
-                    min_length,
-                    keep_percent
-                ),
-                daemon=True
-            ).start()
-        else:
-            Thread(
-                target=run_pipeline_wrapper,
-                args=(
-                    run_id,
-                    username,
-                    "single",
-                    input_fastq_path,
-                    output_dir,
-                    genome_size,
-                    threads,
-                    log_file,
-                    min_length,
-                    keep_percent,
-                    selected_tools
-                ),
-                daemon=True
-            ).start()
+        args = [
+            input_fastq_path,
+            output_dir,
+            genome_size,
+            threads,
+            log_file,
+            min_length,
+            keep_percent
+        ]
+        if mode != "full":
+            args.append(selected_tools)
+
+        if not queue_run(run_id, username, mode, args, threads):
+            log_run_end(run_id, 'failed')
+            return render_template(
+                "index.html",
+                error="Could not queue the run. Please try again."
+            )
 
         return redirect(url_for("status", run_id=run_id))
 
     return render_template("index.html")
 
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+def format_bytes(count):
+    if count is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024:
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TB"
+
+def format_stage_metrics(stages):
+    """metrics.json stage entries as display rows, in execution order."""
+    rows = []
+    for name, m in sorted(stages.items(), key=lambda item: item[1].get("started_at") or ""):
+        cpu = None
+        if m.get("cpu_user_seconds") is not None:
+            cpu = m["cpu_user_seconds"] + (m.get("cpu_system_seconds") or 0)
+        rows.append({
+            "stage": name,
+            "title": m.get("title") or name,
+            "status": m.get("status", "-"),
+            "threads": m.get("threads") or "-",
+            "wall": format_duration(m.get("wall_seconds")),
+            "cpu": format_duration(cpu),
+            "rss": format_bytes(m["max_rss_kb"] * 1024) if m.get("max_rss_kb") is not None else "-",
+            "read": format_bytes(m.get("read_bytes")),
+            "written": format_bytes(m.get("write_bytes")),
+        })
+    return rows
+
 # -----------------------------
 # STATUS PAGE
 # -----------------------------
@@ -271,103 +382,138 @@ def status(run_id):
     run_dir = get_run_dir(username, run_id)
 
     pipeline_log = os.path.join(run_dir, "pipeline_output.log")
-    done_flag = os.path.join(run_dir, "PIPELINE_DONE")
-    cancel_flag = os.path.join(run_dir, "CANCEL")
 
-    output = ""
+    data = b""
     if os.path.exists(pipeline_log):
-        with open(pipeline_log, "r", encoding="utf-8", errors="replace") as f:
-            output = strip_ansi(f.read())
+        with open(pipeline_log, "rb") as f:
+            data = f.read()
+    output = data.decode("utf-8", errors="replace")
+    # Logs written by the LogSink are already clean; older runs' are not
+    legacy_log = not os.path.exists(events_path(pipeline_log))
+    if legacy_log:
+        output = strip_ansi(output)
 
     # 1. Get State from DB (Source of Truth)
     run_data = get_run_by_id(run_id)
     db_status = run_data['status'] if run_data else 'unknown'
     start_time = run_data['start_time'].timestamp() if run_data and run_data['start_time'] else None
+    queue_position = job_queue.queue_position(run_id) if db_status == 'queued' else None
 
-    # 2. File-based Fallbacks (for backwards compatibility)
-    file_is_aborted = (
-        "PIPELINE ABORTED BY USER" in output
-        or os.path.exists(cancel_flag)
-    )
-
-    file_is_complete = (
-        "PIPELINE FINISHED SUCCESSFULLY" in output
-        or "PIPELINE FINISHED" in output
-        or os.path.exists(done_flag)
-    )
+    # 2. Run directory state (state.json; markers/log text for older runs)
+    file_status = run_state.read_status(run_dir)
 
     # 3. Determine Final State
-    # DB takes precedence if it says completed/cancelled/failed
-    # Otherwise check files
-    
-    is_cancelled = (db_status == 'cancelled') or file_is_aborted
-    is_complete = (db_status == 'completed') or file_is_complete
-    is_failed = (db_status == 'failed')
+    # A terminal state in the DB or the run directory wins
+
+    is_cancelled = (db_status == 'cancelled') or file_status == 'cancelled'
+    is_complete = (db_status == 'completed') or file_status == 'completed'
+    is_failed = (db_status == 'failed') or file_status == 'failed'
     
     # If DB says running, but file implies finished/cancelled, trust file and sync DB later (lazy)
     # For now, let's just make sure "failed" shows up as NOT running.
     
-    is_running = (db_status == 'running') and not is_complete and not is_cancelled and not is_failed
-
-    # -----------------------------
-    # AUTO-TERMINATION ON ERROR
-    # -----------------------------
-    if is_running and output:
-        # Check for error keywords - Refined to avoid false positives (e.g. "non-fatal ERRORs")
-        error_keywords = ["Traceback", "Exception", "PIPELINE ABORTED", "Pipeline aborted", "Fatal Error"]
-        
-        # Check for "Error" only if it's not part of "non-fatal ERRORs" or similar safe contexts
-        has_critical_error = any(keyword in output for keyword in error_keywords)
-        
-        # Strict check for generic 'Error'/'Failed' at start of line or specific contexts if needed
-        # For now, relying on Traceback/Exception/Aborted is safer. 
-        # Adding simple check for "Error:" or "Failed:" might be better than bare word.
-        if "Error:" in output or "Failed:" in output:
-            has_critical_error = True
-
-        if has_critical_error:
-             # Trigger termination
-             terminate_pipeline(username, run_id)
-             is_cancelled = True # Treat error as cancelled/stopped for UI mostly, or add specific failed state
-             is_running = False
-             # Append message to log if not present
-             if "Auto-terminated due to error" not in output:
-                 with open(pipeline_log, "a") as f:
-                     f.write("\n\n[SYSTEM] Auto-terminated pipeline due to detected error in logs.\n")
-             
-             # Update DB to failed explicitly
-             log_run_end(run_id, 'failed')
-             is_failed = True
+    is_running = (db_status in ('running', 'queued')) and not is_complete and not is_cancelled and not is_failed
+
+    # A running page follows the log from here on (/events or /get_log);
+    # it starts at a line start and gets the partial last line with the rest
+    log_offset = len(data)
+    if is_running:
+        log_offset = line_end(data)
+        output = data[:log_offset].decode("utf-8", errors="replace")
+        if legacy_log:
+            output = strip_ansi(output)
 
     return render_template(
         "status.html",
         run_id=run_id,
         output=output,
+        log_offset=log_offset,
         is_running=is_running,
         is_complete=is_complete,
         is_cancelled=is_cancelled,
         is_failed=is_failed,
-        start_time=start_time
+        start_time=start_time,
+        queue_position=queue_position,
+        stage_metrics=format_stage_metrics(load_metrics(run_dir)["stages"]),
+        export_profiles=run_export.PROFILES
     )
 
 # -----------------------------
 # LIVE LOG FETCH (AJAX)
 # -----------------------------
+def current_state(run_dir, run_id):
+    """One of queued/running/completed/failed/cancelled (state.json first, then the DB)."""
+    state = run_state.read_status(run_dir)
+    if state:
+        return state
+    run_data = get_run_by_id(run_id)
+    return run_data["status"] if run_data else "running"
+
+
+def run_status(run_dir, run_id):
+    """{"status", "queue_position", "progress"} as reported by the live log APIs.
+
+    `progress` ({"percent", "eta_seconds", "stages"}) is set while running.
+    """
+    state = current_state(run_dir, run_id)
+    return {
+        "status": state,
+        "queue_position": job_queue.queue_position(run_id) if state == "queued" else None,
+        "progress": progress.run_progress(run_dir) if state == "running" else None,
+    }
+
+
 def get_log(run_id):
+    """Log text written after `?offset=N`, as JSON for the status page to append."""
     username = session.get("user")
     run_dir = get_run_dir(username, run_id)
 
     log_file = os.path.join(run_dir, "pipeline_output.log")
-    cancel_flag = os.path.join(run_dir, "CANCEL")
+    offset = request.args.get("offset", 0, type=int)
+    status = run_status(run_dir, run_id)
 
-    if os.path.exists(cancel_flag):
-        return "PIPELINE ABORTED BY USER\nExecution stopped."
+    chunk = read_log_chunk(log_file, offset, final=status["status"] not in ("queued", "running"))
+    chunk.update(status)
+    return jsonify(chunk)
 
-    if not os.path.exists(log_file):
-        return "Waiting for pipeline to start..."
+# -----------------------------
+# LIVE EVENTS (SSE)
+# -----------------------------
+def run_events(run_id):
+    """Server-Sent Events stream of a run's log and status.
+
+    All viewers of a run share one tailer (utils.run_tailer). Reconnecting
+    browsers resume from their Last-Event-ID (a log byte offset). Past
+    run_tailer.MAX_STREAMS open streams the request is refused with 503
+    and the page falls back to polling /get_log.
+    """
+    username = session.get("user")
+    run_dir = get_run_dir(username, run_id)
+    if not os.path.isdir(run_dir):
+        return "Run not found", 404
 
-    with open(log_file, "r", encoding="utf-8", errors="replace") as f:
-        return strip_ansi(f.read())
+    run_data = get_run_by_id(run_id)
+    if run_data and run_data.get("run_type") == "blast":
+        log_file = os.path.join(run_dir, "blast.log")
+        state_fn = lambda: fasta_controller.blast_run_status(run_id)
+    else:
+        log_file = os.path.join(run_dir, "pipeline_output.log")
+        state_fn = lambda: run_status(run_dir, run_id)
+
+    offset = request.headers.get("Last-Event-ID", type=int)
+    if offset is None:
+        offset = request.args.get("offset", 0, type=int)
+
+    if not run_tailer.open_stream():
+        return jsonify({"error": "Too many live views", "poll": url_for("get_log", run_id=run_id, offset=offset)}), 503
+
+    response = Response(
+        run_tailer.stream(run_id, log_file, state_fn, offset),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(run_tailer.close_stream)
+    return response
 
 # -----------------------------
 # DOWNLOAD RESULTS
@@ -399,6 +545,63 @@ def download_output(run_id):
         download_name=f"{run_id}_output.zip"
     )
 # -----------------------------
+# RESUME RUN
+# -----------------------------
+def resume_run(run_id):
+    """Restarts a failed/cancelled run, skipping stages with a valid checkpoint."""
+    username = session.get("user")
+    output_dir = get_run_dir(username, run_id)
+
+    params = load_run_params(output_dir)
+    if not params:
+        flash("This run cannot be resumed (no saved parameters).", "error")
+        return redirect(url_for("status", run_id=run_id))
+
+    run_data = get_run_by_id(run_id)
+    if run_data and run_data["status"] in ("running", "queued"):
+        flash("Run is still in progress.", "info")
+        return redirect(url_for("status", run_id=run_id))
+
+    # Clear stop markers and keep the previous attempt's log and events
+    # aside, so the status page does not pick up its old cancel/error lines
+    # or progress. A CANCEL sent after this point stops the new attempt.
+    for marker in ("CANCEL", "PIPELINE_ABORTED", "PIPELINE_DONE", error_monitor.SCAN_FILE):
+        marker_path = os.path.join(output_dir, marker)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+    log_file = os.path.join(output_dir, "pipeline_output.log")
+    if os.path.exists(log_file):
+        attempt = 1
+        while os.path.exists(os.path.join(output_dir, f"pipeline_output.attempt{attempt}.log")):
+            attempt += 1
+        attempt_log = os.path.join(output_dir, f"pipeline_output.attempt{attempt}.log")
+        os.replace(log_file, attempt_log)
+        if os.path.exists(events_path(log_file)):
+            os.replace(events_path(log_file), events_path(attempt_log))
+
+    input_fastq_path = os.path.join(output_dir, params["input_fastq"])
+    args = [
+        input_fastq_path,
+        output_dir,
+        params["genome_size"],
+        params["threads"],
+        log_file,
+        params["min_length"],
+        params["keep_percent"]
+    ]
+    if params["mode"] != "full":
+        args.append(params["selected_tools"])
+
+    log_run_status(run_id, 'queued')
+    if not queue_run(run_id, username, params["mode"], args, params["threads"], resume=True):
+        log_run_end(run_id, 'failed')
+        flash("Could not queue the run. Please try again.", "error")
+        return redirect(url_for("status", run_id=run_id))
+
+    return redirect(url_for("status", run_id=run_id))
+
+# -----------------------------
 # CANCEL RUN
 # -----------------------------
 def cancel_run(run_id):
@@ -1,19 +1,21 @@
 from flask import (
     Flask, redirect, url_for, send_file,
     abort, request, render_template,
-    flash, session, jsonify, after_this_request
+    flash, session, jsonify, Response, stream_with_context
 )
 from controllers import main_controller, diagnostics_controller, fasta_controller
-from models.db import get_user_by_email, init_db, update_user_session_token, get_db_connection
+from models.db import (
+    get_user_by_email, init_db, update_user_session_token, get_db_connection, get_stage_metrics,
+    get_runs_by_ids, get_runs_page, get_session_token
+)
 from ai.chat_engine import build_prompt
+from models import job_queue, run_manifest, reconciler, run_archive, run_state, run_export, artifact_digests, session_cache, stage_cache
+from utils import zip_stream
 from openai import OpenAI
 from datetime import datetime
 
-import subprocess
 import os
-import zipfile
 import shutil
-import tempfile
 import uuid
 from functools import wraps
 from pathlib import Path
@@ -72,10 +74,11 @@ def check_session_validity():
         session["last_active"] = now
 
         # 2. Concurrent Session Check (Single Session Enforcement)
-        # Skip check for static assets to reduce DB load
+        # Skip check for static assets to reduce DB load; the token itself
+        # is cached briefly and dropped whenever it changes
         if request.endpoint and "static" not in request.endpoint:
-            user = get_user_by_email(session["user"])
-            if user and user.get("session_token") != session.get("token"):
+            current = get_session_token(session["user"])
+            if current and current[0] and current[1] != session.get("token"):
                 session.clear()
                 flash("You have been logged out because your account was accessed from another device.", "warning")
                 return redirect(url_for("login"))
@@ -528,6 +531,7 @@ def api_delete_user():
             # Delete
             cursor.execute("DELETE FROM users WHERE email = %s", (email_to_delete,))
             conn.commit()
+            session_cache.invalidate(email_to_delete)
             
             return jsonify({"message": f"User {email_to_delete} deleted successfully"}), 200
 
@@ -556,59 +560,6 @@ def api_delete_user():
 
 #     return zip_path, tmp_dir
 
-def get_or_create_run_zip(email: str, run_id: str) -> Path:
-    run_dir = get_run_dir(email, run_id)
-    if not run_dir.exists():
-        abort(404, "Run not found")
-
-    zip_path = run_dir / f"{run_id}.zip"
-
-    # 1. Check if valid ZIP already exists
-    if zip_path.exists():
-        if zipfile.is_zipfile(zip_path):
-            return zip_path
-        else:
-            print(f"Corrupt zip found at {zip_path}, regenerating...")
-            try:
-                os.remove(zip_path)
-            except OSError:
-                pass
-
-    # 2. Atomic Creation (Write to temp, then rename)
-    tmp_zip_path = run_dir / f"{run_id}.zip.tmp"
-    
-    try:
-        with zipfile.ZipFile(tmp_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file in run_dir.rglob("*"):
-                # Skip the zip file itself and any temp files
-                if file.is_file() and file.name != zip_path.name and not file.name.endswith('.tmp'):
-                    zipf.write(file, file.relative_to(run_dir))
-        
-        # Atomic move
-        if tmp_zip_path.exists():
-            tmp_zip_path.replace(zip_path)
-            
-    except Exception as e:
-        print(f"Error creating zip: {e}")
-        if tmp_zip_path.exists():
-            try:
-                os.remove(tmp_zip_path)
-            except OSError:
-                pass
-        raise e
-
-    return zip_path
-
-def build_file_tree(paths):
-    tree = {}
-    for path in paths:
-        parts = path.split(os.sep)
-        cur = tree
-        for p in parts[:-1]:
-            cur = cur.setdefault(p, {})
-        cur.setdefault("__files__", []).append(parts[-1])
-    return tree
-
 @app.route("/", methods=["GET", "POST"])
 @login_required
 def index():
@@ -633,6 +584,13 @@ def get_log(run_id):
         return redirect(url_for("create_user"))
     return main_controller.get_log(run_id)
 
+@app.route("/events/<run_id>")
+@login_required
+def run_events(run_id):
+    if session.get("role") == "admin":
+        return redirect(url_for("create_user"))
+    return main_controller.run_events(run_id)
+
 @app.route("/diagnostics")
 @login_required
 def diagnostics():
@@ -722,28 +680,116 @@ def download_output(run_id):
 #         mimetype="application/zip"
 #     )
 
+def send_with_digest(path, digest, **kwargs):
+    """send_file with a content-hash ETag and Digest header when the
+    file's BLAKE2 digest is known (mtime-based ETag otherwise)."""
+    response = send_file(
+        path,
+        as_attachment=True,
+        etag=artifact_digests.etag(digest) if digest else True,
+        conditional=True,
+        **kwargs
+    )
+    if digest:
+        response.headers["Digest"] = artifact_digests.digest_header(digest)
+    return response
+
 @app.route("/download-all/<username>/<run_id>")
 @login_required
 def download_all(username, run_id):
     if username != safe_username(session["user"]) and session.get("role") != "admin":
         abort(403)
 
-    zip_path = get_or_create_run_zip(session["user"], run_id)
+    run_dir = get_run_dir(session["user"], run_id)
+    if not run_dir.exists():
+        abort(404, "Run not found")
 
-    return send_file(
-        zip_path,
-        as_attachment=True,
-        download_name=f"{run_id}_results.zip",
+    # Built in the background when the run finished; sent as is while it
+    # still matches the run's files
+    archive = run_archive.ready_archive(str(run_dir))
+    if archive:
+        return send_with_digest(
+            os.path.abspath(archive),
+            run_archive.load_info(archive).get("blake2b"),
+            download_name=f"{run_id}_results.zip",
+            mimetype="application/zip"
+        )
+
+    # Otherwise built while it is sent, and rebuilt for next time
+    if run_state.read_status(str(run_dir)) in run_state.TERMINAL_STATES:
+        run_archive.schedule(str(run_dir))
+    files = [(str(run_dir / rel), rel.replace(os.sep, "/")) for rel, _, _ in run_archive.members(str(run_dir))]
+    return Response(
+        stream_with_context(zip_stream.stream_zip(files)),
         mimetype="application/zip",
-        conditional=True  # enables browser caching
+        headers={
+            "Content-Disposition": f'attachment; filename="{run_id}_results.zip"',
+            "X-Accel-Buffering": "no",
+        }
     )
 
+def export_response(run_id, files, fmt, name):
+    try:
+        chunks, mimetype, extension = run_export.export_stream(files, fmt)
+    except KeyError:
+        abort(400, f"Unknown format: {fmt}")
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{run_id}_{name}{extension}"',
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+@app.route("/export/<run_id>")
+@login_required
+def export_run(run_id):
+    """A named subset of a run (`?profile=assembly`, `?format=zip|tar.gz`), streamed."""
+    run_dir = get_run_dir(session["user"], run_id)
+    if not run_dir.exists():
+        abort(404, "Run not found")
+
+    profile = request.args.get("profile", "no_reads")
+    try:
+        files = run_export.profile_files(str(run_dir), profile)
+    except KeyError:
+        abort(400, f"Unknown export profile: {profile}")
+    if not files:
+        abort(404, "No files in this export")
+    return export_response(run_id, files, request.args.get("format", "zip"), profile)
+
+@app.route("/api/runs/<run_id>/export", methods=["POST"])
+@login_required
+def api_export_run(run_id):
+    """Custom selection: `paths` (files or folders, relative to the run) and
+    `format`, as JSON or form fields. The archive is streamed back."""
+    run_dir = get_run_dir(session["user"], run_id)
+    if not run_dir.exists():
+        abort(404, "Run not found")
+
+    data = request.get_json(silent=True)
+    if data is not None:
+        paths, fmt = data.get("paths") or [], data.get("format", "zip")
+    else:
+        paths, fmt = request.form.getlist("paths"), request.form.get("format", "zip")
+    if not paths:
+        return jsonify({"error": "No paths selected"}), 400
+
+    try:
+        files = run_export.selected_files(str(run_dir), paths)
+    except ValueError:
+        abort(403)
+    if not files:
+        return jsonify({"error": "None of the selected paths exist"}), 404
+    return export_response(run_id, files, fmt, "selection")
+
 @app.route("/prepare-download/<run_id>")
 @login_required
 def prepare_download(run_id):
-    # Ensure ZIP exists (this may take time)
-    get_or_create_run_zip(session["user"], run_id)
-
+    # The archive is streamed by download_all, so there is nothing to prepare
+    if not get_run_dir(session["user"], run_id).exists():
+        return jsonify({"ready": False, "error": "Run not found"}), 404
     return jsonify({"ready": True})
 
 @app.route("/download-file/<username>/<run_id>")
@@ -765,7 +811,18 @@ def download_file(username, run_id):
     if not file_path.exists():
         abort(404)
 
-    return send_file(file_path, as_attachment=True)
+    digest = artifact_digests.lookup(str(base_dir), file_path.relative_to(base_dir).as_posix())
+    return send_with_digest(file_path, digest)
+
+@app.route("/api/runs/<run_id>/manifest", methods=["GET"])
+@login_required
+def api_run_manifest(run_id):
+    """Content digests of a run's files. With `?since=<version>`, only what
+    changed after that version of the manifest (for sync clients)."""
+    run_dir = get_run_dir(session["user"], run_id)
+    if not run_dir.exists():
+        abort(404)
+    return jsonify(artifact_digests.changes_since(str(run_dir), request.args.get("since", type=int)))
 
 # =============================
 # MY RUNS
@@ -784,119 +841,138 @@ def download_file(username, run_id):
 
 #     return render_template("my_runs.html", runs=runs)
 
+@app.route("/api/history", methods=["GET"])
+@login_required
+def api_history():
+    """The user's recent runs with per-stage resource metrics."""
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    except ValueError:
+        limit = 50
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT run_id, status, run_type, start_time, end_time FROM pipeline_runs "
+            "WHERE user_email = %s ORDER BY start_time DESC LIMIT %s",
+            (session["user"], limit)
+        )
+        runs = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+
+    def iso(value):
+        return value.isoformat() if value else None
+
+    metrics = get_stage_metrics(r["run_id"] for r in runs)
+    for run in runs:
+        run["start_time"] = iso(run["start_time"])
+        run["end_time"] = iso(run["end_time"])
+        run["stages"] = [
+            {
+                **{k: v for k, v in row.items() if k not in ("id", "run_id", "started_at", "finished_at")},
+                "started_at": iso(row["started_at"]),
+                "finished_at": iso(row["finished_at"]),
+            }
+            for row in metrics.get(run["run_id"], [])
+        ]
+    return jsonify(runs)
+
+
 @app.route("/my-runs")
 @login_required
 def my_runs():
     if session.get("role") == "admin":
         return redirect(url_for("create_user"))
-    username = safe_username(session["user"])
-    user_root = Path(PIPELINE_RUNS_DIR) / username
-    
-    # Fetch DB runs
-    conn = get_db_connection()
-    db_runs_map = {}
-    if conn:
+    # The runs themselves are loaded page by page from /api/runs
+    return render_template("my_runs.html")
+
+
+RUNS_PAGE_SIZE = 20
+
+def run_json(run_id, run_type, status, start_time, end_time, has_files):
+    def iso(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    return {
+        "run_id": run_id,
+        "run_type": run_type or "analysis",
+        "status": status,
+        "start_time": iso(start_time),
+        "end_time": iso(end_time),
+        "has_files": has_files,
+    }
+
+
+@app.route("/api/runs", methods=["GET"])
+@login_required
+def api_runs():
+    """The user's runs, newest first, one page at a time.
+
+    `?limit=` (default 20, at most 100) and `?cursor=` (the `next_cursor`
+    of the previous page). Runs that exist only on disk (from before runs
+    were recorded in the database) follow the last page.
+    """
+    try:
+        limit = max(1, min(int(request.args.get("limit", RUNS_PAGE_SIZE)), 100))
+    except ValueError:
+        limit = RUNS_PAGE_SIZE
+
+    before = None
+    cursor = request.args.get("cursor")
+    if cursor:
+        start, _, last_id = cursor.partition("|")
         try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM pipeline_runs WHERE user_email = %s", (session["user"],))
-            rows = cursor.fetchall()
-            for r in rows:
-                db_runs_map[r["run_id"]] = r
-            cursor.close()
-            conn.close()
-        except:
-             pass
+            before = (datetime.fromisoformat(start), last_id)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
 
-    runs_data = []
-    
-    # 1. Runs in DB
-    for run_id, db_data in db_runs_map.items():
-         run_path = get_run_dir(session["user"], run_id)
-         
-         # Check files
-         file_tree = {}
-         has_files = False
-         pipeline_done = False
-         pipeline_aborted = False
-         
-         if run_path.exists():
-             has_files = True
-             files = [str(p.relative_to(run_path)) for p in run_path.rglob("*") if p.is_file()]
-             file_tree = build_file_tree(sorted(files))
-             
-             # Check for physical status markers
-             pipeline_done = (run_path / "PIPELINE_DONE").exists()
-             pipeline_aborted = (run_path / "CANCEL").exists()
-             
-             # Check logs for strict success/failure if markers missing
-             log_path = run_path / "pipeline_output.log"
-             if log_path.exists():
-                 try:
-                     with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-                         content = f.read()
-                         if "PIPELINE FINISHED" in content or "PIPELINE FINISHED SUCCESSFULLY" in content:
-                             pipeline_done = True
-                         if "PIPELINE ABORTED BY USER" in content:
-                             pipeline_aborted = True
-                 except:
-                     pass
-
-         # SELF-HEALING / SYNC LOGIC
-         current_status = db_data["status"]
-         new_status = current_status
-         
-         if pipeline_done and current_status != 'completed':
-             new_status = 'completed'
-         elif pipeline_aborted and current_status != 'cancelled':
-             new_status = 'cancelled'
-         
-         # Update DB if mismatched
-         if new_status != current_status:
-             try:
-                 # Re-connect to update
-                 update_conn = get_db_connection()
-                 if update_conn:
-                     update_cursor = update_conn.cursor()
-                     update_cursor.execute(
-                         "UPDATE pipeline_runs SET status = %s, end_time = %s WHERE run_id = %s",
-                         (new_status, datetime.now(), run_id)
-                     )
-                     update_conn.commit()
-                     update_cursor.close()
-                     update_conn.close()
-                     current_status = new_status # Reflect in UI immediately
-             except Exception as e:
-                 print(f"Failed to sync status for {run_id}: {e}")
-
-         runs_data.append({
-             "run_id": run_id,
-             "run_type": db_data.get("run_type") or "analysis", # Handle None or missing
-             "status": current_status,
-             "start_time": db_data["start_time"],
-             "end_time": db_data["end_time"],
-             "file_tree": file_tree,
-             "has_files": has_files
-         })
-
-    # 2. Runs on disk NOT in DB (Legacy)
-    if user_root.exists():
-        for run_dir in user_root.iterdir():
-            if run_dir.is_dir() and run_dir.name not in db_runs_map:
-                files = [str(p.relative_to(run_dir)) for p in run_dir.rglob("*") if p.is_file()]
-                runs_data.append({
-                    "run_id": run_dir.name,
-                    "run_type": "analysis", # Standard pipeline runs (legacy)
-                    "status": "legacy",
-                    "start_time": datetime.fromtimestamp(run_dir.stat().st_ctime),
-                    "end_time": None,
-                    "file_tree": build_file_tree(sorted(files)),
-                     "has_files": True
-                })
-
-    # Sort by start_time
-    runs_data.sort(key=lambda x: x["start_time"] if x["start_time"] else datetime.min, reverse=True)
-
-    return render_template("my_runs.html", runs=runs_data, zip=zip)
+    rows = get_runs_page(session["user"], limit + 1, before)
+    if rows is None:
+        return jsonify({"error": "Database connection failed"}), 500
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Statuses are kept in line with the run directories by models.reconciler
+    runs = [
+        run_json(row["run_id"], row["run_type"], row["status"], row["start_time"], row["end_time"],
+                 get_run_dir(session["user"], row["run_id"]).exists())
+        for row in rows
+    ]
+
+    if not has_more:
+        user_root = Path(PIPELINE_RUNS_DIR) / safe_username(session["user"])
+        index = run_manifest.user_runs(str(user_root), lambda ids: get_runs_by_ids(session["user"], ids))
+        legacy = sorted((e for e in index.values() if e["status"] == "legacy"),
+                        key=lambda e: e["start_time"] or "", reverse=True)
+        runs += [run_json(e["run_id"], e["run_type"], "legacy", e["start_time"], None, True) for e in legacy]
+
+    next_cursor = None
+    if has_more and rows[-1]["start_time"]:
+        next_cursor = f"{rows[-1]['start_time'].isoformat()}|{rows[-1]['run_id']}"
+    return jsonify({"runs": runs, "next_cursor": next_cursor})
+
+
+@app.route("/api/runs/<run_id>/files", methods=["GET"])
+@login_required
+def api_run_files(run_id):
+    """One directory of a run (`?path=`, relative to the run), listed on demand."""
+    run_dir = get_run_dir(session["user"], run_id)
+    if not run_dir.exists():
+        abort(404)
+
+    path = request.args.get("path", "").strip("/")
+    try:
+        entries = run_manifest.list_dir(str(run_dir), path)
+    except ValueError:
+        abort(403)
+    except OSError:
+        abort(404)
+    return jsonify({"path": path, "entries": entries})
 
 # =============================
 # CANCEL PIPELINE
@@ -909,21 +985,22 @@ def cancel_run(run_id):
     if not run_dir.exists():
         abort(404)
 
-    (run_dir / "CANCEL").write_text("cancelled")
-
-    subprocess.run(
-        ["wsl", "--terminate", "Ubuntu"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    )
-
-    # Log to DB
-    main_controller.log_run_end(run_id, 'cancelled')
+    # Writes CANCEL and stops the run (or drops it from the queue); the end
+    # is logged by whichever of the two handles it
+    main_controller.terminate_pipeline(session["user"], run_id)
 
     flash("Pipeline cancelled.", "info")
     return redirect(url_for("status", run_id=run_id))
 
 
+@app.route("/resume/<run_id>", methods=["POST"])
+@login_required
+def resume_run(run_id):
+    if session.get("role") == "admin":
+        return redirect(url_for("create_user"))
+    return main_controller.resume_run(run_id)
+
+
 
 
 @app.route("/fasta-compare", methods=["GET"])
@@ -970,6 +1047,9 @@ def delete_run(username, run_id):
         abort(404)
 
     shutil.rmtree(run_dir)
+    run_archive.remove(str(run_dir))
+    # Cached stage outputs only this run linked to now count against the cap
+    stage_cache.prune_later()
 
     # Delete from DB
     conn = get_db_connection()
@@ -1012,6 +1092,10 @@ if __name__ == "__main__":
     # Initialize DB table if needed (for dev convenience)
     # Initialize DB table if needed (for dev convenience)
     init_db()
+    job_queue.start()
+    # After the queue has re-queued interrupted jobs: settles runs left orphaned
+    reconciler.start()
+    stage_cache.prune_later()
 
     if os.environ.get("FLASK_ENV") == "development":
         app.run(
@@ -1025,4 +1109,6 @@ if __name__ == "__main__":
         from waitress import serve
         print("Starting production server with Waitress on port 5000...")
         # Increase max_request_body_size to 16GB
-        serve(app, host="0.0.0.0", port=5000, max_request_body_size=16 * 1024 * 1024 * 1024)
+        # Every open status page holds a thread for its event stream (/events)
+        serve(app, host="0.0.0.0", port=5000, max_request_body_size=16 * 1024 * 1024 * 1024,
+              threads=int(os.environ.get("WAITRESS_THREADS", 32)))
@@ -0,0 +1,167 @@
+import os
+import json
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from models import run_manifest
+
+# hashlib releases the GIL on large reads, so threads hash in parallel
+HASH_WORKERS = max(1, int(os.environ.get("HASH_WORKERS", min(4, os.cpu_count() or 1))))
+CHUNK_BYTES = 1024 * 1024
+DIGEST_SIZE = 32
+ALGORITHM = "blake2b-256"
+
+POOL = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="digest")
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def file_digest(path):
+    """Hex BLAKE2b-256 of a file."""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def etag(hex_digest):
+    return f"{ALGORITHM}-{hex_digest}"
+
+
+def digest_header(hex_digest):
+    """Value of a `Digest` header (base64 of the raw digest)."""
+    return f"{ALGORITHM}={base64.b64encode(bytes.fromhex(hex_digest)).decode('ascii')}"
+
+
+def run_lock(run_dir):
+    with _locks_lock:
+        return _locks.setdefault(os.path.normpath(run_dir), threading.Lock())
+
+
+def load(run_dir):
+    """The run's digest manifest: {"version": n, "files": {path: entry}}.
+
+    Each entry holds the file's size, mtime and digest, and the manifest
+    version in which it last changed. Deleted files stay as
+    {"deleted": true, "version": n} so clients can be told about them.
+    """
+    try:
+        with open(os.path.join(run_dir, run_manifest.DIGESTS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": 0, "files": {}}
+
+
+def save(run_dir, manifest):
+    path = os.path.join(run_dir, run_manifest.DIGESTS_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+def is_current(entry, size, mtime):
+    return bool(entry) and not entry.get("deleted") and entry["size"] == size and entry["mtime"] == mtime
+
+
+def under(rel, paths):
+    return any(rel == p or rel.startswith(p + "/") for p in paths)
+
+
+def hashed(run_dir, rel):
+    """(digest, size, mtime) of one file, or None if it is gone."""
+    path = os.path.join(run_dir, rel)
+    try:
+        st = os.stat(path)
+        return file_digest(path), st.st_size, round(st.st_mtime, 3)
+    except FileNotFoundError:
+        return None
+
+
+def refresh(run_dir, paths=None):
+    """Hashes the files of a run that are new or changed since they were
+    hashed; with `paths` (files or folders relative to the run), only
+    those. A full pass also records deleted files. Returns the number of
+    entries that changed."""
+    files = {rel.replace(os.sep, "/"): (size, mtime) for rel, size, mtime in run_manifest.list_files(run_dir)}
+    if paths is not None:
+        paths = [p.replace(os.sep, "/").rstrip("/") for p in paths]
+        files = {rel: stat for rel, stat in files.items() if under(rel, paths)}
+
+    known = load(run_dir)["files"]
+    stale = [rel for rel, (size, mtime) in files.items() if not is_current(known.get(rel), size, mtime)]
+    results = dict(zip(stale, POOL.map(lambda rel: hashed(run_dir, rel), stale)))
+
+    with run_lock(run_dir):
+        manifest = load(run_dir)
+        version = manifest["version"] + 1
+        changed = 0
+        for rel, result in results.items():
+            if result is None:
+                continue       # deleted meanwhile
+            digest, size, mtime = result
+            entry = manifest["files"].get(rel)
+            if entry and not entry.get("deleted") and entry["blake2b"] == digest:
+                entry.update(size=size, mtime=mtime)       # touched, same content
+                continue
+            manifest["files"][rel] = {"size": size, "mtime": mtime, "blake2b": digest, "version": version}
+            changed += 1
+        if paths is None:
+            for rel, entry in manifest["files"].items():
+                if rel not in files and not entry.get("deleted"):
+                    manifest["files"][rel] = {"deleted": True, "version": version}
+                    changed += 1
+        if changed:
+            manifest["version"] = version
+        if changed or results:
+            save(run_dir, manifest)
+    return changed
+
+
+def run_refresh(run_dir, paths):
+    try:
+        changed = refresh(run_dir, paths)
+        if changed:
+            print(f"[DIGEST] {run_dir}: {changed} artifact(s) hashed")
+    except Exception as e:
+        print(f"[DIGEST] Could not hash {run_dir}: {e}")
+
+
+def schedule(run_dir, paths=None):
+    """Hashes a run's artifacts in the background (e.g. a stage's outputs
+    when it finishes, or the whole run when it ends)."""
+    threading.Thread(target=run_refresh, args=(run_dir, paths), daemon=True).start()
+
+
+def lookup(run_dir, rel):
+    """Hex digest of a run file if it is recorded and the file is unchanged."""
+    entry = load(run_dir)["files"].get(rel.replace(os.sep, "/"))
+    try:
+        st = os.stat(os.path.join(run_dir, rel))
+    except OSError:
+        return None
+    return entry["blake2b"] if is_current(entry, st.st_size, round(st.st_mtime, 3)) else None
+
+
+def changes_since(run_dir, version):
+    """{"version", "changed": [...], "deleted": [...], "complete"} since `version`.
+
+    A version the run never had (e.g. from before the manifest was reset)
+    gets the whole manifest, flagged "complete".
+    """
+    manifest = load(run_dir)
+    complete = version is None or not 0 <= version <= manifest["version"]
+    since = 0 if complete else version
+    changed, deleted = [], []
+    for rel, entry in sorted(manifest["files"].items()):
+        if entry["version"] <= since:
+            continue
+        if entry.get("deleted"):
+            if not complete:
+                deleted.append(rel)
+        else:
+            changed.append({"path": rel, "size": entry["size"], "blake2b": entry["blake2b"]})
+    return {"version": manifest["version"], "changed": changed, "deleted": deleted, "complete": complete}
@@ -0,0 +1,84 @@
+import os
+import json
+import datetime
+
+CHECKPOINT_DIR = ".checkpoints"
+
+
+# -------------------------------------------------
+# Output fingerprints
+# -------------------------------------------------
+def fingerprint(output_dir, rel_paths):
+    """{relative file path: [size, mtime_ns]} for every file under `rel_paths`."""
+    prints = {}
+    for rel in rel_paths:
+        path = os.path.join(output_dir, rel)
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    full = os.path.join(root, name)
+                    st = os.stat(full)
+                    prints[os.path.relpath(full, output_dir).replace(os.sep, "/")] = [st.st_size, st.st_mtime_ns]
+        elif os.path.isfile(path):
+            st = os.stat(path)
+            prints[rel] = [st.st_size, st.st_mtime_ns]
+    return prints
+
+
+def outputs_present(output_dir, stage):
+    return all(os.path.exists(os.path.join(output_dir, rel)) for rel in stage.outputs)
+
+
+# -------------------------------------------------
+# Checkpoint files
+# -------------------------------------------------
+def checkpoint_path(output_dir, stage_name):
+    return os.path.join(output_dir, CHECKPOINT_DIR, f"{stage_name}.json")
+
+
+def write_checkpoint(output_dir, stage, key=None):
+    """Records that `stage` completed, with a fingerprint of its outputs.
+
+    Stages that exited cleanly without producing their declared outputs
+    (skipped in lenient mode) get no checkpoint, so a resume retries them.
+    """
+    if not outputs_present(output_dir, stage):
+        return False
+
+    path = checkpoint_path(output_dir, stage.name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({
+            "stage": stage.name,
+            "key": key,
+            "completed_at": datetime.datetime.now().isoformat(),
+            "outputs": fingerprint(output_dir, stage.outputs),
+        }, f)
+    os.replace(tmp, path)
+    return True
+
+
+def read_checkpoint(output_dir, stage_name):
+    try:
+        with open(checkpoint_path(output_dir, stage_name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def verify_checkpoint(output_dir, stage):
+    """Returns the checkpoint if the stage's outputs still match it, else None."""
+    checkpoint = read_checkpoint(output_dir, stage.name)
+    if not checkpoint or not outputs_present(output_dir, stage):
+        return None
+    if checkpoint.get("outputs") != fingerprint(output_dir, stage.outputs):
+        return None
+    return checkpoint
+
+
+def clear_checkpoint(output_dir, stage_name):
+    try:
+        os.remove(checkpoint_path(output_dir, stage_name))
+    except OSError:
+        pass
@@ -0,0 +1,112 @@
+import os
+import threading
+
+
+def host_cpus():
+    """CPUs this process may run on (honours cgroup/taskset limits)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# -------------------------------------------------
+# Per-run grant
+# -------------------------------------------------
+class Allocation:
+    """The CPU set granted to one run.
+
+    `cpus` only ever grows while the run is alive (cores freed by finished
+    runs are handed out by `CoreAllocator.rebalance`). Callbacks registered
+    with `subscribe` are called with the allocation after every change.
+    """
+
+    def __init__(self, run_id, wanted, cpus):
+        self.run_id = run_id
+        self.wanted = wanted
+        self.cpus = list(cpus)
+        self.listeners = []
+
+    @property
+    def threads(self):
+        return len(self.cpus)
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+
+# -------------------------------------------------
+# Host allocator
+# -------------------------------------------------
+class CoreAllocator:
+    """Hands out disjoint CPU sets to concurrent runs.
+
+    A run asking for more cores than are free starts with what is left, as
+    long as that is at least half of its request, and is topped up as other
+    runs release their cores (oldest runs first).
+    """
+
+    def __init__(self, cpus=None):
+        self.cpus = list(cpus) if cpus is not None else host_cpus()
+        self.lock = threading.Lock()
+        self.free = list(self.cpus)
+        self.allocations = []        # oldest first
+
+    def clamp(self, wanted):
+        try:
+            wanted = int(wanted)
+        except (TypeError, ValueError):
+            wanted = 1
+        return max(1, min(wanted, len(self.cpus)))
+
+    def can_grant(self, wanted):
+        wanted = self.clamp(wanted)
+        with self.lock:
+            if not self.allocations:
+                return True
+            return len(self.free) >= max(1, wanted // 2)
+
+    def allocate(self, run_id, wanted):
+        """Grants up to `wanted` free cores (at least one) to `run_id`.
+
+        Returns None when every core is held; the caller retries after a
+        `release`.
+        """
+        wanted = self.clamp(wanted)
+        with self.lock:
+            if not self.free:
+                return None
+            # Lowest numbered cores first keeps a run's cores adjacent.
+            cpus, self.free = self.free[:wanted], self.free[wanted:]
+            allocation = Allocation(run_id, wanted, cpus)
+            self.allocations.append(allocation)
+        return allocation
+
+    def release(self, allocation):
+        """Returns a finished run's cores and tops up the runs still going."""
+        with self.lock:
+            if allocation not in self.allocations:
+                return
+            self.allocations.remove(allocation)
+            self.free = sorted(self.free + allocation.cpus)
+        self.rebalance()
+
+    def rebalance(self):
+        changed = []
+        with self.lock:
+            for allocation in self.allocations:
+                missing = allocation.wanted - len(allocation.cpus)
+                if missing <= 0 or not self.free:
+                    continue
+                extra, self.free = self.free[:missing], self.free[missing:]
+                allocation.cpus = sorted(allocation.cpus + extra)
+                changed.append(allocation)
+
+        for allocation in changed:
+            for callback in list(allocation.listeners):
+                try:
+                    callback(allocation)
+                except Exception as e:
+                    print(f"[CORES] Rebalance callback for {allocation.run_id} failed: {e}")
+
+
+ALLOCATOR = CoreAllocator()
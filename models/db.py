@@ -1,34 +1,127 @@
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
+from mysql.connector.errors import PoolError
+from contextlib import contextmanager
+from datetime import datetime
 import os
+import time
+import threading
+
+from models import session_cache
+
+# One pool per process; MySQL Connector caps a pool at 32 connections
+DB_POOL_SIZE = min(max(1, int(os.environ.get('DB_POOL_SIZE', 10))), pooling.CNX_POOL_MAXSIZE)
+# How long a caller waits for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def db_config(database=None):
+    config = {
+        "host": os.environ.get('DB_HOST', 'localhost'),
+        "port": int(os.environ.get('DB_PORT', 3306)),
+        "user": os.environ.get('DB_USER', 'root'),
+        "password": os.environ.get('DB_PASSWORD', '2005'),
+    }
+    if database:
+        config["database"] = database
+    return config
+
+
+class PooledConnection:
+    """A connection checked out of the pool.
+
+    close() puts it back instead of closing it (so does leaving a `with`
+    block, or dropping it without closing). The pool resets the session on
+    the way back, which also rolls back anything left uncommitted.
+    """
+
+    def __init__(self, pooled):
+        self._pooled = pooled
+
+    def __getattr__(self, attr):
+        return getattr(self._pooled, attr)
+
+    def is_connected(self):
+        return self._pooled is not None and self._pooled.is_connected()
+
+    def close(self):
+        pooled, self._pooled = self._pooled, None
+        if pooled is None:
+            return
+        try:
+            pooled.close()
+        except Error as e:
+            # Back in the pool either way; it is reconnected on next checkout
+            print(f"Error resetting pooled connection: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def get_pool():
+    """The process-wide pool, opened on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = pooling.MySQLConnectionPool(
+                pool_name="mapnmark",
+                pool_size=DB_POOL_SIZE,
+                pool_reset_session=True,
+                **db_config(os.environ.get('DB_NAME', 'gene_app'))
+            )
+        return _pool
+
+
+def checkout(timeout=None):
+    """A pooled connection, waiting up to `timeout` seconds (default
+    DB_POOL_TIMEOUT) for a free one.
+
+    The pool checks the connection on the way out (a ping) and reconnects
+    it if the server dropped it while it sat idle.
+    """
+    deadline = time.time() + (DB_POOL_TIMEOUT if timeout is None else timeout)
+    while True:
+        try:
+            return PooledConnection(get_pool().get_connection())
+        except PoolError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.05)
+
 
 def get_db_connection(database=None):
-    """Establishes a connection to the MySQL database."""
+    """Establishes a connection to the MySQL database.
+
+    Connections to the app's database come from the process-wide pool;
+    close() hands them back. Returns None if MySQL cannot be reached.
+    """
     # Use default DB name if not provided, unless explicitly set to None (to check connection/create DB)
     if database is None:
         database = os.environ.get('DB_NAME', 'gene_app')
 
     try:
-        # Try connecting with the specified database
-        connection = mysql.connector.connect(
-            host=os.environ.get('DB_HOST', 'localhost'),
-            port=int(os.environ.get('DB_PORT', 3306)),
-            user=os.environ.get('DB_USER', 'root'),
-            password=os.environ.get('DB_PASSWORD', '2005'),
-            database=database
-        )
+        if database == os.environ.get('DB_NAME', 'gene_app'):
+            return checkout()
+        connection = mysql.connector.connect(**db_config(database))
         if connection.is_connected():
             return connection
     except Error as e:
         # If database unknown, try connecting without it to create it later
         if e.errno == 1049: # Unknown database
              try:
-                 connection = mysql.connector.connect(
-                    host=os.environ.get('DB_HOST', 'localhost'),
-                    port=int(os.environ.get('DB_PORT', 3306)),
-                    user=os.environ.get('DB_USER', 'root'),
-                    password=os.environ.get('DB_PASSWORD', '2005')
-                )
+                 connection = mysql.connector.connect(**db_config())
                  return connection
              except Error as ex:
                  print(f"Error connecting without DB: {ex}")
@@ -37,6 +130,18 @@ def get_db_connection(database=None):
         print(f"Error while connecting to MySQL: {e}")
         return None
 
+
+@contextmanager
+def db_connection():
+    """`with db_connection() as conn:` checks a connection out of the pool
+    and back in (conn is None if MySQL cannot be reached)."""
+    connection = get_db_connection()
+    try:
+        yield connection
+    finally:
+        if connection is not None:
+            connection.close()
+
 def get_user_by_email(email):
     """Fetches a user by email from the database."""
     connection = get_db_connection()
@@ -59,6 +164,29 @@ def get_user_by_email(email):
             cursor.close()
             connection.close()
 
+def load_session_token(email):
+    """(user exists, session token) straight from the DB, or None on error."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT session_token FROM users WHERE email = %s", (email,))
+        row = cursor.fetchone()
+        cursor.close()
+        return (row is not None, row[0] if row else None)
+    except Error as e:
+        print(f"Error reading session token: {e}")
+        return None
+    finally:
+        connection.close()
+
+def get_session_token(email):
+    """(user exists, session token) for the single-session check, cached for
+    a few seconds (models.session_cache). None if the DB cannot be reached."""
+    return session_cache.lookup(email, lambda: load_session_token(email))
+
 def update_user_session_token(email, token):
     """Updates the session token for a user."""
     connection = get_db_connection()
@@ -70,6 +198,7 @@ def update_user_session_token(email, token):
         query = "UPDATE users SET session_token = %s WHERE email = %s"
         cursor.execute(query, (token, email))
         connection.commit()
+        session_cache.invalidate(email)
         return True
     except Error as e:
         print(f"Error updating session token: {e}")
@@ -85,12 +214,7 @@ def init_db():
     
     # First, connect without specifying a DB to ensure it exists
     try:
-        connection = mysql.connector.connect(
-            host=os.environ.get('DB_HOST', 'localhost'),
-            port=int(os.environ.get('DB_PORT', 3306)),
-            user=os.environ.get('DB_USER', 'root'),
-            password=os.environ.get('DB_PASSWORD', '2005')
-        )
+        connection = mysql.connector.connect(**db_config())
     except Error as e:
         print(f"Could not connect to MySQL server: {e}")
         return
@@ -159,6 +283,53 @@ def init_db():
         """
         cursor.execute(create_runs_table_query)
         print("Pipeline runs table checked/created successfully.")
+
+        # Create Job Queue Table
+        create_jobs_table_query = """
+        CREATE TABLE IF NOT EXISTS pipeline_jobs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            run_id VARCHAR(50) NOT NULL UNIQUE,
+            user_email VARCHAR(255),
+            job_type VARCHAR(50) NOT NULL,
+            payload TEXT,
+            threads INT DEFAULT 1,
+            memory_mb INT DEFAULT 0,
+            state VARCHAR(20) NOT NULL DEFAULT 'queued',
+            attempts INT DEFAULT 0,
+            queued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME,
+            finished_at DATETIME,
+            INDEX idx_pipeline_jobs_state (state, id)
+        );
+        """
+        cursor.execute(create_jobs_table_query)
+        print("Pipeline jobs table checked/created successfully.")
+
+        # Create Stage Metrics Table
+        create_metrics_table_query = """
+        CREATE TABLE IF NOT EXISTS pipeline_stage_metrics (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            run_id VARCHAR(50) NOT NULL,
+            stage VARCHAR(100) NOT NULL,
+            title VARCHAR(255),
+            tool VARCHAR(100),
+            status VARCHAR(50),
+            exit_code INT,
+            threads INT,
+            wall_seconds DOUBLE,
+            cpu_user_seconds DOUBLE,
+            cpu_system_seconds DOUBLE,
+            max_rss_kb BIGINT,
+            read_bytes BIGINT,
+            write_bytes BIGINT,
+            started_at DATETIME,
+            finished_at DATETIME,
+            UNIQUE KEY uq_run_stage (run_id, stage),
+            FOREIGN KEY (run_id) REFERENCES pipeline_runs(run_id) ON DELETE CASCADE
+        );
+        """
+        cursor.execute(create_metrics_table_query)
+        print("Stage metrics table checked/created successfully.")
         
         # MIGRATION: Ensure session_token column exists
         try:
@@ -197,6 +368,17 @@ def init_db():
     except Error:
         pass
 
+    # MIGRATION 5: Index for paging a user's runs by start time
+    try:
+        cursor.execute("SHOW INDEX FROM pipeline_runs WHERE Key_name = 'idx_pipeline_runs_user_start'")
+        if not cursor.fetchall():
+            cursor.execute(
+                "CREATE INDEX idx_pipeline_runs_user_start ON pipeline_runs (user_email, start_time, run_id)"
+            )
+            connection.commit()
+    except Error as e:
+        print(f"Error indexing pipeline_runs: {e}")
+
     # MIGRATION 3: Add run_type column
     try:
         cursor.execute("SELECT run_type FROM pipeline_runs LIMIT 1")
@@ -205,6 +387,14 @@ def init_db():
         cursor.execute("ALTER TABLE pipeline_runs ADD COLUMN run_type VARCHAR(50) DEFAULT 'pipeline'")
         connection.commit()
 
+    # MIGRATION 6: Tool a stage's threads were sized for (thread tuning)
+    try:
+        cursor.execute("SELECT tool FROM pipeline_stage_metrics LIMIT 1")
+        cursor.fetchall()
+    except Error:
+        cursor.execute("ALTER TABLE pipeline_stage_metrics ADD COLUMN tool VARCHAR(100) AFTER title")
+        connection.commit()
+
     finally:
         if connection.is_connected():
             cursor.close()
@@ -267,3 +457,129 @@ def get_run_by_id(run_id):
         if connection and connection.is_connected():
             cursor.close()
             connection.close()
+
+
+def get_runs_by_ids(user_email, run_ids):
+    """Fetches a user's pipeline runs as {run_id: row} in one query."""
+    run_ids = list(run_ids)
+    if not run_ids:
+        return {}
+    connection = get_db_connection()
+    if connection is None:
+        return {}
+
+    try:
+        cursor = connection.cursor(dictionary=True)
+        placeholders = ", ".join(["%s"] * len(run_ids))
+        cursor.execute(
+            f"SELECT * FROM pipeline_runs WHERE user_email = %s AND run_id IN ({placeholders})",
+            (user_email,) + tuple(run_ids)
+        )
+        return {row["run_id"]: row for row in cursor.fetchall()}
+    except Error as e:
+        print(f"Error executing query: {e}")
+        return {}
+    finally:
+        if connection.is_connected():
+            cursor.close()
+            connection.close()
+
+
+def get_runs_page(user_email, limit, before=None):
+    """One page of a user's runs, newest first.
+
+    Keyset pagination: `before` is the (start_time, run_id) of the last run
+    of the previous page, so a page costs the same however deep it is.
+    """
+    connection = get_db_connection()
+    if connection is None:
+        return None
+
+    query = "SELECT run_id, status, run_type, start_time, end_time FROM pipeline_runs WHERE user_email = %s"
+    params = [user_email]
+    if before is not None:
+        query += " AND (start_time < %s OR (start_time = %s AND run_id < %s))"
+        params += [before[0], before[0], before[1]]
+    query += " ORDER BY start_time DESC, run_id DESC LIMIT %s"
+    params.append(limit)
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(query, tuple(params))
+        return cursor.fetchall()
+    except Error as e:
+        print(f"Error executing query: {e}")
+        return None
+    finally:
+        if connection.is_connected():
+            cursor.close()
+            connection.close()
+
+
+STAGE_METRIC_COLUMNS = (
+    "title", "tool", "status", "exit_code", "threads", "wall_seconds", "cpu_user_seconds",
+    "cpu_system_seconds", "max_rss_kb", "read_bytes", "write_bytes", "started_at", "finished_at"
+)
+
+def save_stage_metrics(run_id, stages):
+    """Stores a run's per-stage metrics ({stage: metrics.json entry}), replacing earlier rows."""
+    if not stages:
+        return False
+    connection = get_db_connection()
+    if connection is None:
+        return False
+
+    columns = ", ".join(STAGE_METRIC_COLUMNS)
+    placeholders = ", ".join(["%s"] * (len(STAGE_METRIC_COLUMNS) + 2))
+    def value(entry, column):
+        if column in ("started_at", "finished_at") and entry.get(column):
+            return datetime.fromisoformat(entry[column])
+        return entry.get(column)
+
+    rows = [
+        (run_id, stage) + tuple(value(entry, c) for c in STAGE_METRIC_COLUMNS)
+        for stage, entry in stages.items()
+    ]
+    try:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM pipeline_stage_metrics WHERE run_id = %s", (run_id,))
+        cursor.executemany(
+            f"INSERT INTO pipeline_stage_metrics (run_id, stage, {columns}) VALUES ({placeholders})",
+            rows
+        )
+        connection.commit()
+        return True
+    except Error as e:
+        print(f"Error saving stage metrics: {e}")
+        return False
+    finally:
+        if connection.is_connected():
+            cursor.close()
+            connection.close()
+
+def get_stage_metrics(run_ids):
+    """Fetches per-stage metrics for the given runs as {run_id: [rows]}."""
+    run_ids = list(run_ids)
+    if not run_ids:
+        return {}
+    connection = get_db_connection()
+    if connection is None:
+        return {}
+
+    try:
+        cursor = connection.cursor(dictionary=True)
+        placeholders = ", ".join(["%s"] * len(run_ids))
+        cursor.execute(
+            f"SELECT * FROM pipeline_stage_metrics WHERE run_id IN ({placeholders}) ORDER BY started_at, id",
+            tuple(run_ids)
+        )
+        metrics = {}
+        for row in cursor.fetchall():
+            metrics.setdefault(row["run_id"], []).append(row)
+        return metrics
+    except Error as e:
+        print(f"Error executing query: {e}")
+        return {}
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
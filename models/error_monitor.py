@@ -0,0 +1,193 @@
+import os
+import re
+import json
+import threading
+
+from models import run_state
+from models.thread_tuning import tool_of
+from utils.log_tail import read_log_bytes
+from utils.log_sink import latest_segment, open_segment
+from utils.executor import kill_run
+
+SCAN_SECONDS = float(os.environ.get("ERROR_SCAN_SECONDS", 1))
+SCAN_FILE = ".error_scan.json"
+
+# Fatal error lines per tool ("*" applies to every run). Only lines that
+# mean the run cannot succeed belong here: tools print plenty of harmless
+# "error"/"failed" text (e.g. Flye's "non-fatal errors" summary).
+DEFAULT_RULES = {
+    "*": [
+        r"^Traceback \(most recent call last\):",
+        r"\bMemoryError\b",
+        r"No space left on device",
+        r"^Segmentation fault",
+    ],
+    "porechop": [r"^Error: "],
+    "filtlong": [r"^Error: "],
+    "flye": [r"^\[[^\]]+\] ERROR: "],
+    "minimap2": [r"^\[E::\w+\]"],
+    "racon": [r"^\[racon::\w+\] error:"],
+    "prokka": [r"^\[[\d:]+\] ERROR: "],
+    "quast": [r"^ERROR! "],
+    "fastqc": [r"^Failed to process file"],
+}
+
+
+def load_rules(path=None):
+    """DEFAULT_RULES, with tools overridden from the JSON file in ERROR_RULES_FILE.
+
+    The file maps a tool name (or "*") to a list of regexes; listing a tool
+    replaces its default rules, an empty list disables them.
+    """
+    rules = {tool: list(patterns) for tool, patterns in DEFAULT_RULES.items()}
+    path = path or os.environ.get("ERROR_RULES_FILE")
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            rules.update(json.load(f))
+    return compile_rules(rules)
+
+
+def compile_rules(rules):
+    return {tool: [re.compile(p) for p in patterns] for tool, patterns in rules.items()}
+
+
+def load_scan(output_dir):
+    try:
+        with open(os.path.join(output_dir, SCAN_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"offset": 0, "fatal": None}
+
+
+def save_scan(output_dir, scan):
+    path = os.path.join(output_dir, SCAN_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(scan, f)
+    os.replace(tmp, path)
+
+
+def terminate_run(output_dir, log_file, match):
+    """Default fatal-match action: the same path as a user cancel (CANCEL + kill_run).
+
+    The reason goes into CANCEL; the scheduler, the log's only writer,
+    logs it when it stops the run.
+    """
+    reason = f"Auto-terminated pipeline: fatal {match['tool']} error detected: {match['line']}"
+    with open(os.path.join(output_dir, "CANCEL"), "w") as f:
+        f.write(reason + "\n")
+    kill_run(output_dir)
+
+
+class ErrorMonitor:
+    """Watches one running job's log for fatal tool errors.
+
+    Every SCAN_SECONDS only the complete lines appended since the last scan
+    are checked, and the scan offset is kept in the run directory so a
+    resumed or re-queued job does not rescan what was already checked.
+    When the log has been rotated, the rest of the rotated segment is
+    checked before the new file. A line is matched against the "*" rules
+    and those of every tool a started stage runs (from state.json). The
+    first fatal match is passed to `on_fatal(output_dir, log_file, match)`
+    (by default: terminate_run) and the monitor stops.
+    """
+
+    def __init__(self, output_dir, log_file, on_fatal=terminate_run, rules=None):
+        self.output_dir = output_dir
+        self.log_file = log_file
+        self.on_fatal = on_fatal
+        self.rules = rules if rules is not None else RULES
+        self.scan = load_scan(output_dir)
+        # Rotated segment the scan offset belongs after (older ones are
+        # from before this run, or a previous attempt)
+        self.scan.setdefault("segment", latest_segment(log_file))
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def fatal(self):
+        return self.scan.get("fatal")
+
+    def active_rules(self):
+        state = run_state.load_state(self.output_dir) or {}
+        tools = {"*"} | {
+            tool for name, stage in state.get("stages", {}).items()
+            if stage.get("status") != "pending"
+            for tool in stage.get("tools") or [tool_of(name)]
+        }
+        return [(tool, rule) for tool in tools for rule in self.rules.get(tool, ())]
+
+    def check(self, lines, rules):
+        """Records and returns the first fatal match among `lines`."""
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", errors="replace")
+            for tool, rule in rules:
+                if rule.search(line):
+                    self.scan["fatal"] = {"tool": tool, "rule": rule.pattern, "line": line.strip()}
+                    return self.scan["fatal"]
+        return None
+
+    def finish_segments(self, latest, rules):
+        """Checks what was left unscanned of the segments rotated since the
+        last scan. Returns the fatal match, if any."""
+        while self.scan["segment"] < latest and not self.scan["fatal"]:
+            number = self.scan["segment"] + 1
+            with open_segment(self.log_file, number) as f:
+                f.seek(self.scan["offset"])
+                self.check(f, rules)
+            self.scan.update(segment=number, offset=0)
+            save_scan(self.output_dir, self.scan)
+        return self.scan["fatal"]
+
+    def scan_once(self):
+        """Checks newly written lines. Returns the fatal match, if any."""
+        rules = None
+        while True:
+            latest = latest_segment(self.log_file)
+            if latest > self.scan["segment"]:
+                rules = rules if rules is not None else self.active_rules()
+                if self.finish_segments(latest, rules):
+                    return self.scan["fatal"]
+            data, offset, more, _ = read_log_bytes(self.log_file, self.scan["offset"])
+            if latest_segment(self.log_file) != latest:
+                continue     # rotated while it was read: finish the old file first
+            if data:
+                rules = rules if rules is not None else self.active_rules()
+                self.check(data.decode("utf-8", errors="replace").splitlines(), rules)
+            if offset != self.scan["offset"] or self.scan["fatal"]:
+                self.scan["offset"] = offset
+                save_scan(self.output_dir, self.scan)
+            if self.scan["fatal"] or not more:
+                return self.scan["fatal"]
+
+    def run(self):
+        while not self.stop_event.wait(SCAN_SECONDS):
+            try:
+                match = self.scan_once()
+            except OSError as e:
+                print(f"[MONITOR] Log scan failed for {self.output_dir}: {e}")
+                continue
+            if match:
+                self.on_fatal(self.output_dir, self.log_file, match)
+                return
+
+    def start(self):
+        # A previous attempt's match does not stop a resumed run
+        self.scan["fatal"] = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the monitor thread (the job has ended)."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+try:
+    RULES = load_rules()
+except (OSError, ValueError, re.error) as e:
+    print(f"[MONITOR] Ignoring ERROR_RULES_FILE ({e}); using the default rules")
+    RULES = compile_rules(DEFAULT_RULES)
@@ -0,0 +1,324 @@
+import os
+import json
+import queue
+import threading
+import traceback
+
+from models.db import get_db_connection
+from models.core_allocator import ALLOCATOR
+
+# -------------------------------------------------
+# Configuration
+# -------------------------------------------------
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", "2")))
+
+# Memory reserved per job type when the submitter gives no estimate (MB)
+DEFAULT_MEMORY_MB = {
+    "analysis": int(os.environ.get("JOB_ANALYSIS_MEMORY_MB", "8192")),
+    "diagnostic": int(os.environ.get("JOB_DIAGNOSTIC_MEMORY_MB", "8192")),
+    "blast": int(os.environ.get("JOB_BLAST_MEMORY_MB", "2048")),
+}
+
+POLL_SECONDS = 5
+
+_handlers = {}                 # job type -> callable(job)
+_wakeup = threading.Condition()
+_started = False
+
+
+def register(job_type, handler):
+    """Registers the function that runs jobs of `job_type`.
+
+    The handler receives the job row (with `payload` decoded and the run's
+    core `allocation`) and runs the job to completion on a worker thread.
+    The job keeps its worker and cores until the handler returns, so
+    follow-up work such as emails belongs on another thread (releasing the
+    allocation early is fine: the pool's release is a no-op then).
+    """
+    _handlers[job_type] = handler
+
+
+def _notify():
+    with _wakeup:
+        _wakeup.notify_all()
+
+
+# -------------------------------------------------
+# Host resources
+# -------------------------------------------------
+def memory_info_mb():
+    """Returns (total, available) memory in MB, or (None, None) if unknown."""
+    try:
+        values = {}
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                values[name] = int(rest.split()[0]) // 1024
+        return values.get("MemTotal"), values.get("MemAvailable")
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+# -------------------------------------------------
+# Queue table
+# -------------------------------------------------
+def enqueue(run_id, user_email, job_type, payload, threads=1, memory_mb=None):
+    """Adds a job to the durable queue.
+
+    Returns False if the DB is unavailable or the run already has a job
+    that is queued or running.
+    """
+    threads = ALLOCATOR.clamp(threads)
+    if memory_mb is None:
+        memory_mb = DEFAULT_MEMORY_MB.get(job_type, 1024)
+
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        # A resubmitted run (resume) goes to the back of the queue
+        cursor.execute("DELETE FROM pipeline_jobs WHERE run_id = %s AND state = 'done'", (run_id,))
+        cursor.execute(
+            "INSERT INTO pipeline_jobs (run_id, user_email, job_type, payload, threads, memory_mb, state) "
+            "VALUES (%s, %s, %s, %s, %s, %s, 'queued')",
+            (run_id, user_email, job_type, json.dumps(payload), threads, memory_mb)
+        )
+        conn.commit()
+        cursor.close()
+    except Exception as e:
+        print(f"Failed to enqueue job {run_id}: {e}")
+        return False
+    finally:
+        conn.close()
+
+    _notify()
+    return True
+
+
+def queue_position(run_id):
+    """1-based position of a queued job, or None if it is not waiting."""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM pipeline_jobs q "
+            "JOIN pipeline_jobs j ON j.run_id = %s AND j.state = 'queued' "
+            "WHERE q.state = 'queued' AND q.id <= j.id",
+            (run_id,)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row and row[0] else None
+    except Exception as e:
+        print(f"Failed to read queue position for {run_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def cancel_queued(run_id):
+    """Drops a job that has not started yet. Returns True if one was removed."""
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE pipeline_jobs SET state = 'done', finished_at = NOW() "
+            "WHERE run_id = %s AND state = 'queued'",
+            (run_id,)
+        )
+        conn.commit()
+        removed = cursor.rowcount == 1
+        cursor.close()
+        return removed
+    except Exception as e:
+        print(f"Failed to cancel queued job {run_id}: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def _head_job():
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM pipeline_jobs WHERE state = 'queued' ORDER BY id LIMIT 1")
+        job = cursor.fetchone()
+        cursor.close()
+        return job
+    finally:
+        conn.close()
+
+
+def _update(query, params):
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        conn.commit()
+        changed = cursor.rowcount == 1
+        cursor.close()
+        return changed
+    finally:
+        conn.close()
+
+
+def _claim(job_id):
+    """Atomically moves a job from queued to running."""
+    return _update(
+        "UPDATE pipeline_jobs SET state = 'running', started_at = NOW(), attempts = attempts + 1 "
+        "WHERE id = %s AND state = 'queued'",
+        (job_id,)
+    )
+
+
+def _finish(job_id):
+    return _update(
+        "UPDATE pipeline_jobs SET state = 'done', finished_at = NOW() WHERE id = %s",
+        (job_id,)
+    )
+
+
+def recover_interrupted():
+    """Puts jobs that were running when the web process died back in the queue."""
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE pipeline_jobs SET state = 'queued', started_at = NULL WHERE state = 'running'"
+        )
+        conn.commit()
+        count = cursor.rowcount
+        cursor.close()
+        return count
+    except Exception as e:
+        print(f"Failed to recover interrupted jobs: {e}")
+        return 0
+    finally:
+        conn.close()
+
+
+# -------------------------------------------------
+# Worker pool
+# -------------------------------------------------
+class WorkerPool:
+    """A fixed number of worker threads fed by one dispatcher.
+
+    The dispatcher takes queued jobs strictly in submission order and starts
+    the head job only when a worker is idle, the core allocator can grant it
+    cores and its memory fits next to the jobs already running (a job always
+    starts on an idle host, however large it is).
+    """
+
+    def __init__(self, workers=JOB_WORKERS, allocator=ALLOCATOR):
+        self.workers = workers
+        self.allocator = allocator
+        self.lock = threading.Lock()
+        self.running = {}          # job id -> job row
+        self.ready = queue.Queue()
+
+    def reserved_memory(self):
+        with self.lock:
+            return sum(j["memory_mb"] for j in self.running.values())
+
+    def admits(self, job):
+        with self.lock:
+            busy = len(self.running)
+        if busy >= self.workers:
+            return False
+        if not busy:
+            return True
+
+        if not self.allocator.can_grant(job["threads"]):
+            return False
+        memory = self.reserved_memory()
+        total, available = memory_info_mb()
+        if total is not None:
+            if memory + job["memory_mb"] > total or job["memory_mb"] > available:
+                return False
+        return True
+
+    def dispatch_once(self):
+        """Starts the head job if it can be admitted. Returns True if one started."""
+        job = _head_job()
+        if not job or not self.admits(job):
+            return False
+        # No free core (a finished job not released yet): stay queued, the
+        # worker's release wakes the dispatcher.
+        allocation = self.allocator.allocate(job["run_id"], job["threads"])
+        if allocation is None:
+            return False
+        if not _claim(job["id"]):
+            self.allocator.release(allocation)
+            return False
+
+        job["attempts"] += 1
+        job["allocation"] = allocation
+        with self.lock:
+            self.running[job["id"]] = job
+        self.ready.put(job)
+        return True
+
+    def dispatcher(self):
+        while True:
+            try:
+                if self.dispatch_once():
+                    continue
+            except Exception as e:
+                print(f"[QUEUE] Dispatcher error: {e}")
+            with _wakeup:
+                _wakeup.wait(POLL_SECONDS)
+
+    def worker(self):
+        while True:
+            job = self.ready.get()
+            handler = _handlers.get(job["job_type"])
+            try:
+                job["payload"] = json.loads(job["payload"] or "{}")
+                if handler is None:
+                    raise RuntimeError(f"No handler for job type '{job['job_type']}'")
+                handler(job)
+            except Exception as e:
+                print(f"[QUEUE] Job {job['run_id']} failed: {e}")
+                traceback.print_exc()
+            finally:
+                try:
+                    _finish(job["id"])
+                except Exception as e:
+                    print(f"[QUEUE] Could not mark job {job['run_id']} done: {e}")
+                with self.lock:
+                    self.running.pop(job["id"], None)
+                self.allocator.release(job["allocation"])
+                _notify()
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+        threading.Thread(target=self.dispatcher, daemon=True).start()
+
+
+POOL = WorkerPool()
+
+
+def start():
+    """Recovers interrupted jobs and starts the worker pool (once per process)."""
+    global _started
+    if _started:
+        return
+    _started = True
+
+    recovered = recover_interrupted()
+    if recovered:
+        print(f"[QUEUE] Re-queued {recovered} job(s) interrupted by a restart")
+    print(f"[QUEUE] Starting {POOL.workers} worker(s) for {len(POOL.allocator.cpus)} core(s)")
+    POOL.start()
@@ -1,8 +1,11 @@
 import os
-import subprocess
-import uuid
 import datetime
 
+from models.scheduler import Stage, StageScheduler
+from models.thread_tuning import tuned_limits
+from models import run_state
+from utils.executor import shell_path
+
 
 # -------------------------------------------------
 # Python-side debug (Flask console only)
@@ -11,222 +14,398 @@ def debug(msg):
     print(f"[PY-DEBUG {datetime.datetime.now().strftime('%H:%M:%S')}] {msg}")
 
 
+# Stream Porechop -> seqkit -> Filtlong instead of writing every
+# intermediate read set (PIPELINE_STREAMING=1)
+STREAMING_ENABLED = os.environ.get("PIPELINE_STREAMING", "0") in ("1", "true", "yes")
+
+
 # -------------------------------------------------
-# Convert Windows → WSL path
+# Per-tool resource profiles
 # -------------------------------------------------
-def convert_to_wsl_path(win_path):
-    win_path = os.path.abspath(win_path)
-    if not os.path.exists(win_path):
-        raise FileNotFoundError(f"Path does not exist: {win_path}")
+# Parallelism flag of each tool and the most threads it uses well
+# (None = as many as the run has). Caps learned from past runs'
+# metrics (models.thread_tuning) can only lower these.
+TOOL_PROFILES = {
+    "porechop": {"flag": "--threads", "max_threads": 16},  # scales poorly past 16
+    "fastqc":   {"flag": "--threads", "max_threads": 1},   # parallel across input files only
+    "flye":     {"flag": "--threads", "max_threads": None},
+    "minimap2": {"flag": "-t",        "max_threads": None},
+    "racon":    {"flag": "-t",        "max_threads": None},
+    "prokka":   {"flag": "--cpus",    "max_threads": None},
+    "quast":    {"flag": "--threads", "max_threads": None},
+}
 
-    drive, path = os.path.splitdrive(win_path)
-    drive_letter = drive.rstrip(":").lower()
-    linux_path = path.replace("\\", "/").lstrip("/")
-    return f"/mnt/{drive_letter}/{linux_path}"
 
+def threads_arg(tool):
+    """The tool's thread flag, bound to the threads the scheduler granted."""
+    return f"{TOOL_PROFILES[tool]['flag']} '$STAGE_THREADS'"
 
-# -------------------------------------------------
-# Run bash script inside WSL
-# -------------------------------------------------
-def run_script_in_wsl(script_contents, output_file):
-    script_dir = os.path.join("pipeline_runs", "scripts")
-    os.makedirs(script_dir, exist_ok=True)
-
-    script_path = os.path.join(script_dir, f"{uuid.uuid4()}.sh")
-    with open(script_path, "w", encoding="utf-8", newline="\n") as f:
-        f.write(script_contents)
-
-    wsl_script_path = convert_to_wsl_path(script_path)
-    subprocess.run(["wsl", "chmod", "+x", wsl_script_path], check=True)
-
-    with open(output_file, "a", encoding="utf-8") as logf:
-        process = subprocess.Popen(
-            ["wsl", "bash", wsl_script_path],
-            stdout=logf,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
-        ret = process.wait()
-        if ret != 0:
-            raise RuntimeError(f"Pipeline aborted with exit code {ret}")
+
+def tool_threads(tool, threads, limits=None):
+    """Threads a stage running `tool` should ask for out of `threads`."""
+    caps = [threads, TOOL_PROFILES[tool]["max_threads"], (limits or {}).get(tool)]
+    return max(1, min(c for c in caps if c))
 
 
 # -------------------------------------------------
-# MAIN PIPELINE
+# Shared stage preamble
 # -------------------------------------------------
-def run_pipeline_async(
-    input_fastq,
-    output_dir,
-    genome_size,
-    threads,
-    output_file,
-    min_length,
-    keep_percent,
-    selected_tools,
-    blast_db_path=""
-):
-    debug(f"Enabled tools: {selected_tools}")
+CONDA_ACTIVATION = """
+# -------------------------------------------------
+# Conda activation
+# -------------------------------------------------
+for p in "$HOME/miniconda3/bin" "$HOME/anaconda3/bin"; do
+    [ -d "$p" ] && export PATH="$p:$PATH"
+done
+
+if command -v conda &>/dev/null; then
+    BASE=$(conda info --base 2>/dev/null)
+    [ -f "$BASE/etc/profile.d/conda.sh" ] && source "$BASE/etc/profile.d/conda.sh"
+    conda activate pipeline || echo "[PIPELINE $(date '+%H:%M:%S')] Conda env not found"
+fi
+"""
 
-    input_fastq_wsl = convert_to_wsl_path(input_fastq)
-    output_dir_wsl = convert_to_wsl_path(output_dir)
-    blast_db_wsl = convert_to_wsl_path(blast_db_path) if blast_db_path else ""
 
-    script = f"""#!/usr/bin/env bash
+def build_preamble(input_fastq_sh, output_dir_sh, genome_size, threads,
+                   min_length, keep_percent, blast_db_sh):
+    return f"""#!/usr/bin/env bash
 set -euo pipefail
 
-INPUT_FASTQ="{input_fastq_wsl}"
-OUTPUT_DIR="{output_dir_wsl}"
+INPUT_FASTQ="{input_fastq_sh}"
+OUTPUT_DIR="{output_dir_sh}"
 GENOME_SIZE="{genome_size}"
 THREADS="{threads}"
 MIN_LENGTH="{min_length}"
 KEEP_PERCENT="{keep_percent}"
-BLAST_DB_PATH="{blast_db_wsl}"
+BLAST_DB_PATH="{blast_db_sh}"
 
-LOG_FILE="$OUTPUT_DIR/pipeline.log"
 mkdir -p "$OUTPUT_DIR"
-touch "$LOG_FILE"
-
-exec > >(stdbuf -oL tr '\\r' '\\n' | tee -a "$LOG_FILE") 2>&1
 
 log() {{
     echo "[PIPELINE $(date '+%H:%M:%S')] $1"
 }}
 
-run_with_cancel() {{
+run_step() {{
     CMD="$1"
     log "RUNNING: $CMD"
     bash -c "$CMD"
-    EXIT_CODE=$?
-    if [ $EXIT_CODE -ne 0 ]; then
-        log "PIPELINE ABORTED (exit code $EXIT_CODE)"
-        touch "$OUTPUT_DIR/PIPELINE_ABORTED"
-        exit $EXIT_CODE
-    fi
 }}
+""" + CONDA_ACTIVATION
 
-log "Pipeline started"
-log "Input FASTQ: $INPUT_FASTQ"
 
 # -------------------------------------------------
-# Conda activation
+# Stage graph
 # -------------------------------------------------
-for p in "$HOME/miniconda3/bin" "$HOME/anaconda3/bin"; do
-    [ -d "$p" ] && export PATH="$p:$PATH"
-done
-
-if command -v conda &>/dev/null; then
-    BASE=$(conda info --base 2>/dev/null)
-    [ -f "$BASE/etc/profile.d/conda.sh" ] && source "$BASE/etc/profile.d/conda.sh"
-    conda activate pipeline || log "Conda env not found"
+# Tools that read the Flye assembly
+ASSEMBLY_TOOLS = ("minimap2", "racon", "prokka", "quast")
+# Where Minimap2 writes its read alignments (the full pipeline has always
+# kept them in racon/reads.paf)
+PAF_PATH = "minimap2/reads.paf"
+
+
+def build_stages(selected_tools, threads, input_fastq, genome_size="", min_length="",
+                 keep_percent="", streaming=False, limits=None, paf_path=PAF_PATH):
+    """Expresses the selected tools as a dependency graph.
+
+    Each stage only depends on the stages whose files it reads, so e.g.
+    FastQC on the raw reads starts immediately and Prokka/QUAST/FastQC on
+    the filtered reads run side by side. Stage params only list values that
+    change a stage's output; they key the stage cache.
+
+    With `streaming=True` read processing is a single stage: Porechop pipes
+    into `seqkit rename`, whose output is spooled to a temporary file for
+    Filtlong (which reads its input twice). Only the filtered FASTQ is kept.
+
+    Every tool gets its thread flag from TOOL_PROFILES; `limits` are the
+    per-tool caps from thread_tuning. `paf_path` is where Minimap2's
+    alignments go, relative to the run folder.
+
+    Raises ValueError if a tool that needs the assembly is selected
+    without Flye.
+    """
+    needs_assembly = [t for t in ASSEMBLY_TOOLS if t in selected_tools]
+    if needs_assembly and "flye" not in selected_tools:
+        raise ValueError(f"{', '.join(needs_assembly)} need(s) Flye (the assembly) to be selected")
+
+    stages = []
+    reads = "$INPUT_FASTQ"     # current read set (shell path)
+    reads_stage = []           # stage that produced it
+    raw = [input_fastq]        # run inputs read directly by a stage
+
+    def reads_inputs():
+        return [] if reads_stage else raw
+
+    # ---------------- STREAMED PORECHOP | DEDUP -> FILTLONG ----------------
+    if streaming and "filtlong" in selected_tools:
+        trim = "porechop" in selected_tools
+        source = f"porechop {threads_arg('porechop')} -i" if trim else "cat"
+        stages.append(Stage(
+            "filtlong", "Filtlong", f"""
+mkdir -p "$OUTPUT_DIR/filtlong"
+if ! command -v seqkit &>/dev/null; then
+    log "PIPELINE ABORTED: seqkit not found"
+    exit 1
 fi
-
-CURRENT_FASTQ="$INPUT_FASTQ"
-CURRENT_FASTA=""
-CURRENT_FILE="$INPUT_FASTQ"
-"""
+SPOOL="$OUTPUT_DIR/filtlong/.dedup.spool.fastq"
+trap 'rm -f "$SPOOL"' EXIT
+
+log "RUNNING (streamed): {source} $INPUT_FASTQ | seqkit rename - -o $SPOOL"
+{source} "$INPUT_FASTQ" | seqkit rename - -o "$SPOOL"
+{'log "Porechop finished"' if trim else ''}
+log "Deduplication (SRA-safe) finished"
+
+run_step "filtlong --min_length '$MIN_LENGTH' --keep_percent '$KEEP_PERCENT' \\
+    '$SPOOL' > '$OUTPUT_DIR/filtlong/filtered.fastq'"
+""",
+            threads=tool_threads("porechop", threads, limits) if trim else 1, elastic=trim,
+            tools=(["porechop"] if trim else []) + ["filtlong"], requires=[reads],
+            outputs=["filtlong/filtered.fastq"], inputs=raw,
+            params={"min_length": min_length, "keep_percent": keep_percent, "porechop": trim}
+        ))
+        reads = "$OUTPUT_DIR/filtlong/filtered.fastq"
+        reads_stage = ["filtlong"]
+        selected_tools = [t for t in selected_tools if t not in ("porechop", "filtlong")]
 
     # ---------------- PORECHOP ----------------
     if "porechop" in selected_tools:
-        script += """
-log "STEP: Porechop"
+        stages.append(Stage(
+            "porechop", "Porechop", f"""
 mkdir -p "$OUTPUT_DIR/porechop"
-run_with_cancel "porechop -i '$CURRENT_FASTQ' -o '$OUTPUT_DIR/porechop/trimmed.fastq'"
-CURRENT_FASTQ="$OUTPUT_DIR/porechop/trimmed.fastq"
-"""
+run_step "porechop {threads_arg('porechop')} -i '$INPUT_FASTQ' -o '$OUTPUT_DIR/porechop/trimmed.fastq'"
+""",
+            threads=tool_threads("porechop", threads, limits), elastic=True,
+            tools=["porechop"], requires=[reads],
+            outputs=["porechop/trimmed.fastq"], inputs=raw
+        ))
+        reads = "$OUTPUT_DIR/porechop/trimmed.fastq"
+        reads_stage = ["porechop"]
 
     # ---------------- DEDUP + FILTLONG ----------------
     if "filtlong" in selected_tools:
-        script += """
-log "STEP: Deduplication (SRA-safe)"
+        stages.append(Stage(
+            "dedup", "Deduplication (SRA-safe)", f"""
 mkdir -p "$OUTPUT_DIR/dedup"
-
-if command -v seqkit &>/dev/null; then
-    run_with_cancel "seqkit rename '$CURRENT_FASTQ' -o '$OUTPUT_DIR/dedup/dedup.fastq'"
-    CURRENT_FASTQ="$OUTPUT_DIR/dedup/dedup.fastq"
-else
+if ! command -v seqkit &>/dev/null; then
     log "PIPELINE ABORTED: seqkit not found"
     exit 1
 fi
-
-log "STEP: Filtlong"
+run_step "seqkit rename '{reads}' -o '$OUTPUT_DIR/dedup/dedup.fastq'"
+""",
+            deps=reads_stage, tools=["seqkit"], requires=[reads],
+            outputs=["dedup/dedup.fastq"], inputs=reads_inputs()
+        ))
+        stages.append(Stage(
+            "filtlong", "Filtlong", """
 mkdir -p "$OUTPUT_DIR/filtlong"
-run_with_cancel "filtlong --min_length '$MIN_LENGTH' --keep_percent '$KEEP_PERCENT' \
-    '$CURRENT_FASTQ' > '$OUTPUT_DIR/filtlong/filtered.fastq'"
-
-CURRENT_FASTQ="$OUTPUT_DIR/filtlong/filtered.fastq"
-"""
+run_step "filtlong --min_length '$MIN_LENGTH' --keep_percent '$KEEP_PERCENT' \\
+    '$OUTPUT_DIR/dedup/dedup.fastq' > '$OUTPUT_DIR/filtlong/filtered.fastq'"
+""",
+            deps=["dedup"], tools=["filtlong"], requires=["$OUTPUT_DIR/dedup/dedup.fastq"],
+            outputs=["filtlong/filtered.fastq"],
+            params={"min_length": min_length, "keep_percent": keep_percent}
+        ))
+        reads = "$OUTPUT_DIR/filtlong/filtered.fastq"
+        reads_stage = ["filtlong"]
+
+    # ---------------- FASTQC (raw reads) ----------------
+    if "fastqc" in selected_tools:
+        stages.append(Stage(
+            "fastqc_raw", "FastQC (raw reads)", f"""
+mkdir -p "$OUTPUT_DIR/fastqc/raw"
+run_step "fastqc {threads_arg('fastqc')} '$INPUT_FASTQ' -o '$OUTPUT_DIR/fastqc/raw'"
+""",
+            threads=tool_threads("fastqc", threads, limits), elastic=True,
+            tools=["fastqc"], requires=["$INPUT_FASTQ"],
+            outputs=["fastqc/raw"], inputs=raw,
+            params={"input_name": os.path.basename(input_fastq)}
+        ))
 
     # ---------------- FLYE ----------------
+    assembly = ""
+    assembly_stage = []
     if "flye" in selected_tools:
-        script += """
-log "STEP: Flye"
+        flye_cmd = f"""flye --nano-raw '{reads}' \\
+    --out-dir '$OUTPUT_DIR/flye' \\
+    {threads_arg('flye')} \\
+    --genome-size '$GENOME_SIZE'"""
+        stages.append(Stage(
+            "flye", "Flye", f"""
 mkdir -p "$OUTPUT_DIR/flye"
-run_with_cancel "flye --nano-raw '$CURRENT_FASTQ' \
-    --out-dir '$OUTPUT_DIR/flye' \
-    --threads '$THREADS' \
-    --genome-size '$GENOME_SIZE'"
-
-CURRENT_FASTA="$OUTPUT_DIR/flye/assembly.fasta"
+run_step "{flye_cmd}"
+""",
+            deps=reads_stage, threads=tool_threads("flye", threads, limits), elastic=True,
+            tools=["flye"], requires=[reads],
+            outputs=["flye"], inputs=reads_inputs(),
+            params={"genome_size": genome_size},
+            # Flye keeps its own stage checkpoints in params.json
+            resume_body=f"""
+mkdir -p "$OUTPUT_DIR/flye"
+if [ -f "$OUTPUT_DIR/flye/params.json" ]; then
+    run_step "{flye_cmd} --resume"
+else
+    run_step "{flye_cmd}"
+fi
 """
+        ))
+        assembly = "$OUTPUT_DIR/flye/assembly.fasta"
+        assembly_stage = ["flye"]
 
     # ---------------- MINIMAP2 ----------------
+    paf = f"$OUTPUT_DIR/{paf_path}"
     if "minimap2" in selected_tools:
-        script += """
-log "STEP: Minimap2"
-mkdir -p "$OUTPUT_DIR/minimap2"
-run_with_cancel "minimap2 -t '$THREADS' -x map-ont \
-    '$CURRENT_FASTA' '$CURRENT_FASTQ' > '$OUTPUT_DIR/minimap2/reads.paf'"
-"""
+        stages.append(Stage(
+            "minimap2", "Minimap2", f"""
+mkdir -p "$OUTPUT_DIR/{os.path.dirname(paf_path)}"
+run_step "minimap2 {threads_arg('minimap2')} -x map-ont \\
+    '{assembly}' '{reads}' > '{paf}'"
+""",
+            deps=assembly_stage + reads_stage, threads=tool_threads("minimap2", threads, limits), elastic=True,
+            tools=["minimap2"], requires=[assembly, reads],
+            outputs=[paf_path], inputs=reads_inputs()
+        ))
 
     # ---------------- RACON ----------------
     if "racon" in selected_tools:
-        script += """
-log "STEP: Racon"
+        paf_stage = ["minimap2"] if "minimap2" in selected_tools else []
+        stages.append(Stage(
+            "racon", "Racon", f"""
 mkdir -p "$OUTPUT_DIR/racon"
-run_with_cancel "racon -t '$THREADS' \
-    '$CURRENT_FASTQ' \
-    '$OUTPUT_DIR/minimap2/reads.paf' \
-    '$CURRENT_FASTA' > '$OUTPUT_DIR/racon/polished.fasta'"
-
-CURRENT_FILE="$OUTPUT_DIR/racon/polished.fasta"
-"""
-
-    # ---------------- FASTQC ----------------
+run_step "racon {threads_arg('racon')} \\
+    '{reads}' \\
+    '{paf}' \\
+    '{assembly}' > '$OUTPUT_DIR/racon/polished.fasta'"
+""",
+            deps=paf_stage + assembly_stage + reads_stage, threads=tool_threads("racon", threads, limits), elastic=True,
+            tools=["racon"], requires=[paf, assembly],
+            outputs=["racon/polished.fasta"], inputs=reads_inputs()
+        ))
+        assembly = "$OUTPUT_DIR/racon/polished.fasta"
+        assembly_stage = ["racon"]
+
+    # ---------------- FASTQC (filtered reads) ----------------
     if "fastqc" in selected_tools:
-        script += """
-log "STEP: FastQC"
-mkdir -p "$OUTPUT_DIR/fastqc/raw" "$OUTPUT_DIR/fastqc/filtered"
-run_with_cancel "fastqc '$INPUT_FASTQ' -o '$OUTPUT_DIR/fastqc/raw'"
-run_with_cancel "fastqc '$CURRENT_FASTQ' -o '$OUTPUT_DIR/fastqc/filtered'"
-"""
+        stages.append(Stage(
+            "fastqc_filtered", "FastQC (filtered reads)", f"""
+mkdir -p "$OUTPUT_DIR/fastqc/filtered"
+run_step "fastqc {threads_arg('fastqc')} '{reads}' -o '$OUTPUT_DIR/fastqc/filtered'"
+""",
+            deps=reads_stage, threads=tool_threads("fastqc", threads, limits), elastic=True,
+            tools=["fastqc"], requires=[reads],
+            outputs=["fastqc/filtered"], inputs=reads_inputs(),
+            params={"input_name": os.path.basename(input_fastq) if not reads_stage else ""}
+        ))
 
     # ---------------- PROKKA ----------------
     if "prokka" in selected_tools:
-        script += """
-log "STEP: Prokka"
+        stages.append(Stage(
+            "prokka", "Prokka", f"""
 mkdir -p "$OUTPUT_DIR/prokka"
-run_with_cancel "prokka --outdir '$OUTPUT_DIR/prokka' \
-    --force \
-    --prefix genome '$CURRENT_FILE'"
-"""
+run_step "prokka --outdir '$OUTPUT_DIR/prokka' \\
+    {threads_arg('prokka')} \\
+    --force \\
+    --prefix genome '{assembly}'"
+""",
+            deps=assembly_stage, threads=tool_threads("prokka", threads, limits), elastic=True,
+            tools=["prokka"], requires=[assembly],
+            outputs=["prokka"]
+        ))
 
     # ---------------- QUAST ----------------
     if "quast" in selected_tools:
-        script += """
-log "STEP: QUAST"
+        stages.append(Stage(
+            "quast", "QUAST", f"""
 mkdir -p "$OUTPUT_DIR/quast"
-run_with_cancel "quast '$CURRENT_FILE' -o '$OUTPUT_DIR/quast'"
-"""
+run_step "quast {threads_arg('quast')} '{assembly}' -o '$OUTPUT_DIR/quast'"
+""",
+            deps=assembly_stage, threads=tool_threads("quast", threads, limits), elastic=True,
+            tools=["quast"], requires=[assembly],
+            outputs=["quast"]
+        ))
+
+    return stages
 
-    script += """
-touch "$OUTPUT_DIR/PIPELINE_DONE"
-log "PIPELINE FINISHED SUCCESSFULLY"
-"""
+
+# -------------------------------------------------
+# MAIN PIPELINE
+# -------------------------------------------------
+def run_pipeline_async(
+    input_fastq,
+    output_dir,
+    genome_size,
+    threads,
+    output_file,
+    min_length,
+    keep_percent,
+    selected_tools,
+    blast_db_path="",
+    lenient=False,
+    resume=False,
+    streaming=None,
+    allocation=None,
+    paf_path=PAF_PATH
+):
+    """Runs the selected tools as a stage graph. Returns the final run status.
+
+    With `lenient=True` stages whose tool or input is missing are logged as
+    skipped instead of failing the run (used by the full pipeline). With
+    `resume=True` stages with a valid checkpoint are skipped. `streaming`
+    defaults to the PIPELINE_STREAMING setting. With a core `allocation`
+    the tools get the granted core count instead of `threads`, which only
+    caps how many cores a single stage may use.
+    """
+    debug(f"Enabled tools: {selected_tools}")
+
+    if streaming is None:
+        streaming = STREAMING_ENABLED
 
     try:
-        run_script_in_wsl(script, output_file)
+        thread_budget = max(1, int(threads))
+    except (TypeError, ValueError):
+        thread_budget = 1
+    stage_threads = thread_budget
+    if allocation is not None:
+        thread_budget = allocation.threads
+    limits = tuned_limits()
+
+    try:
+        preamble = build_preamble(
+            shell_path(input_fastq, must_exist=True),
+            shell_path(output_dir, must_exist=True),
+            genome_size,
+            thread_budget,
+            min_length,
+            keep_percent,
+            shell_path(blast_db_path, must_exist=True) if blast_db_path else ""
+        )
+
+        scheduler = StageScheduler(
+            build_stages(selected_tools, stage_threads, input_fastq,
+                         genome_size, min_length, keep_percent, streaming,
+                         limits=limits, paf_path=paf_path),
+            preamble,
+            output_dir,
+            output_file,
+            thread_budget,
+            lenient=lenient,
+            env_script=CONDA_ACTIVATION,
+            resume=resume,
+            allocation=allocation
+        )
+        if not resume:
+            scheduler.log("Pipeline started")
+            scheduler.log(f"Input FASTQ: {input_fastq}")
+        if allocation is not None:
+            scheduler.log(f"Cores granted: {allocation.threads} of {stage_threads} requested (CPUs {allocation.cpus})")
+        if limits:
+            caps = ", ".join(f"{tool}={cap}" for tool, cap in sorted(limits.items()))
+            scheduler.log(f"Thread caps from past runs: {caps}")
+        return scheduler.run()
     except Exception as e:
         with open(output_file, "a", encoding="utf-8") as f:
             f.write(f"\n[INTERNAL ERROR] {str(e)}\n")
         print(f"Pipeline failed: {e}")
+        try:
+            run_state.finish_run(output_dir, "failed", error=str(e))
+        except OSError:
+            pass
+        return "failed"
@@ -0,0 +1,251 @@
+import re
+import time
+import datetime
+import statistics
+import threading
+
+from models import run_state
+from models.thread_tuning import tool_of, CACHE_SECONDS
+
+# How often a running stage's progress is written to state.json
+WRITE_SECONDS = 2.0
+# Stage length assumed when there is no history for it
+DEFAULT_STAGE_SECONDS = 300
+# Below this share done, a tool's own progress is too early to extrapolate
+MIN_FRACTION = 0.05
+FINISHED = ("completed", "cached", "skipped")
+
+# Per tool: lines that start a phase, with the share of the stage done when
+# it starts and ends, and counters giving progress within the current phase
+# (as "done / total", a percentage or a "[=====>    ]" bar).
+PHASES = {
+    "porechop": [
+        (r"^Loading reads", 0.0, 0.1),
+        (r"^Looking for known adapter sets", 0.1, 0.2),
+        (r"^Trimming adapters from read ends", 0.2, 0.6),
+        (r"^Splitting reads containing middle adapters", 0.6, 1.0),
+    ],
+    "flye": [
+        (r">>>STAGE: configure", 0.0, 0.02),
+        (r">>>STAGE: assembly|Assembling disjointigs", 0.02, 0.35),
+        (r">>>STAGE: consensus", 0.35, 0.5),
+        (r">>>STAGE: repeat", 0.5, 0.6),
+        (r">>>STAGE: contigger", 0.6, 0.7),
+        (r">>>STAGE: polishing|Polishing genome", 0.7, 0.98),
+        (r">>>STAGE: finalize", 0.98, 1.0),
+    ],
+    "filtlong": [
+        (r"^Scoring long reads", 0.0, 0.5),
+        (r"^Filtering long reads", 0.5, 0.6),
+        (r"^Outputting passed long reads", 0.6, 1.0),
+    ],
+    "racon": [
+        (r"\[racon::Polisher::initialize\] loaded", 0.0, 0.1),
+        (r"\[racon::Polisher::initialize\] aligning overlaps", 0.1, 0.5),
+        (r"\[racon::Polisher::polish\] generating consensus", 0.5, 1.0),
+    ],
+}
+COUNTERS = {
+    "porechop": [(r"([\d,]+)\s*/\s*([\d,]+)", "ratio")],
+    "racon": [(r"\[(=*)>?( *)\]", "bar")],
+    "fastqc": [(r"Approx (\d+)% complete", "percent")],
+}
+# Share of a stage that runs several tools in turn (streamed Porechop ->
+# Filtlong) taken by each of them; tools not listed weigh 1
+TOOL_WEIGHTS = {"porechop": 4}
+
+_lock = threading.Lock()
+_cache = {"at": 0.0, "durations": {}}
+
+
+def compile_rules():
+    phases = {tool: [(re.compile(p), lo, hi) for p, lo, hi in rules] for tool, rules in PHASES.items()}
+    counters = {tool: [(re.compile(p), kind) for p, kind in rules] for tool, rules in COUNTERS.items()}
+    return phases, counters
+
+
+PHASE_RULES, COUNTER_RULES = compile_rules()
+
+
+def stage_rules(tools):
+    """(phases, counters) for a stage running `tools` one after the other.
+
+    Each tool's phases are scaled into its share of the stage; its counters
+    carry that share as the span to use before any of its phases started.
+    """
+    weights = [TOOL_WEIGHTS.get(tool, 1) for tool in tools]
+    total = sum(weights)
+    phases, counters = [], []
+    start = 0.0
+    for tool, weight in zip(tools, weights):
+        lo_t, hi_t = start / total, (start + weight) / total
+        scale = hi_t - lo_t
+        phases += [(p, lo_t + scale * lo, lo_t + scale * hi) for p, lo, hi in PHASE_RULES.get(tool, ())]
+        counters += [(p, kind, (lo_t, hi_t)) for p, kind in COUNTER_RULES.get(tool, ())]
+        start += weight
+    return phases, counters
+
+
+def counter_fraction(match, kind):
+    """Share done from a counter match (None if it carries no information)."""
+    if kind == "percent":
+        return min(float(match.group(1)) / 100, 1.0)
+    if kind == "bar":
+        filled, empty = len(match.group(1)), len(match.group(2))
+        return filled / (filled + empty) if filled + empty else None
+    done, total = (int(g.replace(",", "")) for g in match.groups())
+    return min(done / total, 1.0) if total else None
+
+
+class ProgressTracker:
+    """Turns the tool output of a running pipeline into per-stage progress.
+
+    Fed every line (and progress-bar redraw) of a stage by the LogSink.
+    The share of each stage done only ever grows; it is written to the
+    stage's "progress" in state.json at most every WRITE_SECONDS.
+    `stage_tools` ({stage: [tools]}) names the tools a stage runs, e.g.
+    Porechop inside the streamed "filtlong" stage; otherwise the tool is
+    taken from the stage name.
+    """
+
+    def __init__(self, output_dir, stage_tools=None):
+        self.output_dir = output_dir
+        self.stage_tools = stage_tools or {}
+        self.rules = {}       # stage -> (phases, counters)
+        self.lock = threading.Lock()
+        self.spans = {}       # stage -> (start, end) of its current phase
+        self.fractions = {}   # stage -> share done
+        self.written = {}
+        self.written_at = 0.0
+
+    def fraction(self, stage, text):
+        """Share of `stage` done after it printed `text` (None if unknown)."""
+        if stage not in self.rules:
+            self.rules[stage] = stage_rules(self.stage_tools.get(stage) or [tool_of(stage)])
+        phases, counters = self.rules[stage]
+        fraction = self.fractions.get(stage)
+        for pattern, lo, hi in phases:
+            if pattern.search(text):
+                self.spans[stage] = (lo, hi)
+                fraction = max(fraction or 0.0, lo)
+                break
+        for pattern, kind, tool_span in counters:
+            match = pattern.search(text)
+            share = counter_fraction(match, kind) if match else None
+            if share is not None:
+                lo, hi = self.spans.get(stage, tool_span)
+                fraction = max(fraction or 0.0, lo + (hi - lo) * share)
+                break
+        return fraction
+
+    def observe(self, stage, text):
+        with self.lock:
+            fraction = self.fraction(stage, text)
+            if fraction is None:
+                return
+            self.fractions[stage] = fraction
+            if time.time() - self.written_at < WRITE_SECONDS:
+                return
+            changed = {s: round(f, 3) for s, f in self.fractions.items() if self.written.get(s) != round(f, 3)}
+            self.written_at = time.time()
+            self.written.update(changed)
+        if changed:
+            try:
+                run_state.set_progress(self.output_dir, changed)
+            except OSError as e:
+                print(f"[PROGRESS] Could not record progress for {self.output_dir}: {e}")
+
+
+def load_durations(limit=2000):
+    """Median wall time per stage name over recent completed stages."""
+    from models.db import get_db_connection
+
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT stage, wall_seconds FROM pipeline_stage_metrics "
+            "WHERE status = 'completed' AND wall_seconds IS NOT NULL ORDER BY id DESC LIMIT %s",
+            (limit,)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    samples = {}
+    for stage, wall in rows:
+        samples.setdefault(stage, []).append(wall)
+    return {stage: statistics.median(walls) for stage, walls in samples.items()}
+
+
+def stage_durations():
+    """{stage: typical seconds} from history (cached like the thread limits)."""
+    with _lock:
+        if time.time() - _cache["at"] < CACHE_SECONDS:
+            return _cache["durations"]
+    try:
+        durations = load_durations()
+    except Exception as e:
+        print(f"[PROGRESS] No stage history for estimates ({e})")
+        durations = {}
+    with _lock:
+        _cache.update(at=time.time(), durations=durations)
+    return durations
+
+
+def seconds_since(iso, now):
+    try:
+        return max(now - datetime.datetime.fromisoformat(iso).timestamp(), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def estimate(state, durations, now=None):
+    """{"percent", "eta_seconds", "stages"} for a run's state.json.
+
+    Each stage weighs what it usually takes (`durations`). A running stage
+    that reports its own progress is extrapolated from its rate so far;
+    otherwise its typical length is assumed. The ETA adds up what is left
+    of every stage, so it is an upper bound while stages overlap.
+    """
+    now = time.time() if now is None else now
+    total = done = remaining = 0.0
+    stages = {}
+    for name, entry in state.get("stages", {}).items():
+        expected = durations.get(name, DEFAULT_STAGE_SECONDS)
+        status = entry.get("status")
+        if status in FINISHED:
+            share, left = 1.0, 0.0
+        elif status == "running":
+            elapsed = seconds_since(entry.get("started_at"), now)
+            fraction = entry.get("progress")
+            if fraction is not None and fraction >= MIN_FRACTION:
+                left = elapsed * (1 - fraction) / fraction
+            else:
+                # Past its usual length: assume a tenth of it is left
+                left = max(expected - elapsed, expected * 0.1)
+            share = elapsed / (elapsed + left) if elapsed + left else 0.0
+        elif status == "pending":
+            share, left = 0.0, expected
+        else:
+            continue      # failed/cancelled stages do not count
+        total += expected
+        done += expected * share
+        remaining += left
+        stages[name] = round(share * 100, 1)
+
+    return {
+        "percent": round(done / total * 100, 1) if total else 0.0,
+        "eta_seconds": round(remaining),
+        "stages": stages,
+    }
+
+
+def run_progress(output_dir):
+    """Percent complete and ETA of a running run, or None if it is not running."""
+    state = run_state.load_state(output_dir)
+    if not state or state.get("status") != "running":
+        return None
+    return estimate(state, stage_durations())
@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+
+from models import run_state
+from models.db import get_db_connection
+from utils.run_paths import get_run_dir
+
+RECONCILE_SECONDS = float(os.environ.get("RECONCILE_SECONDS", 60))
+# A run row may exist briefly before its job is queued; leave it alone that long
+ORPHAN_GRACE_SECONDS = 300
+
+ORPHAN_ERROR = "The job running this run was lost (e.g. the server restarted)"
+
+# What a waiting run is called in pipeline_runs, by run_type
+QUEUED_STATUS = {"blast": "pending"}
+
+_started = False
+
+
+def active_runs(cursor):
+    """Runs the DB does not consider finished, with the state of their job."""
+    cursor.execute(
+        "SELECT r.run_id, r.user_email, r.status, r.run_type, j.state AS job_state, "
+        "r.start_time < NOW() - INTERVAL %s SECOND AS settled "
+        "FROM pipeline_runs r LEFT JOIN pipeline_jobs j ON j.run_id = r.run_id "
+        "WHERE r.status NOT IN ('completed', 'failed', 'cancelled')",
+        (ORPHAN_GRACE_SECONDS,)
+    )
+    return cursor.fetchall()
+
+
+def target_status(run, file_status):
+    """(new status, reason) for a run the DB shows as active, or None if it is right.
+
+    - the run directory reached a terminal state -> that state
+    - its job was put back in the queue (a restart) -> 'queued' ('pending'
+      for BLAST runs)
+    - no job will ever finish it (job done or missing) -> 'failed'
+    """
+    if file_status in run_state.TERMINAL_STATES:
+        return file_status, "finished on disk"
+    job_state = run["job_state"]
+    if job_state == "queued":
+        queued = QUEUED_STATUS.get(run["run_type"], "queued")
+        return (queued, "job re-queued") if run["status"] == "running" else None
+    if job_state == "running":
+        return None
+    if job_state == "done" or run["settled"]:
+        return "failed", "orphaned"
+    return None
+
+
+def reconcile_once():
+    """Brings pipeline_runs in line with the run directories and job queue.
+
+    Drift is written back in one transaction; every update is conditional
+    on the status that was read, so a run that changed meanwhile is left
+    for the next pass. Returns the number of runs updated.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    try:
+        cursor = conn.cursor(dictionary=True)
+        updates = []
+        for run in active_runs(cursor):
+            run_dir = get_run_dir(run["user_email"], run["run_id"])
+            log_name = "blast.log" if run["run_type"] == "blast" else "pipeline_output.log"
+            file_status = run_state.read_status(run_dir, log_name) if os.path.isdir(run_dir) else None
+            target = target_status(run, file_status)
+            if target is None:
+                continue
+            status, reason = target
+            updates.append((run, run_dir, status, reason, file_status))
+
+        if updates:
+            cursor.executemany(
+                "UPDATE pipeline_runs SET status = %s, "
+                "end_time = IF(%s, COALESCE(end_time, NOW()), NULL) "
+                "WHERE run_id = %s AND status = %s",
+                [(status, status in run_state.TERMINAL_STATES, run["run_id"], run["status"])
+                 for run, _, status, _, _ in updates]
+            )
+            conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+    for run, run_dir, status, reason, file_status in updates:
+        print(f"[RECONCILE] {run['run_id']}: {run['status']} -> {status} ({reason})")
+        if not os.path.isdir(run_dir):
+            continue
+        if reason == "orphaned" and file_status not in run_state.TERMINAL_STATES:
+            run_state.finish_run(run_dir, "failed", error=ORPHAN_ERROR)
+        elif reason == "job re-queued":
+            run_state.set_status(run_dir, "queued")
+    return len(updates)
+
+
+def run():
+    while True:
+        try:
+            reconcile_once()
+        except Exception as e:
+            print(f"[RECONCILE] Pass failed: {e}")
+        time.sleep(RECONCILE_SECONDS)
+
+
+def start():
+    """Starts the reconciler (once per process). Its first pass runs right away,
+    so runs orphaned by a restart are settled at startup."""
+    global _started
+    if _started:
+        return
+    _started = True
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,278 @@
+import os
+import json
+import zlib
+import queue
+import struct
+import shutil
+import hashlib
+import datetime
+import tempfile
+import threading
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from models import run_manifest, artifact_digests
+from utils.zip_stream import compression_for
+
+# Built archives live outside the run folders, so building one does not
+# change the run it was built from: <ARCHIVE_DIR>/<user>/<run_id>.zip
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "pipeline_archives")
+ARCHIVE_WORKERS = max(1, int(os.environ.get("ARCHIVE_WORKERS", min(4, os.cpu_count() or 1))))
+CHUNK_BYTES = 1024 * 1024
+# A run whose files keep changing while it is archived is left to streaming
+BUILD_ATTEMPTS = 3
+
+_pending = set()
+_queue = queue.Queue()
+_lock = threading.Lock()
+_started = False
+
+
+def archive_path(run_dir):
+    run_dir = os.path.normpath(run_dir)
+    user = os.path.basename(os.path.dirname(run_dir))
+    return os.path.join(ARCHIVE_DIR, user, os.path.basename(run_dir) + ".zip")
+
+
+def info_path(archive):
+    return os.path.splitext(archive)[0] + ".json"
+
+
+def members(run_dir):
+    """[(relative path, size, mtime)] of the files that go into a run's archive.
+
+    <run_id>.zip is the archive older versions kept in the run folder.
+    """
+    legacy = os.path.basename(os.path.normpath(run_dir)) + ".zip"
+    return [f for f in run_manifest.list_files(run_dir) if f[0] != legacy]
+
+
+def fingerprint(files):
+    listing = json.dumps(files, separators=(",", ":"))
+    return hashlib.sha256(listing.encode("utf-8")).hexdigest()
+
+
+def load_info(archive):
+    """What was recorded about a built archive ({} if nothing)."""
+    try:
+        with open(info_path(archive), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def ready_archive(run_dir):
+    """Path of the built archive if it matches the run's current files, else None."""
+    archive = archive_path(run_dir)
+    info = load_info(archive)
+    if not info or not os.path.isfile(archive):
+        return None
+    try:
+        return archive if info.get("fingerprint") == fingerprint(members(run_dir)) else None
+    except OSError:
+        return None
+
+
+def compress_member(path, part_path):
+    """(CRC, size, compressed size) of one file; runs in a worker process.
+
+    With a `part_path`, the file is raw-deflated into it; otherwise it is
+    stored and only its CRC is computed.
+    """
+    crc = size = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if part_path else None
+    out = open(part_path, "wb") if part_path else None
+    try:
+        with open(path, "rb") as src:
+            while True:
+                data = src.read(CHUNK_BYTES)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                if compressor:
+                    out.write(compressor.compress(data))
+        if compressor:
+            out.write(compressor.flush())
+            return crc, size, out.tell()
+        return crc, size, size
+    finally:
+        if out:
+            out.close()
+
+
+# ZIP records (APPNOTE.TXT 4.3), written here rather than through zipfile's
+# internals since the members arrive already compressed
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_NAMES = 0x800
+MADE_BY_UNIX = 3 << 8
+
+
+def dos_time(mtime):
+    t = datetime.datetime.fromtimestamp(mtime)
+    if t.year < 1980:
+        return 0, (1 << 5) | 1          # 1980-01-01 00:00
+    return (t.hour << 11) | (t.minute << 5) | (t.second // 2), ((t.year - 1980) << 9) | (t.month << 5) | t.day
+
+
+class ArchiveWriter:
+    """Writes a ZIP from members whose data is already in its final form
+    (stored, or raw-deflated by compress_member), switching to ZIP64
+    records where sizes, offsets or the entry count need it."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.entries = []
+
+    def add(self, name, data_path, method, crc, size, compressed, mtime, mode):
+        name = name.encode("utf-8")
+        offset = self.fp.tell()
+        zip64 = size >= ZIP64_LIMIT or compressed >= ZIP64_LIMIT
+        extra = struct.pack("<HHQQ", 1, 16, size, compressed) if zip64 else b""
+        time_, date = dos_time(mtime)
+        self.fp.write(LOCAL_HEADER.pack(
+            0x04034b50, 45 if zip64 else 20, UTF8_NAMES, method, time_, date, crc,
+            ZIP64_LIMIT if zip64 else compressed, ZIP64_LIMIT if zip64 else size,
+            len(name), len(extra)
+        ))
+        self.fp.write(name + extra)
+        # Exactly the bytes the header describes, even if the file grew since
+        left = compressed
+        with open(data_path, "rb") as src:
+            while left:
+                data = src.read(min(CHUNK_BYTES, left))
+                if not data:
+                    raise ValueError(f"{data_path} shrank while it was archived")
+                self.fp.write(data)
+                left -= len(data)
+        self.entries.append((name, method, crc, size, compressed, time_, date, mode, offset))
+
+    def close(self):
+        """Writes the central directory and end records."""
+        start = self.fp.tell()
+        for name, method, crc, size, compressed, time_, date, mode, offset in self.entries:
+            # ZIP64 extra: only the fields that overflow, in this order
+            wide = [v for v in (size, compressed, offset) if v >= ZIP64_LIMIT]
+            extra = struct.pack(f"<HH{len(wide)}Q", 1, 8 * len(wide), *wide) if wide else b""
+            self.fp.write(CENTRAL_HEADER.pack(
+                0x02014b50, MADE_BY_UNIX | 45, 45 if wide else 20, UTF8_NAMES, method, time_, date, crc,
+                min(compressed, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0,
+                (mode & 0xFFFF) << 16, min(offset, ZIP64_LIMIT)
+            ))
+            self.fp.write(name + extra)
+        end = self.fp.tell()
+        count, length = len(self.entries), end - start
+
+        if count >= 0xFFFF or length >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            self.fp.write(ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12, MADE_BY_UNIX | 45, 45,
+                                         0, 0, count, count, length, start))
+            self.fp.write(ZIP64_LOCATOR.pack(0x07064b50, 0, end, 1))
+        self.fp.write(END_RECORD.pack(0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                      min(length, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+
+def build_archive(run_dir):
+    """Builds a run's archive; returns False if its files changed meanwhile.
+
+    Members are compressed in parallel (ARCHIVE_WORKERS processes) into
+    part files, then stitched into one ZIP. Text artifacts are deflated and
+    everything else stored, as for a streamed download. The fingerprint of
+    the files it was built from is kept next to it.
+
+    The workers are spawned, not forked: this runs on a thread of the
+    multithreaded web server, and a forked child would inherit its locks.
+    """
+    files = members(run_dir)
+    archive = archive_path(run_dir)
+    os.makedirs(os.path.dirname(archive), exist_ok=True)
+    parts_dir = tempfile.mkdtemp(prefix=".parts_", dir=os.path.dirname(archive))
+    tmp = archive + ".tmp"
+    try:
+        try:
+            with ProcessPoolExecutor(max_workers=ARCHIVE_WORKERS,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                jobs = []
+                for number, (rel, _, _) in enumerate(files):
+                    path = os.path.join(run_dir, rel)
+                    deflate = compression_for(path) == zipfile.ZIP_DEFLATED
+                    part = os.path.join(parts_dir, str(number)) if deflate else None
+                    jobs.append((path, rel, part, pool.submit(compress_member, path, part)))
+
+                with open(tmp, "wb") as out:
+                    writer = ArchiveWriter(out)
+                    for path, rel, part, job in jobs:
+                        crc, size, compressed = job.result()
+                        st = os.stat(path)
+                        writer.add(rel.replace(os.sep, "/"), part or path,
+                                   zipfile.ZIP_DEFLATED if part else zipfile.ZIP_STORED,
+                                   crc, size, compressed, st.st_mtime, st.st_mode)
+                        if part:
+                            os.remove(part)
+                    writer.close()
+        except (FileNotFoundError, ValueError):
+            return False     # a member was deleted or shrank meanwhile
+
+        if members(run_dir) != files:
+            return False
+        os.replace(tmp, archive)
+        with open(info_path(archive), "w", encoding="utf-8") as f:
+            json.dump({
+                "fingerprint": fingerprint(files),
+                "files": len(files),
+                "blake2b": artifact_digests.file_digest(archive),
+                "built_at": datetime.datetime.now().isoformat(),
+            }, f)
+        return True
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def remove(run_dir):
+    """Deletes a run's archive (e.g. with the run)."""
+    archive = archive_path(run_dir)
+    for path in (archive, info_path(archive)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def builder():
+    while True:
+        run_dir = _queue.get()
+        with _lock:
+            _pending.discard(run_dir)
+        try:
+            for _ in range(BUILD_ATTEMPTS):
+                if not os.path.isdir(run_dir) or ready_archive(run_dir):
+                    break
+                if build_archive(run_dir):
+                    print(f"[ARCHIVE] Built {archive_path(run_dir)}")
+                    break
+            else:
+                print(f"[ARCHIVE] {run_dir} kept changing; downloads will be streamed")
+        except Exception as e:
+            print(f"[ARCHIVE] Could not archive {run_dir}: {e}")
+
+
+def schedule(run_dir):
+    """Queues a (re)build of a run's archive, e.g. when it reaches a terminal
+    state. Runs whose archive is being waited for are not queued twice."""
+    global _started
+    run_dir = os.path.normpath(run_dir)
+    with _lock:
+        if run_dir in _pending:
+            return
+        _pending.add(run_dir)
+        if not _started:
+            _started = True
+            threading.Thread(target=builder, daemon=True).start()
+    _queue.put(run_dir)
@@ -0,0 +1,88 @@
+import os
+import fnmatch
+
+from models import run_archive
+from utils.zip_stream import stream_zip
+from utils.tar_stream import stream_tar_gz
+
+# Reads are the bulk of a run and rarely wanted back
+READS = ["*.fastq", "*.fq", "*.fastq.gz", "*.fq.gz", "*.fast5", "*.pod5"]
+
+# Named subsets of a run: paths relative to the run folder, as glob patterns
+# ("*" also matches "/")
+PROFILES = {
+    "assembly": {
+        "label": "Assembly",
+        "include": ["racon/polished.fasta", "flye/assembly.fasta", "flye/assembly_info.txt",
+                    "flye/assembly_graph.gfa", "flye/assembly_graph.gv"],
+    },
+    "annotation": {
+        "label": "Annotation (Prokka)",
+        "include": ["prokka/*"],
+    },
+    "qc": {
+        "label": "Quality reports",
+        "include": ["fastqc/*", "quast/*"],
+    },
+    "no_reads": {
+        "label": "Everything except reads",
+        "include": ["*"],
+        "exclude": READS,
+    },
+}
+
+FORMATS = {
+    "zip": (stream_zip, "application/zip", ".zip"),
+    "tar.gz": (stream_tar_gz, "application/gzip", ".tar.gz"),
+}
+
+
+def matches(rel, patterns):
+    return any(fnmatch.fnmatchcase(rel, pattern) for pattern in patterns)
+
+
+def run_paths(run_dir):
+    """Relative paths (with "/") of every file a run can export."""
+    return [rel.replace(os.sep, "/") for rel, _, _ in run_archive.members(run_dir)]
+
+
+def profile_files(run_dir, profile):
+    """[(path, archive name)] of a run's files in a named profile.
+
+    Raises KeyError for an unknown profile.
+    """
+    rules = PROFILES[profile]
+    return [
+        (os.path.join(run_dir, rel), rel) for rel in run_paths(run_dir)
+        if matches(rel, rules["include"]) and not matches(rel, rules.get("exclude", ()))
+    ]
+
+
+def selected_files(run_dir, paths):
+    """[(path, archive name)] for a custom selection of files and folders.
+
+    Raises ValueError for a path outside the run.
+    """
+    base = os.path.realpath(run_dir)
+    selected = set()
+    for path in paths:
+        target = os.path.realpath(os.path.join(base, path))
+        if target != base and not target.startswith(base + os.sep):
+            raise ValueError(f"Path outside the run: {path}")
+        selected.add(os.path.relpath(target, base).replace(os.sep, "/"))
+
+    if "." in selected:
+        return [(os.path.join(run_dir, rel), rel) for rel in run_paths(run_dir)]
+    return [
+        (os.path.join(run_dir, rel), rel) for rel in run_paths(run_dir)
+        if rel in selected or any(rel.startswith(folder + "/") for folder in selected)
+    ]
+
+
+def export_stream(files, fmt):
+    """(chunk generator, mimetype, file extension) of an export.
+
+    Raises KeyError for an unknown format.
+    """
+    stream, mimetype, extension = FORMATS[fmt]
+    return stream(files), mimetype, extension
@@ -0,0 +1,173 @@
+import os
+import json
+import datetime
+import threading
+
+from models import run_state
+
+MANIFEST_FILE = "manifest.json"
+# Content digests of the run's files (models.artifact_digests)
+DIGESTS_FILE = "digests.json"
+# Per user, next to their run directories
+INDEX_FILE = ".runs_index.json"
+
+_lock = threading.Lock()
+
+
+def list_files(run_dir, prefix=""):
+    """[(relative path, size, mtime)] of every file under `run_dir`."""
+    files = []
+    with os.scandir(run_dir) as entries:
+        for entry in entries:
+            rel = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                files.extend(list_files(entry.path, rel + os.sep))
+            elif entry.is_file():
+                if not prefix and entry.name in (MANIFEST_FILE, DIGESTS_FILE):
+                    continue
+                if entry.name.endswith(".tmp"):
+                    continue
+                st = entry.stat()
+                files.append((rel, st.st_size, round(st.st_mtime, 3)))
+    return sorted(files)
+
+
+def iso(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def build_manifest(run_dir, run=None):
+    """The manifest of one run: its files plus status and timestamps.
+
+    `run` is the run's pipeline_runs row (None for runs that are only on
+    disk). A terminal state in the run directory wins over the row's status.
+    """
+    log_name = "blast.log" if run and run.get("run_type") == "blast" else "pipeline_output.log"
+    file_status = run_state.read_status(run_dir, log_name)
+    if file_status in run_state.TERMINAL_STATES:
+        status = file_status
+    elif run is not None:
+        status = run["status"]
+    else:
+        status = "legacy"
+
+    files = list_files(run_dir)
+    return {
+        "run_id": os.path.basename(run_dir),
+        "run_type": (run or {}).get("run_type") or "analysis",
+        "status": status,
+        "start_time": iso(run["start_time"]) if run else
+            datetime.datetime.fromtimestamp(os.stat(run_dir).st_ctime).isoformat(),
+        "end_time": iso(run["end_time"]) if run else None,
+        "files": [{"path": path, "size": size, "mtime": mtime} for path, size, mtime in files],
+        "total_bytes": sum(size for _, size, _ in files),
+        "updated_at": datetime.datetime.now().isoformat(),
+    }
+
+
+def refresh_run(run_dir, run=None):
+    """Rewrites a run's manifest.json. Returns its index entry."""
+    manifest = build_manifest(run_dir, run)
+    path = os.path.join(run_dir, MANIFEST_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+    return index_entry(manifest, os.stat(run_dir).st_mtime_ns)
+
+
+def index_entry(manifest, signature):
+    """What the runs page needs of a manifest, keyed to the directory's mtime."""
+    entry = {k: v for k, v in manifest.items() if k != "files"}
+    entry.update(file_count=len(manifest["files"]), signature=signature)
+    return entry
+
+
+def load_index(user_root):
+    try:
+        with open(os.path.join(user_root, INDEX_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_index(user_root, entries, keep=None):
+    """Stores `entries` in the user's index; with `keep`, drops runs not in it."""
+    with _lock:
+        index = load_index(user_root)
+        index.update(entries)
+        if keep is not None:
+            index = {run_id: entry for run_id, entry in index.items() if run_id in keep}
+
+        path = os.path.join(user_root, INDEX_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, path)
+    return index
+
+
+def write_manifest(run_dir, run=None):
+    """Refreshes a run's manifest and its entry in the user's index (e.g. when it finishes)."""
+    try:
+        entry = refresh_run(run_dir, run)
+        update_index(os.path.dirname(run_dir), {entry["run_id"]: entry})
+    except OSError as e:
+        print(f"[MANIFEST] Could not write the manifest of {run_dir}: {e}")
+
+
+def user_runs(user_root, load_rows):
+    """Index entries for every run directory of a user.
+
+    Only runs whose directory changed since they were indexed (or that are
+    new) are listed again; `load_rows(run_ids)` returns their
+    pipeline_runs rows as {run_id: row}. An unchanged user costs one
+    directory listing and one index read.
+    """
+    try:
+        with os.scandir(user_root) as entries:
+            dirs = {e.name: e.stat().st_mtime_ns for e in entries if e.is_dir()}
+    except OSError:
+        return {}
+
+    index = load_index(user_root)
+    stale = [run_id for run_id, mtime in dirs.items() if index.get(run_id, {}).get("signature") != mtime]
+    if not stale and set(index) == set(dirs):
+        return index
+
+    rows = load_rows(stale) if stale else {}
+    refreshed = {}
+    for run_id in stale:
+        try:
+            refreshed[run_id] = refresh_run(os.path.join(user_root, run_id), rows.get(run_id))
+        except OSError as e:
+            print(f"[MANIFEST] Skipping {run_id}: {e}")
+    return update_index(user_root, refreshed, keep=set(dirs))
+
+
+def list_dir(run_dir, rel_path=""):
+    """One directory of a run: [{"name", "type", "size", "mtime"}], folders first.
+
+    Raises ValueError for paths outside the run and OSError if it does not
+    exist.
+    """
+    base = os.path.realpath(run_dir)
+    target = os.path.realpath(os.path.join(base, rel_path))
+    if target != base and not target.startswith(base + os.sep):
+        raise ValueError(f"Path outside the run: {rel_path}")
+
+    listing = []
+    with os.scandir(target) as entries:
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                continue
+            is_dir = entry.is_dir()
+            st = entry.stat()
+            listing.append({
+                "name": entry.name,
+                "type": "dir" if is_dir else "file",
+                "size": None if is_dir else st.st_size,
+                "mtime": round(st.st_mtime, 3),
+            })
+    listing.sort(key=lambda e: (e["type"] != "dir", e["name"].lower()))
+    return listing
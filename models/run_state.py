@@ -0,0 +1,139 @@
+import os
+import json
+import datetime
+import threading
+
+STATE_FILE = "state.json"
+TERMINAL_STATES = ("completed", "failed", "cancelled")
+
+_lock = threading.Lock()
+
+
+def state_path(output_dir):
+    return os.path.join(output_dir, STATE_FILE)
+
+
+def now():
+    return datetime.datetime.now().isoformat()
+
+
+def load_state(output_dir):
+    """The run's state.json, or None for runs that predate it."""
+    try:
+        with open(state_path(output_dir), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def update_state(output_dir, change):
+    """Applies `change(state)` to state.json and replaces the file atomically."""
+    with _lock:
+        state = load_state(output_dir) or {"status": "queued", "current_stage": None, "stages": {}}
+        change(state)
+        state["updated_at"] = now()
+
+        path = state_path(output_dir)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, path)
+
+
+def set_status(output_dir, status):
+    update_state(output_dir, lambda state: state.update(status=status))
+
+
+def start_run(output_dir, stages, skipped=()):
+    """Marks the run as running with every stage pending.
+
+    `stages` are (name, title) pairs, or (name, title, tools) to record the
+    tools a stage runs when its name does not say (e.g. Porechop inside the
+    streamed "filtlong" stage). Stages in `skipped` (a resumed run's
+    checkpointed stages) keep what the previous attempt recorded.
+    """
+    def change(state):
+        previous = state.get("stages", {})
+        state["stages"] = {}
+        for name, title, *tools in stages:
+            entry = {"title": title, "status": "completed" if name in skipped else "pending"}
+            if tools and tools[0]:
+                entry["tools"] = list(tools[0])
+            state["stages"][name] = previous.get(name, entry) if name in skipped else entry
+        state.update(status="running", current_stage=None, started_at=now(),
+                     finished_at=None, failed_stage=None, exit_code=None, error=None)
+
+    update_state(output_dir, change)
+
+
+def set_stage(output_dir, name, status, exit_code=None):
+    """Records a stage starting ('running') or finishing with `status`."""
+    def change(state):
+        entry = state["stages"].setdefault(name, {"title": name})
+        entry["status"] = status
+        if status == "running":
+            entry.update(started_at=now(), finished_at=None, exit_code=None, progress=None)
+        else:
+            entry.update(finished_at=now(), exit_code=exit_code)
+
+        running = [n for n, s in state["stages"].items() if s["status"] == "running"]
+        if status == "running":
+            state["current_stage"] = name
+        elif state.get("current_stage") == name:
+            state["current_stage"] = running[-1] if running else None
+
+    update_state(output_dir, change)
+
+
+def set_progress(output_dir, fractions):
+    """Records {stage: share done} reported by running stages' tools."""
+    def change(state):
+        for name, fraction in fractions.items():
+            entry = state["stages"].get(name)
+            if entry is not None and entry.get("status") == "running":
+                entry["progress"] = fraction
+
+    update_state(output_dir, change)
+
+
+def finish_run(output_dir, status, failed_stage=None, exit_code=None, error=None):
+    def change(state):
+        state.update(status=status, current_stage=None, finished_at=now(),
+                     failed_stage=failed_stage, exit_code=exit_code, error=error)
+
+    update_state(output_dir, change)
+
+
+def read_status(output_dir, log_name="pipeline_output.log"):
+    """Run status from the files in its directory, or None if unknown.
+
+    state.json answers in O(1); a CANCEL request is reported as cancelled
+    before the engine has wound down. Runs without state.json (started
+    before it existed) fall back to the marker files and, last, a scan of
+    the log.
+    """
+    state = load_state(output_dir)
+    if state is not None and state.get("status") in TERMINAL_STATES:
+        return state["status"]
+    if os.path.exists(os.path.join(output_dir, "CANCEL")):
+        return "cancelled"
+    if state is not None:
+        return state.get("status")
+
+    if os.path.exists(os.path.join(output_dir, "PIPELINE_DONE")):
+        return "completed"
+    if os.path.exists(os.path.join(output_dir, "PIPELINE_ABORTED")):
+        return "failed"
+
+    log_path = os.path.join(output_dir, log_name)
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        content = f.read()
+    if "PIPELINE ABORTED BY USER" in content:
+        return "cancelled"
+    if "PIPELINE FINISHED" in content:
+        return "completed"
+    if "PIPELINE ABORTED" in content or "[INTERNAL ERROR]" in content:
+        return "failed"
+    return None
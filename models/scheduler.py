@@ -0,0 +1,452 @@
+import os
+import time
+import queue
+import threading
+import datetime
+
+from models import stage_cache
+from models import checkpoints
+from models import stage_metrics
+from models import run_state
+from models import artifact_digests
+from models.progress import ProgressTracker
+from utils.executor import (
+    spawn_script, wait_with_usage, terminate, discard_script, pin_process_group, PID_DIR
+)
+from utils.log_sink import LogSink
+
+
+# -------------------------------------------------
+# Stage definition
+# -------------------------------------------------
+class Stage:
+    """One pipeline step: a bash snippet plus the stages whose outputs it reads.
+
+    `threads` is the most cores the step can use. Elastic stages (tools that
+    take a thread flag) are started with whatever part of the run's budget is
+    free, as long as at least half of what they asked for is available; the
+    granted count is exposed to the snippet as $STAGE_THREADS.
+
+    `outputs` (paths relative to the run directory), `params` and `inputs`
+    (run files read directly, e.g. the uploaded FASTQ) feed the stage cache.
+    `resume_body`, if given, replaces `body` when a resumed run finds the
+    stage's partial outputs (e.g. `flye --resume`).
+    """
+
+    def __init__(self, name, title, body, deps=(), threads=1, elastic=False,
+                 tools=(), requires=(), outputs=(), params=None, inputs=(),
+                 cacheable=True, resume_body=None):
+        self.name = name
+        self.title = title
+        self.body = body
+        self.deps = list(deps)
+        self.threads = max(1, int(threads))
+        self.elastic = elastic
+        self.tools = list(tools)          # executables checked in lenient mode
+        self.requires = list(requires)    # input paths checked in lenient mode
+        self.outputs = list(outputs)
+        self.params = dict(params or {})
+        self.inputs = list(inputs)
+        self.cacheable = cacheable and bool(self.outputs)
+        self.resume_body = resume_body
+
+
+# -------------------------------------------------
+# DAG scheduler
+# -------------------------------------------------
+class StageScheduler:
+    """Runs stages as soon as their dependencies finish, within a thread budget.
+
+    Every stage is its own bash script (shared `preamble` + stage body). The
+    first failure stops new launches and terminates the stages still running,
+    mirroring the old `set -e` behaviour of the sequential script. A CANCEL
+    file in the run directory is polled twice a second; each running stage
+    records its process group under .pids/ so a cancel request can also
+    signal it directly (utils.executor.kill_run).
+
+    Cacheable stages are looked up in the stage cache first; on a hit their
+    outputs are linked in instead of recomputed. `env_script` is the shell
+    snippet (conda activation) used when probing tool versions for the key.
+
+    Every completed stage writes a checkpoint. With `resume=True` stages
+    whose checkpoint still matches their outputs are not run again. Each
+    stage's wall/CPU time, peak RSS and I/O go to the run's metrics.json,
+    and the run's progress (stage statuses, exit codes, final status) to
+    state.json.
+
+    With a core `allocation` the thread budget is the allocation's size and
+    every stage is pinned to its CPUs; when the allocation grows the budget
+    follows and running stages are re-pinned.
+    """
+
+    POLL_SECONDS = 0.5
+
+    def __init__(self, stages, preamble, output_dir, log_file, thread_budget,
+                 lenient=False, env_script="", use_cache=stage_cache.CACHE_ENABLED,
+                 resume=False, allocation=None):
+        self.stages = {s.name: s for s in stages}
+        self.order = [s.name for s in stages]
+        self.preamble = preamble
+        self.output_dir = output_dir
+        self.log_file = log_file
+        self.budget = max(1, int(thread_budget))
+        self.lenient = lenient
+        self.env_script = env_script
+        self.use_cache = use_cache
+        self.resume = resume
+        self.allocation = allocation
+        self.keys = {}        # stage name -> cache key (None = uncacheable)
+        self.processes = {}   # stage name -> Popen of the running stage
+        self.stopping = False
+        self.sink = None      # LogSink while the graph runs
+
+        for stage in stages:
+            missing = [d for d in stage.deps if d not in self.stages]
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stages {missing}")
+
+        if allocation is not None:
+            self.budget = allocation.threads
+            allocation.subscribe(self.on_allocation_change)
+
+    # -------------------------------------------------
+    # Logging / markers
+    # -------------------------------------------------
+    def log(self, msg):
+        line = f"[PIPELINE {datetime.datetime.now().strftime('%H:%M:%S')}] {msg}"
+        if self.sink is not None:
+            self.sink.write_line(line)
+            return
+        with open(self.log_file, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def touch(self, name):
+        with open(os.path.join(self.output_dir, name), "a"):
+            pass
+
+    def cancel_requested(self):
+        return os.path.exists(os.path.join(self.output_dir, "CANCEL"))
+
+    def log_cancel(self):
+        """Logs a cancel request, with the reason left in CANCEL unless it is
+        a plain user cancel (e.g. the error monitor's fatal match)."""
+        try:
+            with open(os.path.join(self.output_dir, "CANCEL"), "r", encoding="utf-8") as f:
+                reason = f.read().strip()
+        except OSError:
+            reason = ""
+        if reason and reason != "PIPELINE ABORTED BY USER":
+            self.log(reason)
+        self.log("CANCEL REQUESTED — stopping running stages")
+
+    # -------------------------------------------------
+    # Script generation
+    # -------------------------------------------------
+    def script_for(self, stage, threads, body=None):
+        script = self.preamble + f'\nSTAGE_THREADS="{threads}"\n'
+
+        if self.lenient:
+            checks = [f"command -v {tool} &>/dev/null" for tool in stage.tools]
+            checks += [f'[ -f "{path}" ]' for path in stage.requires]
+            if checks:
+                script += f"""
+if ! {{ {" && ".join(checks)}; }}; then
+    log "{stage.title} skipped"
+    exit 0
+fi
+"""
+
+        script += f'\nlog "STEP: {stage.title}"\n'
+        script += body if body is not None else stage.body
+        script += f'\nlog "{stage.title} finished"\n'
+        return script
+
+    # -------------------------------------------------
+    # Admission
+    # -------------------------------------------------
+    def grant(self, stage, free, anything_running):
+        """Returns the thread count to start `stage` with, or 0 to keep waiting."""
+        wanted = min(stage.threads, self.budget)
+        if not anything_running:
+            return wanted
+        if stage.elastic:
+            floor = max(1, wanted // 2)
+            return min(wanted, free) if free >= floor else 0
+        return wanted if wanted <= free else 0
+
+    # -------------------------------------------------
+    # Execution
+    # -------------------------------------------------
+    def cache_key(self, stage):
+        if not (self.use_cache and stage.cacheable):
+            return None
+        try:
+            versions = stage_cache.tool_versions(stage.tools, self.env_script)
+            return stage_cache.stage_key(stage, [self.keys.get(d) for d in stage.deps], versions)
+        except Exception as e:
+            self.log(f"{stage.title}: cache key unavailable ({e})")
+            return None
+
+    def record_metrics(self, stage, status, threads, started_at, exit_code=None, usage=None):
+        try:
+            stage_metrics.record_stage(
+                self.output_dir, stage.name,
+                stage_metrics.stage_entry(stage.title, status, threads, started_at, exit_code, usage,
+                                          tool=stage.tools[0] if stage.tools else None)
+            )
+        except OSError as e:
+            self.log(f"{stage.title}: could not record metrics ({e})")
+
+    def record_state(self, update, *args, **kwargs):
+        try:
+            update(self.output_dir, *args, **kwargs)
+        except OSError as e:
+            self.log(f"Could not update {run_state.STATE_FILE} ({e})")
+
+    def stage_status(self, stage, status, exit_code=None):
+        """Records a stage's status in state.json and the log's event stream.
+
+        The outputs of a finished stage are hashed in the background.
+        """
+        self.record_state(run_state.set_stage, stage.name, status, exit_code)
+        if self.sink is not None:
+            self.sink.event("stage", stage=stage.name, status=status, exit_code=exit_code)
+        if status in ("completed", "cached") and stage.outputs:
+            artifact_digests.schedule(self.output_dir, stage.outputs)
+
+    def execute(self, stage, threads):
+        """Runs one stage (or restores it from the cache). Returns its exit code."""
+        started_at = time.time()
+        self.stage_status(stage, "running")
+        key = self.cache_key(stage)
+        self.keys[stage.name] = key
+
+        owner = False
+        restorable = True      # until a restore fails (e.g. evicted meanwhile)
+        while key is not None and not self.stopping:
+            if restorable and stage_cache.lookup(key):
+                restorable = stage_cache.restore(key, stage, self.output_dir)
+                if restorable:
+                    checkpoints.write_checkpoint(self.output_dir, stage, key)
+                    self.log(f"{stage.title} restored from cache ({key[:12]})")
+                    self.record_metrics(stage, "cached", threads, started_at, 0,
+                                        {"wall_seconds": round(time.time() - started_at, 3)})
+                    self.stage_status(stage, "cached", 0)
+                    return 0
+            owner, event = stage_cache.claim(key)
+            if owner and restorable and stage_cache.lookup(key):
+                # Stored by the previous owner just before we claimed it
+                stage_cache.release(key)
+                owner = False
+                continue
+            if owner:
+                break
+            self.log(f"{stage.title}: identical stage already running, waiting for its result")
+            while not event.wait(self.POLL_SECONDS) and not self.stopping:
+                pass
+
+        if self.stopping:
+            self.stage_status(stage, "cancelled")
+            return -1
+
+        body = None
+        if self.resume and stage.resume_body and checkpoints.outputs_present(self.output_dir, stage):
+            body = stage.resume_body
+            self.log(f"{stage.title}: continuing from partial output")
+
+        try:
+            checkpoints.clear_checkpoint(self.output_dir, stage.name)
+            if body is None:
+                stage_cache.clear_outputs(stage, self.output_dir)
+            # Each stage writes to its own pipe, so lines of parallel stages
+            # never interleave and progress updates are tagged with the stage
+            stream = self.sink.stream(stage.name)
+            try:
+                process = spawn_script(
+                    self.script_for(stage, threads, body), stream, self.cpus(),
+                    pid_file=os.path.join(self.output_dir, PID_DIR, f"{stage.name}.pid")
+                )
+                self.processes[stage.name] = process
+                if self.stopping:
+                    terminate(process)
+                code, usage = wait_with_usage(process)
+                discard_script(process)
+            finally:
+                stream.close()
+            if code == 0:
+                produced = checkpoints.outputs_present(self.output_dir, stage)
+                status = "completed" if produced else "skipped"
+            else:
+                status = "cancelled" if self.stopping else "failed"
+            self.record_metrics(stage, status, threads, started_at, code, usage)
+            self.stage_status(stage, status, code)
+            if code == 0:
+                checkpoints.write_checkpoint(self.output_dir, stage, key)
+            if code == 0 and owner and stage_cache.store(key, stage, self.output_dir):
+                self.log(f"{stage.title} result cached ({key[:12]})")
+            return code
+        finally:
+            self.processes.pop(stage.name, None)
+            if owner:
+                stage_cache.release(key)
+
+    def launch(self, stage, threads, events):
+        def worker():
+            try:
+                code = self.execute(stage, threads)
+            except Exception as e:
+                self.log(f"{stage.title}: internal error ({e})")
+                self.stage_status(stage, "failed")
+                code = -1
+            events.put((stage.name, code))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    # -------------------------------------------------
+    # Core allocation
+    # -------------------------------------------------
+    def cpus(self):
+        return list(self.allocation.cpus) if self.allocation is not None else None
+
+    def on_allocation_change(self, allocation):
+        """Called by the core allocator when cores freed elsewhere are added."""
+        self.budget = allocation.threads
+        self.log(f"Core allocation grown to {allocation.threads} (CPUs {allocation.cpus})")
+        for process in list(self.processes.values()):
+            pin_process_group(process.pid, allocation.cpus)
+
+    def stop_running(self):
+        self.stopping = True
+        for process in list(self.processes.values()):
+            terminate(process)
+
+    # -------------------------------------------------
+    # Resume
+    # -------------------------------------------------
+    def verified_stages(self):
+        """Stages a resumed run can skip.
+
+        A stage is skipped when its checkpoint still matches its outputs, or
+        when everything that reads its outputs is itself skipped (e.g. an
+        intermediate file removed after its consumer finished).
+        """
+        verified = {}
+        for name in self.order:
+            checkpoint = checkpoints.verify_checkpoint(self.output_dir, self.stages[name])
+            if checkpoint:
+                verified[name] = checkpoint
+
+        dependents = {name: [] for name in self.order}
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                dependents[dep].append(stage.name)
+
+        to_run = set()
+        for name in reversed(self.order):
+            if name in verified:
+                continue
+            if not dependents[name] or any(d in to_run for d in dependents[name]):
+                to_run.add(name)
+
+        for name in self.order:
+            if name not in to_run:
+                self.keys[name] = verified.get(name, {}).get("key")
+        return [name for name in self.order if name not in to_run]
+
+    # -------------------------------------------------
+    # Main loop
+    # -------------------------------------------------
+    def run(self):
+        """Runs the graph. Returns 'completed', 'failed' or 'cancelled'."""
+        tracker = ProgressTracker(self.output_dir, {n: s.tools for n, s in self.stages.items()})
+        self.sink = LogSink(self.log_file, observer=tracker.observe)
+        try:
+            return self.schedule()
+        finally:
+            sink, self.sink = self.sink, None
+            sink.close()
+
+    def schedule(self):
+        done = set()
+        if self.resume:
+            # Stale markers were cleared by resume_run; a CANCEL here is new
+            done.update(self.verified_stages())
+            skipped = ", ".join(self.stages[n].title for n in self.order if n in done)
+            self.log(f"PIPELINE RESUMED (skipping completed stages: {skipped or 'none'})")
+        self.record_state(run_state.start_run, [(n, self.stages[n].title, self.stages[n].tools) for n in self.order], done)
+        running = {}   # name -> threads granted
+        events = queue.Queue()
+        failed = None
+        failed_code = None
+        # Cancelled between being dispatched and starting
+        cancelled = self.cancel_requested()
+        if cancelled:
+            self.log_cancel()
+
+        if self.use_cache and not cancelled:
+            # One probe for every tool in the graph instead of one per stage.
+            try:
+                stage_cache.tool_versions(
+                    sorted({t for s in self.stages.values() if s.cacheable for t in s.tools}),
+                    self.env_script
+                )
+            except Exception as e:
+                self.log(f"Tool version probe failed ({e})")
+
+        while True:
+            if failed is None and not cancelled:
+                free = self.budget - sum(running.values())
+                for name in self.order:
+                    if name in done or name in running:
+                        continue
+                    stage = self.stages[name]
+                    if any(d not in done for d in stage.deps):
+                        continue
+                    threads = self.grant(stage, free, bool(running))
+                    if not threads:
+                        continue
+                    self.launch(stage, threads, events)
+                    running[name] = threads
+                    free -= threads
+
+            if not running:
+                break
+
+            try:
+                name, code = events.get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                if not cancelled and self.cancel_requested():
+                    cancelled = True
+                    self.log_cancel()
+                    self.stop_running()
+                continue
+
+            running.pop(name)
+
+            if code == 0:
+                done.add(name)
+            elif not cancelled and self.cancel_requested():
+                # Stage was killed by a cancel request (kill_run)
+                cancelled = True
+                self.log_cancel()
+                self.stop_running()
+            elif failed is None and not cancelled:
+                failed, failed_code = name, code
+                self.log(f"PIPELINE ABORTED ({self.stages[name].title} exit code {code})")
+                self.stop_running()
+
+        if cancelled:
+            self.log("PIPELINE CANCELLED BY USER")
+            self.touch("PIPELINE_ABORTED")
+            self.record_state(run_state.finish_run, "cancelled")
+            return "cancelled"
+        if failed is not None:
+            self.touch("PIPELINE_ABORTED")
+            self.record_state(run_state.finish_run, "failed", failed, failed_code,
+                              f"{self.stages[failed].title} exit code {failed_code}")
+            return "failed"
+
+        self.touch("PIPELINE_DONE")
+        self.record_state(run_state.finish_run, "completed")
+        self.log("PIPELINE FINISHED SUCCESSFULLY")
+        return "completed"
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# How long a user's session token is trusted without asking the DB again.
+# Changes made through this app invalidate it at once; the TTL only bounds
+# what is missed by other processes on an unshared backend.
+SESSION_CACHE_SECONDS = float(os.environ.get("SESSION_CACHE_SECONDS", 10))
+# "memory" (this process), "file:<directory>" (processes on one host) or
+# "redis://host:port/db" (needs the redis package)
+SESSION_CACHE_BACKEND = os.environ.get("SESSION_CACHE_BACKEND", "memory")
+
+_backend = None
+_lock = threading.Lock()
+_invalidated = {}       # key -> when this process last invalidated it
+# Longer than any load could take (a DB checkout waits at most DB_POOL_TIMEOUT)
+INVALIDATION_MEMORY_SECONDS = 60
+
+
+class MemoryBackend:
+    """Entries in this process only."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}      # key -> (expires at, value)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class FileBackend:
+    """One small file per key in a directory every worker process can reach."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry["value"] if entry.get("expires", 0) >= time.time() else None
+
+    def set(self, key, value, ttl):
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"expires": time.time() + ttl, "value": value}, f)
+        os.replace(tmp, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class RedisBackend:
+    """Entries in Redis, shared by every process that points at it."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_CACHE_BACKEND is a Redis URL but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def make_backend(spec):
+    if spec == "memory":
+        return MemoryBackend()
+    if spec.startswith("file:"):
+        return FileBackend(spec[len("file:"):])
+    if spec.startswith(("redis://", "rediss://")):
+        return RedisBackend(spec)
+    raise ValueError(f"Unknown SESSION_CACHE_BACKEND: {spec}")
+
+
+def get_backend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = make_backend(SESSION_CACHE_BACKEND)
+        return _backend
+
+
+def set_backend(backend):
+    """Replaces the backend (anything with get/set/delete, like MemoryBackend)."""
+    global _backend
+    with _lock:
+        _backend = backend
+
+
+def cache_key(email):
+    return f"session_token:{email.lower()}"
+
+
+def lookup(email, loader):
+    """(user exists, session token) for `email`, from the cache or `loader()`.
+
+    `loader` returns the same pair, or None if it could not tell (e.g. the
+    DB is down), which is not cached. A value loaded while the user's entry
+    was being invalidated is not cached either.
+    """
+    key = cache_key(email)
+    try:
+        cached = get_backend().get(key)
+    except Exception as e:
+        print(f"[SESSION CACHE] Lookup failed: {e}")
+        cached = None
+    if cached is not None:
+        exists, token = json.loads(cached)
+        return exists, token
+
+    started = time.time()
+    value = loader()
+    if value is None:
+        return None
+    with _lock:
+        stale = _invalidated.get(key, 0) >= started
+    if not stale:
+        try:
+            get_backend().set(key, json.dumps(list(value)), SESSION_CACHE_SECONDS)
+        except Exception as e:
+            print(f"[SESSION CACHE] Store failed: {e}")
+    return value
+
+
+def invalidate(email):
+    """Drops a user's cached token (after a new login or when the user is deleted)."""
+    key = cache_key(email)
+    now = time.time()
+    with _lock:
+        for other, at in list(_invalidated.items()):
+            if at < now - INVALIDATION_MEMORY_SECONDS:
+                del _invalidated[other]
+        _invalidated[key] = now
+    try:
+        get_backend().delete(key)
+    except Exception as e:
+        print(f"[SESSION CACHE] Invalidate failed: {e}")
@@ -0,0 +1,364 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import datetime
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:      # Windows: stages are only coalesced within one process
+    fcntl = None
+
+from utils.executor import capture_script
+
+CACHE_DIR = os.environ.get("STAGE_CACHE_DIR", os.path.join("pipeline_runs", "cache"))
+CACHE_ENABLED = os.environ.get("STAGE_CACHE", "1") not in ("0", "false", "no")
+# Disk the cache may hold on its own (files no run links to any more);
+# least recently used entries are evicted past it
+CACHE_MAX_BYTES = int(float(os.environ.get("STAGE_CACHE_MAX_GB", 50)) * 1024 ** 3)
+LOCK_DIR = ".locks"
+# Unfinished stores older than this are from a crashed process
+STALE_TMP_SECONDS = 24 * 3600
+CHUNK_BYTES = 1024 * 1024
+
+_lock = threading.Lock()
+_inflight = {}        # key -> threading.Event set when the owner finishes
+_lock_files = {}      # key -> open lock file held by this process
+_versions = {}        # tool -> version string (per process)
+_digests = {}         # (dev, inode, size, mtime_ns) -> sha256
+
+
+# -------------------------------------------------
+# Hashing helpers
+# -------------------------------------------------
+def memo_key(st):
+    # Not the path: uploads get a fresh one every time, hard links share one file
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def file_digest(path):
+    """sha256 of a file's content, memoised on (device, inode, size, mtime)."""
+    st = os.stat(path)
+    if memo_key(st) in _digests:
+        return _digests[memo_key(st)]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _digests[memo_key(os.stat(path))] = digest
+    return digest
+
+
+def save_upload(stream, path):
+    """Writes an uploaded file to `path`, hashing it on the way, so its
+    first stage does not have to read it again. Returns the sha256."""
+    h = hashlib.sha256()
+    with open(path, "wb") as f:
+        for chunk in iter(lambda: stream.read(CHUNK_BYTES), b""):
+            h.update(chunk)
+            f.write(chunk)
+    digest = h.hexdigest()
+    _digests[memo_key(os.stat(path))] = digest
+    return digest
+
+
+def tool_versions(tools, env_script=""):
+    """Returns {tool: version} using `<tool> --version`, probing each tool once."""
+    with _lock:
+        missing = [t for t in tools if t not in _versions]
+    if missing:
+        script = "#!/usr/bin/env bash\n" + env_script + "\n"
+        for tool in missing:
+            script += f'echo "{tool}=$({tool} --version 2>&1 | head -n 1)"\n'
+        _, output = capture_script(script)
+
+        found = {}
+        for line in output.splitlines():
+            name, sep, version = line.partition("=")
+            if sep and name in missing:
+                found[name] = version.strip()
+        with _lock:
+            for tool in missing:
+                _versions[tool] = found.get(tool, "unknown")
+    return {t: _versions[t] for t in tools}
+
+
+def stage_key(stage, dep_keys, versions):
+    """Content address of a stage result.
+
+    Built from the stage's command text and parameters, the versions of the
+    tools it calls, the content hash of any run inputs it reads directly, and
+    the keys of the stages it depends on (so upstream outputs never have to
+    be re-hashed). Returns None when a dependency is not cacheable.
+    """
+    if any(k is None for k in dep_keys):
+        return None
+
+    payload = {
+        "stage": stage.name,
+        "body": stage.body,
+        "params": stage.params,
+        "versions": versions,
+        "inputs": [file_digest(p) for p in stage.inputs],
+        "deps": dep_keys,
+    }
+    blob = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+# -------------------------------------------------
+# Store / restore
+# -------------------------------------------------
+def _link_tree(src, dst):
+    """Hard-links file or directory `src` to `dst`, copying across devices."""
+    if os.path.isdir(src):
+        for root, _, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            target_root = os.path.normpath(os.path.join(dst, rel))
+            os.makedirs(target_root, exist_ok=True)
+            for name in files:
+                _link_tree(os.path.join(root, name), os.path.join(target_root, name))
+        return
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def entry_dir(key):
+    return os.path.join(CACHE_DIR, key)
+
+
+def lookup(key):
+    return key is not None and os.path.exists(os.path.join(entry_dir(key), "meta.json"))
+
+
+def restore(key, stage, output_dir):
+    """Links a cached stage result into `output_dir`. Returns False if the
+    entry went away meanwhile (evicted), so the stage has to run."""
+    base = entry_dir(key)
+    try:
+        for rel in stage.outputs:
+            src = os.path.join(base, rel)
+            if os.path.lexists(src):
+                _link_tree(src, os.path.join(output_dir, rel))
+        # Its mtime is the entry's last use, for eviction
+        os.utime(os.path.join(base, "meta.json"))
+        return True
+    except OSError as e:
+        print(f"[CACHE] Could not restore {stage.name} ({key[:12]}): {e}")
+        clear_outputs(stage, output_dir)
+        return False
+
+
+def store(key, stage, output_dir):
+    """Publishes a finished stage's outputs under its key (atomic rename)."""
+    if key is None or lookup(key):
+        return False
+
+    outputs = [rel for rel in stage.outputs if os.path.exists(os.path.join(output_dir, rel))]
+    if len(outputs) != len(stage.outputs):
+        # Skipped (lenient) or partial stage: nothing trustworthy to cache.
+        return False
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = os.path.join(CACHE_DIR, f".{key}.{uuid.uuid4().hex}.tmp")
+    try:
+        for rel in outputs:
+            _link_tree(os.path.join(output_dir, rel), os.path.join(tmp, rel))
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "stage": stage.name,
+                "outputs": outputs,
+                "created": datetime.datetime.now().isoformat(),
+            }, f)
+        os.rename(tmp, entry_dir(key))
+    except OSError as e:
+        print(f"[CACHE] Could not store {stage.name} ({key[:12]}): {e}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
+    prune()
+    return True
+
+
+def clear_outputs(stage, output_dir):
+    """Unlinks stale outputs before a stage recomputes them.
+
+    Outputs restored from the cache are hard links; truncating them in place
+    (e.g. `> file` redirects) would corrupt the cache entry.
+    """
+    for rel in stage.outputs:
+        path = os.path.join(output_dir, rel)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+
+# -------------------------------------------------
+# Eviction
+# -------------------------------------------------
+def entry_usage(path):
+    """(bytes only the cache holds, last use) of an entry directory.
+
+    Files still hard-linked from a run cost nothing extra, so only outputs
+    with a single link count.
+    """
+    own = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if root == path and name == "meta.json":
+                continue
+            st = os.stat(os.path.join(root, name))
+            if st.st_nlink == 1:
+                own += st.st_size
+    return own, os.stat(os.path.join(path, "meta.json")).st_mtime
+
+
+def evict(key):
+    """Removes one entry: renamed away first, so it is never seen half deleted."""
+    doomed = os.path.join(CACHE_DIR, f".{key}.{uuid.uuid4().hex}.evicted")
+    try:
+        os.rename(entry_dir(key), doomed)
+    except OSError:
+        return False
+    shutil.rmtree(doomed, ignore_errors=True)
+    try:
+        os.remove(os.path.join(CACHE_DIR, LOCK_DIR, key))
+    except OSError:
+        pass
+    return True
+
+
+def prune(max_bytes=None):
+    """Evicts least recently used entries until the disk held by the cache
+    alone is within `max_bytes` (default CACHE_MAX_BYTES), and removes
+    leftovers of stores that never finished. Entries being computed are
+    kept. Returns the number of entries evicted."""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return 0
+
+    entries = []
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        if name.startswith("."):
+            try:
+                if name.endswith((".tmp", ".evicted")) and os.stat(path).st_mtime < time.time() - STALE_TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+            continue
+        try:
+            entries.append((name,) + entry_usage(path))
+        except OSError:
+            continue      # being stored or evicted
+
+    total = sum(own for _, own, _ in entries)
+    evicted = 0
+    for key, own, _ in sorted(entries, key=lambda e: e[2]):
+        if total <= max_bytes:
+            break
+        with _lock:
+            busy = key in _inflight
+        if own and not busy and evict(key):
+            total -= own
+            evicted += 1
+    if evicted:
+        print(f"[CACHE] Evicted {evicted} entries; {total / 1024 ** 3:.1f} GB held by the cache")
+    return evicted
+
+
+def prune_later():
+    """Prunes in the background, e.g. once a run's links to its entries are gone."""
+    threading.Thread(target=prune, daemon=True).start()
+
+
+# -------------------------------------------------
+# In-flight coalescing
+# -------------------------------------------------
+class LockWaiter:
+    """Stands in for the in-process event while another process computes a key."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        handle = lock_file(self.key)
+        if handle is None:
+            return False
+        unlock_file(handle)
+        return True
+
+
+def lock_file(key):
+    """Takes the key's lock file under CACHE_DIR without blocking.
+
+    Returns the open file, or None if another process holds it. Without
+    fcntl (Windows) there is no cross-process lock: returns False.
+    """
+    if fcntl is None:
+        return False
+    lock_dir = os.path.join(CACHE_DIR, LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    handle = open(os.path.join(lock_dir, key), "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return handle
+    except OSError:
+        handle.close()
+        return None
+
+
+def unlock_file(handle):
+    if handle:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+
+def claim(key):
+    """Returns (True, None) if the caller should compute `key`, else
+    (False, waiter) where `waiter.wait(timeout)` turns true once the
+    current owner finishes.
+
+    Threads of one process wait on an event; other processes sharing
+    CACHE_DIR are kept out by a lock file (POSIX only: on Windows two
+    processes may still compute the same stage at once).
+    """
+    with _lock:
+        event = _inflight.get(key)
+        if event is not None:
+            return False, event
+        _inflight[key] = threading.Event()
+    try:
+        handle = lock_file(key)
+    except OSError as e:
+        print(f"[CACHE] Could not lock {key[:12]}: {e}")
+        handle = False
+    if handle is None:
+        release(key)
+        return False, LockWaiter(key)
+    with _lock:
+        _lock_files[key] = handle
+    return True, None
+
+
+def release(key):
+    with _lock:
+        event = _inflight.pop(key, None)
+        handle = _lock_files.pop(key, None)
+    unlock_file(handle)
+    if event:
+        event.set()
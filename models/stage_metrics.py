@@ -0,0 +1,59 @@
+import os
+import json
+import datetime
+import threading
+
+METRICS_FILE = "metrics.json"
+
+_lock = threading.Lock()
+
+
+def metrics_path(output_dir):
+    return os.path.join(output_dir, METRICS_FILE)
+
+
+def load_metrics(output_dir):
+    """Returns {"stages": {name: entry}} for a run (empty if not measured yet)."""
+    try:
+        with open(metrics_path(output_dir), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data.setdefault("stages", {})
+    return data
+
+
+def record_stage(output_dir, name, entry):
+    """Adds or replaces one stage's measurements in the run's metrics.json.
+
+    A resumed run keeps the entries of the stages it skipped.
+    """
+    with _lock:
+        data = load_metrics(output_dir)
+        data["stages"][name] = entry
+        data["updated_at"] = datetime.datetime.now().isoformat()
+
+        path = metrics_path(output_dir)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+
+
+def stage_entry(title, status, threads, started_at, exit_code=None, usage=None, tool=None):
+    """A metrics.json stage entry: timings, rusage and I/O counters.
+
+    `tool` is the executable the stage's thread count was sized for; thread
+    tuning learns from the entry under that tool.
+    """
+    entry = {
+        "title": title,
+        "tool": tool,
+        "status": status,
+        "exit_code": exit_code,
+        "threads": threads,
+        "started_at": datetime.datetime.fromtimestamp(started_at).isoformat(),
+        "finished_at": datetime.datetime.now().isoformat(),
+    }
+    entry.update(usage or {})
+    return entry
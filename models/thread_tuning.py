@@ -0,0 +1,87 @@
+import math
+import time
+import threading
+
+# Only stages that ran long enough for start-up cost not to dominate
+MIN_WALL_SECONDS = 60
+MIN_SAMPLES = 3
+# A stage "saturated" when it used less than this share of its threads
+SATURATION = 0.6
+HEADROOM = 1.25
+CACHE_SECONDS = 600
+
+_lock = threading.Lock()
+_cache = {"at": 0.0, "limits": {}}
+
+
+def tool_of(stage_name):
+    """Tool a stage belongs to (fastqc_raw -> fastqc)."""
+    return stage_name.split("_")[0]
+
+
+def sample_tool(stage_name, tool=None):
+    """Tool a metrics row counts for: the one recorded with it, else the stage's."""
+    return tool or tool_of(stage_name)
+
+
+def limits_from_samples(samples):
+    """Thread caps from historical (tool, threads, wall, cpu) samples.
+
+    A tool is capped only when enough of its runs were given clearly more
+    threads than they kept busy (cpu / wall); the cap is the best
+    parallelism ever reached there, plus some headroom. Tools that scaled
+    with their threads are left alone.
+    """
+    saturated = {}
+    for tool, threads, wall, cpu in samples:
+        if not threads or not wall or cpu is None or wall < MIN_WALL_SECONDS:
+            continue
+        used = cpu / wall
+        if used < threads * SATURATION:
+            saturated.setdefault(tool, []).append(used)
+
+    return {
+        tool: max(1, math.ceil(max(used) * HEADROOM))
+        for tool, used in saturated.items()
+        if len(used) >= MIN_SAMPLES
+    }
+
+
+def load_samples(limit=500):
+    """Recent completed stage metrics as (tool, threads, wall, cpu) tuples."""
+    from models.db import get_db_connection
+
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT stage, tool, threads, wall_seconds, cpu_user_seconds + cpu_system_seconds "
+            "FROM pipeline_stage_metrics WHERE status = 'completed' ORDER BY id DESC LIMIT %s",
+            (limit,)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        return [(sample_tool(stage, tool), threads, wall, cpu) for stage, tool, threads, wall, cpu in rows]
+    finally:
+        conn.close()
+
+
+def tuned_limits():
+    """{tool: max useful threads} learned from history (cached for 10 minutes).
+
+    Returns {} when there is no history or no database (e.g. diagnostics
+    on a machine without MySQL).
+    """
+    with _lock:
+        if time.time() - _cache["at"] < CACHE_SECONDS:
+            return dict(_cache["limits"])
+    try:
+        limits = limits_from_samples(load_samples())
+    except Exception as e:
+        print(f"[TUNING] Using static thread profiles ({e})")
+        limits = {}
+    with _lock:
+        _cache.update(at=time.time(), limits=limits)
+    return dict(limits)
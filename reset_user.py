@@ -2,6 +2,7 @@
 import os
 import sys
 from models.db import get_db_connection
+from models import session_cache
 
 email = "smp@gmail.com"
 password = "2005"
@@ -15,6 +16,7 @@ if conn:
         cursor.execute("DELETE FROM users WHERE email = %s", (email,))
         conn.commit()
         print(f"Deleted {cursor.rowcount} user(s).")
+        session_cache.invalidate(email)
 
         print(f"Recreating user {email}...")
         cursor.execute("INSERT INTO users (email, password, name) VALUES (%s, %s, %s)", (email, password, name))
@@ -0,0 +1,67 @@
+import sys
+import os
+import time
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import artifact_digests
+
+
+class ArtifactDigestsTest(unittest.TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp(prefix="mapnmark_digest_")
+        self.write("racon/polished.fasta", b">contig_1\nACGT\n")
+        self.write("prokka/PROKKA.gff", b"##gff-version 3\n")
+        self.write("flye/assembly.fasta", b">contig_1\nACGA\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def write(self, rel, data, mtime=None):
+        path = os.path.join(self.run_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_stage_outputs_are_hashed_once(self):
+        self.assertEqual(artifact_digests.refresh(self.run_dir, ["racon"]), 1)
+        expected = hashlib.blake2b(b">contig_1\nACGT\n", digest_size=32).hexdigest()
+        self.assertEqual(artifact_digests.lookup(self.run_dir, "racon/polished.fasta"), expected)
+        self.assertIsNone(artifact_digests.lookup(self.run_dir, "prokka/PROKKA.gff"))
+        self.assertEqual(artifact_digests.refresh(self.run_dir, ["racon"]), 0)
+
+    def test_changes_since_a_version(self):
+        artifact_digests.refresh(self.run_dir)
+        first = artifact_digests.changes_since(self.run_dir, None)
+        self.assertTrue(first["complete"])
+        self.assertEqual([f["path"] for f in first["changed"]], ["flye/assembly.fasta", "prokka/PROKKA.gff", "racon/polished.fasta"])
+
+        # Touched with the same content: not a change
+        self.write("prokka/PROKKA.gff", b"##gff-version 3\n", mtime=time.time() + 5)
+        self.write("racon/polished.fasta", b">contig_1\nACGTT\n", mtime=time.time() + 5)
+        self.write("quast/report.tsv", b"Assembly\n")
+        os.remove(os.path.join(self.run_dir, "flye", "assembly.fasta"))
+        artifact_digests.refresh(self.run_dir)
+
+        delta = artifact_digests.changes_since(self.run_dir, first["version"])
+        self.assertFalse(delta["complete"])
+        self.assertEqual([f["path"] for f in delta["changed"]], ["quast/report.tsv", "racon/polished.fasta"])
+        self.assertEqual(delta["deleted"], ["flye/assembly.fasta"])
+        self.assertEqual(artifact_digests.changes_since(self.run_dir, delta["version"])["changed"], [])
+        self.assertTrue(artifact_digests.changes_since(self.run_dir, delta["version"] + 1)["complete"])
+
+    def test_headers(self):
+        digest = "00" * 32
+        self.assertEqual(artifact_digests.etag(digest), "blake2b-256-" + digest)
+        self.assertEqual(artifact_digests.digest_header(digest), "blake2b-256=" + "A" * 43 + "=")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import sys
+import os
+import unittest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.core_allocator import CoreAllocator
+
+
+class CoreAllocatorTest(unittest.TestCase):
+    def test_allocations_are_disjoint(self):
+        allocator = CoreAllocator(range(8))
+        a = allocator.allocate("a", 3)
+        b = allocator.allocate("b", 4)
+        self.assertEqual(a.threads, 3)
+        self.assertEqual(b.threads, 4)
+        self.assertFalse(set(a.cpus) & set(b.cpus))
+
+    def test_partial_grant_and_rebalance(self):
+        allocator = CoreAllocator(range(8))
+        a = allocator.allocate("a", 6)
+        self.assertFalse(allocator.can_grant(8))
+        self.assertTrue(allocator.can_grant(4))
+
+        b = allocator.allocate("b", 4)
+        self.assertEqual(b.threads, 2)
+
+        grown = []
+        b.subscribe(lambda alloc: grown.append(alloc.threads))
+        allocator.release(a)
+        self.assertEqual(b.threads, 4)
+        self.assertEqual(grown, [4])
+        self.assertEqual(len(allocator.free), 4)
+
+    def test_no_core_is_granted_twice(self):
+        allocator = CoreAllocator(range(2))
+        a = allocator.allocate("a", 2)
+        self.assertIsNone(allocator.allocate("b", 1))
+        allocator.release(a)
+        self.assertEqual(allocator.allocate("b", 1).cpus, [0])
+        self.assertEqual(allocator.free, [1])
+
+    def test_request_is_clamped_to_host(self):
+        allocator = CoreAllocator(range(2))
+        self.assertEqual(allocator.allocate("a", "16").threads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import sys
+import os
+import gc
+import unittest
+from unittest import mock
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import db
+from mysql.connector.errors import PoolError
+
+
+class FakePool:
+    """Stands in for MySQLConnectionPool: hands out a fixed set of connections."""
+
+    def __init__(self, size):
+        self.free = [mock.MagicMock(name=f"cnx{i}") for i in range(size)]
+
+    def get_connection(self):
+        if not self.free:
+            raise PoolError("Failed getting connection; pool exhausted")
+        cnx = self.free.pop()
+        cnx.close.side_effect = lambda: self.free.append(cnx)
+        return cnx
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = FakePool(2)
+        patcher = mock.patch.object(db, "get_pool", return_value=self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connections_go_back_to_the_pool(self):
+        with db.db_connection() as conn:
+            conn.cursor().execute("SELECT 1")
+            self.assertEqual(len(self.pool.free), 1)
+        self.assertEqual(len(self.pool.free), 2)
+
+        conn = db.get_db_connection()
+        conn.close()
+        conn.close()      # closing twice returns it once
+        self.assertEqual(len(self.pool.free), 2)
+
+    def test_dropped_connection_is_returned(self):
+        conn = db.get_db_connection()
+        conn.is_connected()
+        del conn
+        gc.collect()
+        self.assertEqual(len(self.pool.free), 2)
+
+    def test_exhausted_pool_waits_then_gives_up(self):
+        held = [db.get_db_connection(), db.get_db_connection()]
+        with self.assertRaises(PoolError):
+            db.checkout(timeout=0.1)
+        with mock.patch.object(db, "DB_POOL_TIMEOUT", 0.1):
+            self.assertIsNone(db.get_db_connection(database=os.environ.get('DB_NAME', 'gene_app')))
+        held[0].close()
+        self.assertIsNotNone(db.checkout(timeout=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import sys
+import os
+import unittest
+import tempfile
+import shutil
+import threading
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import run_state
+from models import error_monitor
+from models.error_monitor import ErrorMonitor, DEFAULT_RULES, compile_rules, load_scan
+from utils.log_sink import compress
+
+
+class ErrorMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_monitor_")
+        self.log = os.path.join(self.tmp, "pipeline_output.log")
+        run_state.start_run(self.tmp, [("porechop", "Porechop"), ("flye", "Flye")])
+        run_state.set_stage(self.tmp, "porechop", "running")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def append(self, text):
+        with open(self.log, "a", encoding="utf-8") as f:
+            f.write(text)
+
+    def monitor(self):
+        return ErrorMonitor(self.tmp, self.log, rules=compile_rules(DEFAULT_RULES))
+
+    def test_harmless_error_text_is_ignored(self):
+        self.append("Flye finished with 3 non-fatal errors\n")
+        self.append("[2024-01-01 10:00:00] ERROR: no disjointigs were assembled\n")
+        # Flye's rule only applies once its stage has started
+        self.assertIsNone(self.monitor().scan_once())
+
+    def test_fatal_line_of_started_tool(self):
+        run_state.set_stage(self.tmp, "flye", "running")
+        self.append("[2024-01-01 10:00:00] INFO: Assembling\n")
+        monitor = self.monitor()
+        self.assertIsNone(monitor.scan_once())
+        offset = load_scan(self.tmp)["offset"]
+        self.assertEqual(offset, os.path.getsize(self.log))
+
+        self.append("[2024-01-01 10:05:00] ERROR: No disjointigs were assembled - please check if the input parameters are correct\n")
+        match = self.monitor().scan_once()
+        self.assertEqual(match["tool"], "flye")
+        self.assertIn("No disjointigs", match["line"])
+
+    def test_streamed_porechop_rules_apply_in_the_filtlong_stage(self):
+        run_state.start_run(self.tmp, [("filtlong", "Filtlong", ["porechop", "filtlong"])])
+        run_state.set_stage(self.tmp, "filtlong", "running")
+        self.append("Error: could not find adapter sets\n")
+        # Only Porechop's rule, so a match cannot come from Filtlong's
+        monitor = ErrorMonitor(self.tmp, self.log, rules=compile_rules({"porechop": DEFAULT_RULES["porechop"]}))
+        self.assertEqual(monitor.scan_once()["tool"], "porechop")
+
+    def test_partial_line_waits_for_newline(self):
+        self.append("Traceback (most recent")
+        monitor = self.monitor()
+        self.assertIsNone(monitor.scan_once())
+        self.append(" call last):\n")
+        self.assertEqual(monitor.scan_once()["tool"], "*")
+
+
+    def test_fatal_match_triggers_callback_without_viewers(self):
+        error_monitor.SCAN_SECONDS = 0.05
+        matched = threading.Event()
+        monitor = ErrorMonitor(self.tmp, self.log, on_fatal=lambda *args: matched.set()).start()
+        self.append("samtools: No space left on device\n")
+        self.assertTrue(matched.wait(5))
+        monitor.stop()
+        self.assertEqual(monitor.fatal["rule"], "No space left on device")
+
+    def test_rotated_segment_is_finished_first(self):
+        self.append("Loading reads\n")
+        monitor = self.monitor()
+        self.assertIsNone(monitor.scan_once())
+
+        # Written after the last scan, then rotated (and compressed) away
+        self.append("Error: could not open reads.fastq\n")
+        os.replace(self.log, self.log + ".1")
+        compress(self.log + ".1")
+        self.append("Trimming adapters from read ends\n")
+        self.assertEqual(monitor.scan_once()["line"], "Error: could not open reads.fastq")
+
+    def test_segments_from_before_the_run_are_skipped(self):
+        self.append("Error: from an earlier attempt\n")
+        os.replace(self.log, self.log + ".1")
+        self.append("Loading reads\n")
+        monitor = self.monitor()
+        self.assertIsNone(monitor.scan_once())
+        self.assertEqual(load_scan(self.tmp)["segment"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
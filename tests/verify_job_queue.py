@@ -0,0 +1,61 @@
+import sys
+import os
+import unittest
+from unittest import mock
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import job_queue
+from models.job_queue import WorkerPool
+from models.core_allocator import CoreAllocator
+
+
+def job(job_id, threads, memory_mb=1024):
+    return {"id": job_id, "run_id": f"run{job_id}", "threads": threads, "memory_mb": memory_mb}
+
+
+class WorkerPoolAdmissionTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(job_queue, "memory_info_mb", return_value=(16384, 12000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_idle_host_admits_oversized_job(self):
+        pool = WorkerPool(workers=2, allocator=CoreAllocator(range(4)))
+        self.assertTrue(pool.admits(job(1, threads=16, memory_mb=64000)))
+
+    def test_cores_are_not_oversubscribed(self):
+        allocator = CoreAllocator(range(8))
+        pool = WorkerPool(workers=3, allocator=allocator)
+        pool.running[1] = job(1, threads=7)
+        allocator.allocate("run1", 7)
+        # One core left: a 4-thread job needs at least half of its request
+        self.assertFalse(pool.admits(job(2, threads=4)))
+        self.assertTrue(pool.admits(job(2, threads=2)))
+
+    def test_job_stays_queued_until_cores_are_released(self):
+        # The last job left `running` but has not released its cores yet
+        allocator = CoreAllocator(range(2))
+        held = allocator.allocate("run1", 2)
+        pool = WorkerPool(workers=2, allocator=allocator)
+        head = dict(job(2, threads=1), attempts=0)
+        with mock.patch.object(job_queue, "_head_job", return_value=head), \
+                mock.patch.object(job_queue, "_claim", return_value=True) as claim:
+            self.assertFalse(pool.dispatch_once())
+            claim.assert_not_called()
+
+            allocator.release(held)
+            self.assertTrue(pool.dispatch_once())
+        self.assertEqual(pool.ready.get_nowait()["allocation"].cpus, [0])
+
+    def test_memory_and_worker_limits(self):
+        pool = WorkerPool(workers=2, allocator=CoreAllocator(range(32)))
+        pool.running[1] = job(1, threads=1, memory_mb=10000)
+        self.assertFalse(pool.admits(job(2, threads=1, memory_mb=8000)))
+        pool.running[2] = job(2, threads=1, memory_mb=100)
+        self.assertFalse(pool.admits(job(3, threads=1, memory_mb=100)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import sys
+import os
+import json
+import gzip
+import time
+import unittest
+import tempfile
+import shutil
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.log_sink import LineSplitter, LogSink, events_path
+
+
+class LineSplitterTest(unittest.TestCase):
+    def test_progress_redraws_collapse_to_the_final_state(self):
+        splitter = LineSplitter()
+        self.assertEqual(splitter.feed(b"start\n 10%\r 20%\r"), [b"start"])
+        self.assertEqual(splitter.progress, b" 20%")
+        self.assertEqual(splitter.feed(b" 30%\r100%\ndone\r\n"), [b"100%", b"done"])
+        self.assertIsNone(splitter.progress)
+
+    def test_bare_carriage_return_before_newline_keeps_last_state(self):
+        splitter = LineSplitter()
+        splitter.feed(b"50%\r")
+        self.assertEqual(splitter.feed(b"\n"), [b"50%"])
+
+    def test_unfinished_line_is_flushed(self):
+        splitter = LineSplitter()
+        splitter.feed(b"a\rb")
+        self.assertEqual(splitter.flush(), [b"b"])
+
+
+class LogSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_sink_")
+        self.log = os.path.join(self.tmp, "pipeline_output.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def read(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def test_stream_is_normalised_once_at_write_time(self):
+        sink = LogSink(self.log)
+        stream = sink.stream("porechop")
+        os.write(stream.fd, b"[PIPELINE 10:00:00] STEP: Porechop\n\x1b[32m1 / 4\r2 / 4\r")
+        for _ in range(50):
+            if "progress" in self.read(events_path(self.log)):
+                break
+            time.sleep(0.05)
+        os.write(stream.fd, b"4 / 4\x1b[0m\n")
+        stream.close()
+        sink.close()
+
+        self.assertEqual(self.read(self.log), "[PIPELINE 10:00:00] STEP: Porechop\n4 / 4\n")
+        with open(events_path(self.log), "r", encoding="utf-8") as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([e["event"] for e in events], ["log", "progress"])
+        self.assertEqual(events[0]["stage"], "porechop")
+        self.assertEqual(events[1]["text"], "2 / 4")
+
+    def test_full_log_is_rotated_and_compressed(self):
+        sink = LogSink(self.log, rotate_bytes=100)
+        for i in range(30):
+            sink.write_line(f"line {i}")
+        sink.close()
+
+        segment = self.log + ".1.gz"
+        for _ in range(50):
+            if os.path.exists(segment) and not os.path.exists(self.log + ".1"):
+                break
+            time.sleep(0.05)
+        with gzip.open(segment, "rt", encoding="utf-8") as f:
+            self.assertTrue(f.read().startswith("line 0\n"))
+        self.assertLess(os.path.getsize(self.log), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import sys
+import os
+import unittest
+import tempfile
+import shutil
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.log_tail import read_log_chunk
+
+
+class LogTailTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_tail_")
+        self.log = os.path.join(self.tmp, "pipeline_output.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, data, mode="ab"):
+        with open(self.log, mode) as f:
+            f.write(data)
+
+    def test_only_new_complete_lines_are_returned(self):
+        self.write(b"line 1\nline 2\npart")
+        chunk = read_log_chunk(self.log, 0)
+        self.assertEqual(chunk["log"], "line 1\nline 2\n")
+        self.assertFalse(chunk["more"])
+
+        self.write(b"ial\n")
+        chunk = read_log_chunk(self.log, chunk["offset"])
+        self.assertEqual(chunk["log"], "partial\n")
+        self.assertEqual(chunk["offset"], os.path.getsize(self.log))
+
+    def test_final_read_includes_trailing_line(self):
+        self.write("done ✓".encode("utf-8"))
+        self.assertEqual(read_log_chunk(self.log, 0, final=True)["log"], "done ✓")
+
+    def test_large_backlog_is_chunked(self):
+        self.write(b"x" * 9 + b"\n" + b"y" * 9 + b"\n")
+        chunk = read_log_chunk(self.log, 0, limit=15)
+        self.assertEqual(chunk["log"], "x" * 9 + "\n")
+        self.assertTrue(chunk["more"])
+
+    def test_truncated_log_resets(self):
+        self.write(b"a\n")
+        chunk = read_log_chunk(self.log, 100)
+        self.assertTrue(chunk["reset"])
+        self.assertEqual(chunk["log"], "a\n")
+
+    def test_missing_log(self):
+        self.assertEqual(read_log_chunk(self.log, 0)["log"], "")
+
+
+if __name__ == '__main__':
+    unittest.main()
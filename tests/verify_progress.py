@@ -0,0 +1,73 @@
+import sys
+import os
+import time
+import unittest
+import tempfile
+import shutil
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import run_state
+from models.progress import ProgressTracker, estimate
+
+
+class ProgressTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_progress_")
+        self.tracker = ProgressTracker(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def feed(self, stage, *lines):
+        for line in lines:
+            self.tracker.observe(stage, line)
+        return self.tracker.fractions.get(stage)
+
+    def test_porechop_counters_are_scaled_into_their_phase(self):
+        self.assertEqual(self.feed("porechop", "Loading reads", "2,000 / 4,000 (50.0%)"), 0.05)
+        fraction = self.feed("porechop", "Trimming adapters from read ends", "1,000 / 4,000")
+        self.assertAlmostEqual(fraction, 0.3)
+
+    def test_streamed_porechop_counts_in_the_filtlong_stage(self):
+        self.tracker = ProgressTracker(self.tmp, {"filtlong": ["porechop", "filtlong"]})
+        self.assertAlmostEqual(self.feed("filtlong", "Loading reads", "2,000 / 4,000"), 0.04)
+        # Porechop has the first 80% of the stage, Filtlong the rest
+        self.assertAlmostEqual(self.feed("filtlong", "Trimming adapters from read ends", "1,000 / 4,000"), 0.24)
+        self.assertAlmostEqual(self.feed("filtlong", "Scoring long reads"), 0.8)
+
+    def test_flye_stage_names_and_racon_windows(self):
+        self.assertEqual(self.feed("flye", "[2024-01-01 10:00:00] INFO: >>>STAGE: consensus"), 0.35)
+        fraction = self.feed("racon", "[racon::Polisher::polish] generating consensus [==========          ] 10s")
+        self.assertAlmostEqual(fraction, 0.75)
+
+    def test_progress_never_goes_back(self):
+        self.feed("flye", ">>>STAGE: polishing")
+        self.assertEqual(self.feed("flye", ">>>STAGE: assembly"), 0.7)
+
+    def test_progress_is_written_to_running_stages(self):
+        run_state.start_run(self.tmp, [("flye", "Flye")])
+        run_state.set_stage(self.tmp, "flye", "running")
+        self.feed("flye", ">>>STAGE: repeat")
+        self.assertEqual(run_state.load_state(self.tmp)["stages"]["flye"]["progress"], 0.5)
+
+
+class EstimateTest(unittest.TestCase):
+    def test_percent_and_eta(self):
+        now = time.time()
+        started = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now - 100))
+        state = {"stages": {
+            "porechop": {"status": "completed"},
+            "flye": {"status": "running", "started_at": started, "progress": 0.5},
+            "racon": {"status": "pending"},
+        }}
+        result = estimate(state, {"porechop": 100, "flye": 200, "racon": 100}, now)
+        # flye is half done after 100s, so 100s are left, plus racon
+        self.assertAlmostEqual(result["eta_seconds"], 200, delta=2)
+        self.assertAlmostEqual(result["percent"], 50.0, delta=1)
+        self.assertEqual(result["stages"]["porechop"], 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import reconciler, run_state
+from utils import run_paths
+
+
+def run(run_id, status, job_state, settled=1, run_type="analysis"):
+    return {"run_id": run_id, "user_email": "a@b.org", "status": status, "run_type": run_type,
+            "job_state": job_state, "settled": settled}
+
+
+class ReconcilerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="mapnmark_reconcile_")
+        patcher = mock.patch.object(run_paths, "PIPELINE_RUNS_DIR", self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def run_dir(self, run_id):
+        path = os.path.join(self.root, "a_b_org", run_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def test_target_status(self):
+        self.assertEqual(reconciler.target_status(run("r", "running", "running"), "completed")[0], "completed")
+        self.assertEqual(reconciler.target_status(run("r", "running", "queued"), None)[0], "queued")
+        self.assertEqual(reconciler.target_status(run("r", "running", "queued", run_type="blast"), None)[0], "pending")
+        self.assertIsNone(reconciler.target_status(run("r", "running", "running"), "running"))
+        self.assertEqual(reconciler.target_status(run("r", "running", "done"), "running")[0], "failed")
+        # Just created, its job is about to be queued
+        self.assertIsNone(reconciler.target_status(run("r", "running", None, settled=0), None))
+        self.assertEqual(reconciler.target_status(run("r", "running", None), None)[0], "failed")
+
+    def test_drift_is_written_in_one_batch(self):
+        run_state.finish_run(self.run_dir("done1"), "completed")
+        orphan_dir = self.run_dir("orphan")
+        run_state.set_status(orphan_dir, "running")
+        rows = [run("done1", "running", "done"), run("orphan", "running", "done"), run("ok", "running", "running")]
+
+        conn = mock.MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.fetchall.return_value = rows
+        with mock.patch.object(reconciler, "get_db_connection", return_value=conn):
+            self.assertEqual(reconciler.reconcile_once(), 2)
+
+        query, params = cursor.executemany.call_args[0]
+        self.assertIn("AND status = %s", query)
+        self.assertEqual(params, [("completed", True, "done1", "running"), ("failed", True, "orphan", "running")])
+        conn.commit.assert_called_once()
+        state = run_state.load_state(orphan_dir)
+        self.assertEqual(state["status"], "failed")
+        self.assertEqual(state["error"], reconciler.ORPHAN_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
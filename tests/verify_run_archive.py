@@ -0,0 +1,60 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import run_archive
+
+
+class RunArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_archive_")
+        self.run_dir = os.path.join(self.tmp, "pipeline_runs", "a_b_org", "run1")
+        self.write("flye/assembly.fasta", b">contig_1\n" + b"ACGT" * 5000 + b"\n")
+        self.write("porechop/trimmed.fastq.gz", os.urandom(4096))
+        self.write("run1.zip", b"archive kept by older versions")
+        patcher = mock.patch.object(run_archive, "ARCHIVE_DIR", os.path.join(self.tmp, "archives"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, rel, data):
+        path = os.path.join(self.run_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def test_stitched_archive_matches_the_run(self):
+        self.assertTrue(run_archive.build_archive(self.run_dir))
+        archive = run_archive.ready_archive(self.run_dir)
+        self.assertEqual(archive, os.path.join(self.tmp, "archives", "a_b_org", "run1.zip"))
+
+        with zipfile.ZipFile(archive) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(sorted(z.namelist()), ["flye/assembly.fasta", "porechop/trimmed.fastq.gz"])
+            self.assertEqual(z.getinfo("flye/assembly.fasta").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(z.getinfo("porechop/trimmed.fastq.gz").compress_type, zipfile.ZIP_STORED)
+
+    def test_archive_goes_stale_when_files_change(self):
+        run_archive.build_archive(self.run_dir)
+        self.write("quast/report.tsv", b"Assembly\tcontigs\n")
+        self.assertIsNone(run_archive.ready_archive(self.run_dir))
+
+        self.assertTrue(run_archive.build_archive(self.run_dir))
+        with zipfile.ZipFile(run_archive.ready_archive(self.run_dir)) as z:
+            self.assertIn("quast/report.tsv", z.namelist())
+
+        run_archive.remove(self.run_dir)
+        self.assertIsNone(run_archive.ready_archive(self.run_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import sys
+import os
+import io
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import run_export
+
+
+class RunExportTest(unittest.TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp(prefix="mapnmark_export_")
+        for rel in ["racon/polished.fasta", "flye/assembly.fasta", "porechop/trimmed.fastq",
+                    "filtlong/filtered.fastq", "prokka/PROKKA.gff", "prokka/PROKKA.gbk",
+                    "quast/report.tsv", "fastqc/raw/reads_fastqc.html", "pipeline_output.log"]:
+            path = os.path.join(self.run_dir, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(rel + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def names(self, files):
+        return sorted(name for _, name in files)
+
+    def test_profiles(self):
+        names = lambda profile: self.names(run_export.profile_files(self.run_dir, profile))
+        self.assertEqual(names("assembly"), ["flye/assembly.fasta", "racon/polished.fasta"])
+        self.assertEqual(names("annotation"), ["prokka/PROKKA.gbk", "prokka/PROKKA.gff"])
+        self.assertEqual(names("qc"), ["fastqc/raw/reads_fastqc.html", "quast/report.tsv"])
+        self.assertNotIn("porechop/trimmed.fastq", names("no_reads"))
+        self.assertIn("pipeline_output.log", names("no_reads"))
+        with self.assertRaises(KeyError):
+            run_export.profile_files(self.run_dir, "everything")
+
+    def test_custom_selection(self):
+        files = run_export.selected_files(self.run_dir, ["prokka", "racon/polished.fasta", "missing.txt"])
+        self.assertEqual(self.names(files), ["prokka/PROKKA.gbk", "prokka/PROKKA.gff", "racon/polished.fasta"])
+        with self.assertRaises(ValueError):
+            run_export.selected_files(self.run_dir, ["../other_run"])
+
+    def test_tar_gz_export(self):
+        files = run_export.profile_files(self.run_dir, "annotation")
+        chunks, mimetype, extension = run_export.export_stream(files, "tar.gz")
+        self.assertEqual((mimetype, extension), ("application/gzip", ".tar.gz"))
+
+        with tarfile.open(fileobj=io.BytesIO(b"".join(chunks)), mode="r:gz") as tar:
+            self.assertEqual(sorted(tar.getnames()), ["prokka/PROKKA.gbk", "prokka/PROKKA.gff"])
+            self.assertEqual(tar.extractfile("prokka/PROKKA.gff").read(), b"prokka/PROKKA.gff\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import sys
+import os
+import json
+import shutil
+import datetime
+import tempfile
+import unittest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import run_state, run_manifest
+
+
+class RunManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="mapnmark_manifest_")
+        self.lookups = []
+        self.rows = {
+            "run1": {"run_id": "run1", "status": "running", "run_type": "analysis",
+                     "start_time": datetime.datetime(2024, 1, 1, 10, 0), "end_time": None},
+        }
+        for run_id in ("run1", "old"):
+            os.makedirs(os.path.join(self.root, run_id, "flye"))
+            with open(os.path.join(self.root, run_id, "flye", "assembly.fasta"), "w") as f:
+                f.write(">c1\nACGT\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def load_rows(self, run_ids):
+        self.lookups.append(sorted(run_ids))
+        return {run_id: self.rows[run_id] for run_id in run_ids if run_id in self.rows}
+
+    def test_index_lists_runs_and_is_reused_until_a_run_changes(self):
+        run_state.finish_run(os.path.join(self.root, "run1"), "completed")
+        index = run_manifest.user_runs(self.root, self.load_rows)
+
+        self.assertEqual(index["run1"]["status"], "completed")
+        self.assertEqual(index["old"]["status"], "legacy")
+        self.assertEqual(index["run1"]["file_count"], 2)
+        with open(os.path.join(self.root, "run1", run_manifest.MANIFEST_FILE)) as f:
+            self.assertEqual(json.load(f)["files"][0]["size"], 9)
+
+        # Nothing changed: no directory walk, no DB lookup
+        run_manifest.user_runs(self.root, self.load_rows)
+        self.assertEqual(self.lookups, [["old", "run1"]])
+
+        with open(os.path.join(self.root, "run1", "run1.zip"), "w") as f:
+            f.write("zip")
+        shutil.rmtree(os.path.join(self.root, "old"))
+        index = run_manifest.user_runs(self.root, self.load_rows)
+        self.assertEqual(self.lookups[-1], ["run1"])
+        self.assertEqual(sorted(index), ["run1"])
+        self.assertEqual(index["run1"]["file_count"], 3)
+
+    def test_directories_are_listed_one_at_a_time(self):
+        run_dir = os.path.join(self.root, "run1")
+        listing = run_manifest.list_dir(run_dir)
+        self.assertEqual([(e["name"], e["type"]) for e in listing], [("flye", "dir")])
+        listing = run_manifest.list_dir(run_dir, "flye")
+        self.assertEqual(listing[0]["name"], "assembly.fasta")
+        self.assertEqual(listing[0]["size"], 9)
+        with self.assertRaises(ValueError):
+            run_manifest.list_dir(run_dir, "../old")
+
+
+if __name__ == '__main__':
+    unittest.main()
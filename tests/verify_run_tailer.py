@@ -0,0 +1,94 @@
+import sys
+import os
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+import json
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils import run_tailer
+
+
+def events(text):
+    """(event, data) pairs from an SSE stream."""
+    parsed = []
+    for block in text.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+        if "event" in fields:
+            parsed.append((fields["event"], json.loads(fields["data"])))
+    return parsed
+
+
+class RunTailerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_tailer_")
+        self.log = os.path.join(self.tmp, "pipeline_output.log")
+        self.state = {"status": "running", "queue_position": None}
+        self.state_calls = 0
+        run_tailer.POLL_SECONDS = 0.05
+        run_tailer.STATE_SECONDS = 0.1
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def state_fn(self):
+        self.state_calls += 1
+        return dict(self.state)
+
+    def append(self, text):
+        with open(self.log, "a", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_viewers_share_one_tailer(self):
+        self.append("line 1\nline 2\npart")
+        results = []
+
+        def viewer(offset):
+            results.append("".join(run_tailer.stream("run1", self.log, self.state_fn, offset)))
+
+        viewers = [threading.Thread(target=viewer, args=(offset,)) for offset in (0, 7, 0)]
+        for v in viewers:
+            v.start()
+        time.sleep(0.3)
+        self.append("ial\nline 3\n")
+        time.sleep(0.3)
+        self.append("tail")
+        self.state["status"] = "completed"
+        for v in viewers:
+            v.join(5)
+
+        self.assertEqual(len(results), 3)
+        logs = ["".join(data["log"] for event, data in events(r) if event == "log") for r in results]
+        self.assertEqual(sorted(logs), sorted([
+            "line 1\nline 2\npartial\nline 3\ntail",
+            "line 2\npartial\nline 3\ntail",
+            "line 1\nline 2\npartial\nline 3\ntail",
+        ]))
+        for r in results:
+            self.assertEqual(events(r)[-1], ("end", self.state))
+        # One state poll per tick for the run, not one per viewer
+        self.assertLess(self.state_calls, 20)
+        self.assertEqual(run_tailer._tailers, {})
+
+    def test_stream_slots_are_capped(self):
+        previous = run_tailer.MAX_STREAMS
+        run_tailer.MAX_STREAMS = 2
+        try:
+            self.assertTrue(run_tailer.open_stream())
+            self.assertTrue(run_tailer.open_stream())
+            self.assertFalse(run_tailer.open_stream())
+            run_tailer.close_stream()
+            self.assertTrue(run_tailer.open_stream())
+        finally:
+            run_tailer.close_stream()
+            run_tailer.close_stream()
+            run_tailer.MAX_STREAMS = previous
+        self.assertEqual(run_tailer._open_streams, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import sys
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import session_cache
+
+
+class SessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        session_cache.set_backend(session_cache.MemoryBackend())
+        self.calls = 0
+        self.token = "t1"
+
+    def load(self):
+        self.calls += 1
+        return True, self.token
+
+    def test_token_is_cached_until_invalidated(self):
+        self.assertEqual(session_cache.lookup("A@b.org", self.load), (True, "t1"))
+        self.assertEqual(session_cache.lookup("a@b.org", self.load), (True, "t1"))
+        self.assertEqual(self.calls, 1)
+
+        self.token = "t2"
+        session_cache.invalidate("a@b.org")
+        self.assertEqual(session_cache.lookup("a@b.org", self.load), (True, "t2"))
+        self.assertEqual(self.calls, 2)
+
+    def test_entries_expire(self):
+        with mock.patch.object(session_cache, "SESSION_CACHE_SECONDS", 0.05):
+            session_cache.lookup("a@b.org", self.load)
+            time.sleep(0.1)
+            session_cache.lookup("a@b.org", self.load)
+        self.assertEqual(self.calls, 2)
+
+    def test_failed_or_racing_loads_are_not_cached(self):
+        self.assertIsNone(session_cache.lookup("a@b.org", lambda: None))
+
+        def load_during_login():
+            session_cache.invalidate("a@b.org")      # a login lands mid-query
+            return True, "old"
+        session_cache.lookup("a@b.org", load_during_login)
+        self.assertEqual(session_cache.lookup("a@b.org", self.load), (True, "t1"))
+
+    def test_file_backend_is_shared(self):
+        directory = tempfile.mkdtemp(prefix="mapnmark_sessions_")
+        self.addCleanup(shutil.rmtree, directory, True)
+        session_cache.set_backend(session_cache.FileBackend(directory))
+        session_cache.lookup("a@b.org", self.load)
+
+        # Another worker process sees the entry, and its invalidation
+        other = session_cache.FileBackend(directory)
+        self.assertIsNotNone(other.get(session_cache.cache_key("a@b.org")))
+        other.delete(session_cache.cache_key("a@b.org"))
+        session_cache.lookup("a@b.org", self.load)
+        self.assertEqual(self.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
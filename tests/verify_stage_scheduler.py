@@ -0,0 +1,233 @@
+import io
+import sys
+import os
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import stage_cache
+from models.stage_metrics import load_metrics
+from models.run_state import load_state, read_status
+from models.scheduler import Stage, StageScheduler
+from utils.executor import kill_run, spawn_script, PID_DIR
+from utils.log_sink import events_path
+
+PREAMBLE = """#!/usr/bin/env bash
+set -euo pipefail
+OUTPUT_DIR="{out}"
+log() {{
+    echo "[PIPELINE] $1"
+}}
+"""
+
+
+class StageSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mapnmark_sched_")
+        self.out = os.path.join(self.tmp, "run")
+        os.makedirs(self.out)
+        self.log = os.path.join(self.out, "pipeline_output.log")
+        stage_cache.CACHE_DIR = os.path.join(self.tmp, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def scheduler(self, stages, budget=4):
+        return StageScheduler(stages, PREAMBLE.format(out=self.out), self.out, self.log, budget)
+
+    def test_independent_stages_overlap(self):
+        # b and c both only need a; each writes a marker then waits for the other's.
+        stages = [
+            Stage("a", "A", 'echo a > "$OUTPUT_DIR/a.txt"\n', outputs=["a.txt"]),
+            Stage("b", "B", 'touch "$OUTPUT_DIR/b.started"; for i in $(seq 50); do [ -f "$OUTPUT_DIR/c.started" ] && exit 0; sleep 0.1; done; exit 1\n', deps=["a"]),
+            Stage("c", "C", 'touch "$OUTPUT_DIR/c.started"; for i in $(seq 50); do [ -f "$OUTPUT_DIR/b.started" ] && exit 0; sleep 0.1; done; exit 1\n', deps=["a"]),
+        ]
+        self.assertEqual(self.scheduler(stages).run(), "completed")
+        self.assertTrue(os.path.exists(os.path.join(self.out, "PIPELINE_DONE")))
+
+    def test_failure_aborts_dependents(self):
+        stages = [
+            Stage("a", "A", "exit 3\n"),
+            Stage("b", "B", 'touch "$OUTPUT_DIR/b.ran"\n', deps=["a"]),
+        ]
+        self.assertEqual(self.scheduler(stages).run(), "failed")
+        self.assertFalse(os.path.exists(os.path.join(self.out, "b.ran")))
+        self.assertTrue(os.path.exists(os.path.join(self.out, "PIPELINE_ABORTED")))
+
+    def test_cache_hit_links_outputs(self):
+        def stages():
+            return [Stage("a", "A", 'echo $RANDOM > "$OUTPUT_DIR/a.txt"\n',
+                          outputs=["a.txt"], params={"p": 1})]
+
+        self.assertEqual(self.scheduler(stages()).run(), "completed")
+        with open(os.path.join(self.out, "a.txt")) as f:
+            first = f.read()
+
+        os.remove(os.path.join(self.out, "a.txt"))
+        self.assertEqual(self.scheduler(stages()).run(), "completed")
+        with open(os.path.join(self.out, "a.txt")) as f:
+            self.assertEqual(f.read(), first)
+        with open(self.log) as f:
+            self.assertIn("restored from cache", f.read())
+
+    def test_prune_evicts_least_recently_used(self):
+        def cached(name, size):
+            stage = Stage(name, name, "", outputs=[f"{name}.bin"])
+            with open(os.path.join(self.out, f"{name}.bin"), "wb") as f:
+                f.write(b"x" * size)
+            self.assertTrue(stage_cache.store(name * 8, stage, self.out))
+            return stage
+
+        stages = [cached(n, 1000) for n in "abc"]
+        os.utime(os.path.join(stage_cache.entry_dir("a" * 8), "meta.json"), (1, 1))
+        os.utime(os.path.join(stage_cache.entry_dir("b" * 8), "meta.json"), (2, 2))
+        # Still linked from the run: the cache holds nothing of its own
+        self.assertEqual(stage_cache.prune(0), 0)
+
+        for stage in stages:
+            os.remove(os.path.join(self.out, stage.outputs[0]))
+        self.assertEqual(stage_cache.prune(1500), 2)
+        self.assertEqual([stage_cache.lookup(n * 8) for n in "abc"], [False, False, True])
+
+    def test_digest_memo_follows_the_file(self):
+        path = os.path.join(self.out, "reads.fastq")
+        digest = stage_cache.save_upload(io.BytesIO(b"@r\nACGT\n"), path)
+        self.assertEqual(stage_cache.file_digest(path), digest)
+        linked = os.path.join(self.tmp, "linked.fastq")
+        os.link(path, linked)
+        self.assertIn(stage_cache.memo_key(os.stat(linked)), stage_cache._digests)
+
+    def test_claim_defers_to_another_process(self):
+        other = stage_cache.lock_file("k" * 8)      # a second lock holder, as another process would be
+        owner, waiter = stage_cache.claim("k" * 8)
+        self.assertFalse(owner)
+        self.assertFalse(waiter.wait(0))
+        stage_cache.unlock_file(other)
+        self.assertTrue(waiter.wait(0))
+        owner, _ = stage_cache.claim("k" * 8)
+        self.assertTrue(owner)
+        stage_cache.release("k" * 8)
+
+    def test_resume_skips_checkpointed_stages(self):
+        def stages(fail_b):
+            return [
+                Stage("a", "A", 'echo x >> "$OUTPUT_DIR/a.count"; cp "$OUTPUT_DIR/a.count" "$OUTPUT_DIR/a.txt"\n',
+                      outputs=["a.txt"], cacheable=False),
+                Stage("b", "B", ("exit 2\n" if fail_b else 'touch "$OUTPUT_DIR/b.txt"\n'),
+                      deps=["a"], outputs=["b.txt"], cacheable=False),
+            ]
+
+        self.assertEqual(self.scheduler(stages(True)).run(), "failed")
+        os.remove(os.path.join(self.out, "PIPELINE_ABORTED"))     # as resume_run does
+        sched = StageScheduler(stages(False), PREAMBLE.format(out=self.out), self.out, self.log, 4, resume=True)
+        self.assertEqual(sched.run(), "completed")
+        with open(os.path.join(self.out, "a.count")) as f:
+            self.assertEqual(len(f.read().split()), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.out, "b.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.out, "PIPELINE_ABORTED")))
+
+    def test_cancel_before_start_is_kept(self):
+        with open(os.path.join(self.out, "CANCEL"), "w") as f:
+            f.write("PIPELINE ABORTED BY USER\n")
+        stages = [Stage("a", "A", 'touch "$OUTPUT_DIR/a.txt"\n', outputs=["a.txt"])]
+        sched = StageScheduler(stages, PREAMBLE.format(out=self.out), self.out, self.log, 4, resume=True)
+        self.assertEqual(sched.run(), "cancelled")
+        self.assertFalse(os.path.exists(os.path.join(self.out, "a.txt")))
+        self.assertTrue(os.path.exists(os.path.join(self.out, "CANCEL")))
+        self.assertEqual(read_status(self.out), "cancelled")
+
+    def test_cancel_reason_is_logged(self):
+        with open(os.path.join(self.out, "CANCEL"), "w") as f:
+            f.write("Auto-terminated pipeline: fatal flye error detected: ERROR: boom\n")
+        self.assertEqual(self.scheduler([Stage("a", "A", "true\n")]).run(), "cancelled")
+        with open(self.log) as f:
+            self.assertIn("] Auto-terminated pipeline: fatal flye error detected", f.read())
+        with open(events_path(self.log)) as f:
+            self.assertIn("Auto-terminated pipeline", f.read())
+
+    def test_stage_metrics_recorded(self):
+        stages = [Stage("a", "A", 'head -c 1048576 /dev/zero > "$OUTPUT_DIR/a.bin"\n', outputs=["a.bin"])]
+        self.assertEqual(self.scheduler(stages).run(), "completed")
+
+        entry = load_metrics(self.out)["stages"]["a"]
+        self.assertEqual(entry["status"], "completed")
+        self.assertEqual(entry["exit_code"], 0)
+        self.assertGreaterEqual(entry["wall_seconds"], 0)
+        self.assertGreater(entry["max_rss_kb"], 0)
+        self.assertGreaterEqual(entry["write_chars"], 1048576)
+
+    def test_metrics_name_the_thread_driving_tool(self):
+        # a streamed stage is sized for its first tool, not the one it is named after
+        stages = [Stage("filtlong", "Trim + filter", "true\n", tools=["porechop", "filtlong"])]
+        self.assertEqual(self.scheduler(stages).run(), "completed")
+        self.assertEqual(load_metrics(self.out)["stages"]["filtlong"]["tool"], "porechop")
+
+    def test_state_file_tracks_stages(self):
+        stages = [
+            Stage("a", "A", "true\n"),
+            Stage("b", "B", "exit 4\n", deps=["a"]),
+            Stage("c", "C", "true\n", deps=["b"]),
+        ]
+        self.assertEqual(self.scheduler(stages).run(), "failed")
+
+        state = load_state(self.out)
+        self.assertEqual(state["status"], "failed")
+        self.assertEqual((state["failed_stage"], state["exit_code"]), ("b", 4))
+        self.assertIsNone(state["current_stage"])
+        self.assertEqual({n: s["status"] for n, s in state["stages"].items()},
+                         {"a": "completed", "b": "failed", "c": "pending"})
+        self.assertEqual(read_status(self.out), "failed")
+
+    def test_status_of_runs_without_state_file(self):
+        with open(self.log, "w") as f:
+            f.write("Error: harmless tool warning\n[PIPELINE] PIPELINE FINISHED SUCCESSFULLY\n")
+        self.assertEqual(read_status(self.out), "completed")
+
+    def test_cancel_kills_run_process_group(self):
+        # The stage ignores SIGTERM, so stopping it needs the SIGKILL escalation.
+        stages = [Stage("a", "A", "trap '' TERM\nsleep 30\n")]
+        result = {}
+        worker = threading.Thread(target=lambda: result.update(status=self.scheduler(stages).run()))
+        worker.start()
+
+        pid_file = os.path.join(self.out, PID_DIR, "a.pid")
+        for _ in range(100):
+            if os.path.exists(pid_file):
+                break
+            time.sleep(0.05)
+
+        started = time.time()
+        with open(os.path.join(self.out, "CANCEL"), "w") as f:
+            f.write("PIPELINE ABORTED BY USER\n")
+        self.assertEqual(kill_run(self.out, grace=0.5), 1)
+        worker.join(10)
+
+        self.assertEqual(result.get("status"), "cancelled")
+        self.assertLess(time.time() - started, 5)
+        self.assertFalse(os.path.exists(pid_file))
+
+    def test_kill_run_waits_for_leftover_groups(self):
+        # A stage left running by an earlier server process, ignoring SIGTERM
+        pid_file = os.path.join(self.out, PID_DIR, "flye.pid")
+        with open(os.devnull, "w") as devnull:
+            process = spawn_script("trap '' TERM\nsleep 30\n", devnull, pid_file=pid_file)
+        for _ in range(100):
+            if os.path.exists(pid_file):
+                break
+            time.sleep(0.05)
+
+        started = time.time()
+        self.assertEqual(kill_run(self.out, grace=0.5, wait=True), 1)
+        self.assertIsNotNone(process.wait(1))
+        self.assertLess(time.time() - started, 5)
+        self.assertFalse(os.path.exists(pid_file))
+        os.remove(process.script_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import sys
+import os
+import unittest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.thread_tuning import limits_from_samples, sample_tool
+from models.newpipeline import build_stages
+
+ALL_TOOLS = ["porechop", "filtlong", "fastqc", "flye", "minimap2", "racon", "prokka", "quast"]
+
+
+class ThreadTuningTest(unittest.TestCase):
+    def test_saturated_tool_is_capped(self):
+        # 16 threads given, never more than ~3 cores busy
+        samples = [("prokka", 16, 600, 600 * used) for used in (2.5, 3.0, 2.8)]
+        self.assertEqual(limits_from_samples(samples), {"prokka": 4})
+
+    def test_scaling_and_short_runs_are_ignored(self):
+        samples = [("flye", 16, 3600, 3600 * 14)] * 5 + [("quast", 16, 10, 10)] * 5
+        self.assertEqual(limits_from_samples(samples), {})
+
+    def test_samples_count_for_the_recorded_tool(self):
+        self.assertEqual(sample_tool("filtlong", "porechop"), "porechop")
+        self.assertEqual(sample_tool("fastqc_raw", None), "fastqc")
+
+    def test_every_tool_gets_its_thread_flag(self):
+        stages = {s.name: s for s in build_stages(ALL_TOOLS, 32, "/data/reads.fastq", limits={"quast": 4})}
+        self.assertIn("porechop --threads '$STAGE_THREADS'", stages["porechop"].body)
+        self.assertIn("--cpus '$STAGE_THREADS'", stages["prokka"].body)
+        self.assertIn("quast --threads '$STAGE_THREADS'", stages["quast"].body)
+        self.assertEqual(stages["porechop"].threads, 16)
+        self.assertEqual(stages["fastqc_raw"].threads, 1)
+        self.assertEqual(stages["flye"].threads, 32)
+        self.assertEqual(stages["quast"].threads, 4)
+
+    def test_alignments_path(self):
+        stages = {s.name: s for s in build_stages(ALL_TOOLS, 8, "/data/reads.fastq", paf_path="racon/reads.paf")}
+        self.assertEqual(stages["minimap2"].outputs, ["racon/reads.paf"])
+        self.assertIn("'$OUTPUT_DIR/racon/reads.paf'", stages["racon"].body)
+
+    def test_assembly_tools_need_flye(self):
+        with self.assertRaises(ValueError):
+            build_stages(["filtlong", "quast"], 8, "/data/reads.fastq")
+
+
+if __name__ == '__main__':
+    unittest.main()
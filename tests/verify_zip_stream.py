@@ -0,0 +1,53 @@
+import sys
+import os
+import io
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.zip_stream import stream_zip, compression_for
+
+
+class ZipStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp(prefix="mapnmark_zip_")
+        self.write("flye/assembly.fasta", b">contig_1\n" + b"ACGT" * 5000 + b"\n")
+        self.write("porechop/trimmed.fastq.gz", os.urandom(4096))
+        self.write("reads.fastq", b"@r1\nACGT\n+\n!!!!\n")
+        self.write("plot", b"\x89PNG\0\0binary")
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def write(self, rel, data):
+        path = os.path.join(self.run_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def test_only_text_artifacts_are_deflated(self):
+        path = lambda rel: os.path.join(self.run_dir, rel)
+        self.assertEqual(compression_for(path("flye/assembly.fasta")), zipfile.ZIP_DEFLATED)
+        self.assertEqual(compression_for(path("porechop/trimmed.fastq.gz")), zipfile.ZIP_STORED)
+        self.assertEqual(compression_for(path("reads.fastq")), zipfile.ZIP_STORED)
+        self.assertEqual(compression_for(path("plot")), zipfile.ZIP_STORED)
+
+    def test_streamed_archive_is_valid(self):
+        names = ["plot", "reads.fastq", "flye/assembly.fasta", "porechop/trimmed.fastq.gz"]
+        chunks = list(stream_zip([(os.path.join(self.run_dir, name), name) for name in names]))
+        self.assertGreater(len(chunks), 1)
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), names)
+            info = archive.getinfo("flye/assembly.fasta")
+            self.assertLess(info.compress_size, info.file_size)
+            self.assertEqual(archive.read("reads.fastq"), b"@r1\nACGT\n+\n!!!!\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
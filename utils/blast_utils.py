@@ -1,11 +1,15 @@
 import os
-import subprocess
 import uuid
 import datetime
+import time
 import csv
 import tempfile
 import shutil
 
+from utils.executor import run_script_with_usage, shell_path, PID_DIR
+from models.stage_metrics import record_stage, stage_entry
+from models import run_state
+
 # Default to "blast_db/reference" relative to project root
 BLAST_DB_PATH = os.path.join(os.getcwd(), "blast_db", "reference")
 
@@ -16,46 +20,21 @@ def debug(msg):
     print(f"[PY-DEBUG {datetime.datetime.now().strftime('%H:%M:%S')}] {msg}")
 
 # -------------------------------------------------
-# Convert Windows → WSL path
-# -------------------------------------------------
-def convert_to_wsl_path(win_path):
-    win_path = os.path.abspath(win_path)
-    # Check existence only if it's not a potential new file path (like an output log)
-    # But for input files it's good. 
-    # For now, we'll skip strict existence check for output paths or make sure we pass existing dirs.
-    
-    drive, path = os.path.splitdrive(win_path)
-    drive_letter = drive.rstrip(":").lower()
-    linux_path = path.replace("\\", "/").lstrip("/")
-    return f"/mnt/{drive_letter}/{linux_path}"
-
-# -------------------------------------------------
-# Run bash script inside WSL
+# Run bash script on the active execution backend
 # -------------------------------------------------
-def run_script_in_wsl(script_contents, output_file):
-    script_dir = os.path.join("pipeline_runs", "scripts")
-    os.makedirs(script_dir, exist_ok=True)
-
-    script_path = os.path.join(script_dir, f"{uuid.uuid4()}.sh")
-    with open(script_path, "w", encoding="utf-8", newline="\n") as f:
-        f.write(script_contents)
-
-    wsl_script_path = convert_to_wsl_path(script_path)
-    
-    # Ensure script is executable
-    subprocess.run(["wsl", "chmod", "+x", wsl_script_path], check=True)
-
-    with open(output_file, "a", encoding="utf-8") as logf:
-        process = subprocess.Popen(
-            ["wsl", "bash", wsl_script_path],
-            stdout=logf,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
-        ret = process.wait()
-        if ret != 0:
-            raise RuntimeError(f"BLAST pipeline aborted (exit code {ret})")
+def run_blast_script(script_contents, output_file, cpus=None, pid_file=None, output_dir=None, threads=None):
+    started_at = time.time()
+    if output_dir:
+        run_state.start_run(output_dir, [("blast", "BLAST")])
+        run_state.set_stage(output_dir, "blast", "running")
+    ret, usage = run_script_with_usage(script_contents, output_file, cpus=cpus, pid_file=pid_file)
+    status = "completed" if ret == 0 else "failed"
+    if output_dir:
+        record_stage(output_dir, "blast", stage_entry("BLAST", status, threads, started_at, ret, usage))
+        run_state.set_stage(output_dir, "blast", status, ret)
+        run_state.finish_run(output_dir, status, None if ret == 0 else "blast", ret)
+    if ret != 0:
+        raise RuntimeError(f"BLAST pipeline aborted (exit code {ret})")
 
 # -------------------------------------------------
 # BLAST Pipeline Function (Reference-Style)
@@ -67,20 +46,21 @@ def run_blast_pipeline(
     threads,
     output_file,
     blast_task="blastn",   # changed default to blastn, user can override to blastn-fast
-    max_hits=10
+    max_hits=10,
+    cpus=None              # cores to pin BLAST to (from the core allocator)
 ):
     debug("Starting BLAST pipeline")
 
-    query_fasta_wsl = convert_to_wsl_path(query_fasta)
-    output_dir_wsl = convert_to_wsl_path(output_dir)
-    blast_db_wsl = convert_to_wsl_path(blast_db_path)
+    query_fasta_sh = shell_path(query_fasta)
+    output_dir_sh = shell_path(output_dir)
+    blast_db_sh = shell_path(blast_db_path)
 
     script = f"""#!/usr/bin/env bash
 set -euo pipefail
 
-QUERY_FASTA="{query_fasta_wsl}"
-OUTPUT_DIR="{output_dir_wsl}"
-BLAST_DB="{blast_db_wsl}"
+QUERY_FASTA="{query_fasta_sh}"
+OUTPUT_DIR="{output_dir_sh}"
+BLAST_DB="{blast_db_sh}"
 THREADS="{threads}"
 MAX_HITS="{max_hits}"
 
@@ -164,7 +144,9 @@ log "BLAST pipeline finished successfully"
 """
 
     try:
-        run_script_in_wsl(script, output_file)
+        run_blast_script(script, output_file, cpus,
+                         pid_file=os.path.join(output_dir, PID_DIR, "blast.pid"),
+                         output_dir=output_dir, threads=threads)
     except Exception as e:
         with open(output_file, "a", encoding="utf-8") as f:
             f.write(f"\\n[INTERNAL ERROR] {str(e)}\\n")
@@ -0,0 +1,403 @@
+import os
+import platform
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+from utils.log_sink import LogSink, LogStream
+
+SCRIPT_DIR = os.path.join("pipeline_runs", "scripts")
+PID_DIR = ".pids"          # per-run directory of "<pgid> <script>" files
+KILL_GRACE_SECONDS = float(os.environ.get("PIPELINE_KILL_GRACE", "5"))
+
+
+# -------------------------------------------------
+# Convert Windows → WSL path
+# -------------------------------------------------
+def convert_to_wsl_path(win_path):
+    win_path = os.path.abspath(win_path)
+    drive, path = os.path.splitdrive(win_path)
+    drive_letter = drive.rstrip(":").lower()
+    linux_path = path.replace("\\", "/").lstrip("/")
+    return f"/mnt/{drive_letter}/{linux_path}"
+
+
+# -------------------------------------------------
+# Execution backends
+# -------------------------------------------------
+class NativeBackend:
+    """Runs pipeline scripts with the host bash on real paths (Linux/macOS)."""
+    name = "native"
+
+    def shell_path(self, path):
+        return os.path.abspath(path)
+
+    def command(self, script_path):
+        return ["bash", os.path.abspath(script_path)]
+
+    def owns_group(self, pgid, script):
+        """True if `pgid` is still the bash running `script` (guards PID reuse)."""
+        try:
+            with open(f"/proc/{pgid}/cmdline", "rb") as f:
+                return script.encode() in f.read()
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # No /proc (macOS): trust the pid file
+            return True
+
+    def kill_group(self, pgid, sig_name):
+        try:
+            os.killpg(pgid, getattr(signal, f"SIG{sig_name}"))
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class WslBackend:
+    """Runs pipeline scripts inside WSL, translating paths to /mnt/<drive>/."""
+    name = "wsl"
+
+    def shell_path(self, path):
+        return convert_to_wsl_path(path)
+
+    def command(self, script_path):
+        # setsid makes the script a process group leader inside WSL so the
+        # group can be signalled from here; -w keeps its exit status.
+        return ["wsl", "setsid", "-w", "bash", convert_to_wsl_path(script_path)]
+
+    def owns_group(self, pgid, script):
+        result = subprocess.run(
+            ["wsl", "grep", "-qF", script, f"/proc/{pgid}/cmdline"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        return result.returncode == 0
+
+    def kill_group(self, pgid, sig_name):
+        subprocess.run(
+            ["wsl", "kill", f"-{sig_name}", "--", f"-{pgid}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+
+BACKENDS = {
+    "native": NativeBackend,
+    "wsl": WslBackend,
+}
+
+
+def select_backend():
+    """Picks the backend once at startup: PIPELINE_BACKEND env, else by OS."""
+    name = os.environ.get("PIPELINE_BACKEND", "").strip().lower()
+    if name not in BACKENDS:
+        name = "wsl" if platform.system() == "Windows" else "native"
+    print(f"[EXECUTOR] Using '{name}' execution backend")
+    return BACKENDS[name]()
+
+
+BACKEND = select_backend()
+
+
+# -------------------------------------------------
+# Helpers used by the pipeline engines
+# -------------------------------------------------
+def shell_path(path, must_exist=False):
+    """Returns `path` as seen by the bash that runs the pipeline scripts."""
+    if must_exist and not os.path.exists(os.path.abspath(path)):
+        raise FileNotFoundError(f"Path does not exist: {os.path.abspath(path)}")
+    return BACKEND.shell_path(path)
+
+
+def write_script(script_contents):
+    os.makedirs(SCRIPT_DIR, exist_ok=True)
+
+    script_path = os.path.join(SCRIPT_DIR, f"{uuid.uuid4()}.sh")
+    with open(script_path, "w", encoding="utf-8", newline="\n") as f:
+        f.write(script_contents)
+    return script_path
+
+
+# -------------------------------------------------
+# CPU affinity (Linux only; a no-op elsewhere)
+# -------------------------------------------------
+def can_pin():
+    return hasattr(os, "sched_setaffinity") and os.path.isdir("/proc")
+
+
+def pin_process_group(pgid, cpus):
+    """Restricts every thread of every process in group `pgid` to `cpus`."""
+    if not cpus or not can_pin():
+        return
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "stat"), "r") as f:
+                stat = f.read()
+            # Fields after "(comm)": state ppid pgrp ...
+            if int(stat[stat.rindex(")") + 2:].split()[2]) != pgid:
+                continue
+            for tid in os.listdir(os.path.join(entry.path, "task")):
+                os.sched_setaffinity(int(tid), cpus)
+        except (OSError, ValueError, IndexError):
+            # Process exited meanwhile or is not ours
+            continue
+
+
+def record_pid(script_contents, pid_file):
+    """Makes a script write "<pid> <script path>" to `pid_file` as it starts.
+
+    The script runs as a process group leader, so its PID is the group to
+    signal on cancel. It is written from inside the script so the PID is the
+    one the backend sees (a Linux PID under WSL).
+    """
+    shebang, _, rest = script_contents.partition("\n")
+    return f'{shebang}\necho "$$ $0" > "{shell_path(pid_file)}"\n{rest}'
+
+
+def spawn_script(script_contents, logf, cpus=None, pid_file=None):
+    """Starts a bash script on the active backend without waiting for it.
+
+    Output goes to `logf`: an open file object, or a LogStream whose pipe
+    is handed to the script (the parent's end is closed once it has
+    started, so the stream ends with the script). On POSIX hosts the
+    script gets its own session so the whole process tree can be signalled.
+    With `cpus` the script (and everything it starts) is pinned to those
+    cores: the calling thread's affinity is inherited across fork, so it is
+    set just around the Popen call. With `pid_file` the script records its
+    process group there (see `kill_run`); the file is removed by
+    `discard_script`.
+    """
+    if pid_file:
+        os.makedirs(os.path.dirname(pid_file), exist_ok=True)
+        script_contents = record_pid(script_contents, pid_file)
+    script_path = write_script(script_contents)
+    previous = None
+    if cpus and can_pin():
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cpus)
+    try:
+        process = subprocess.Popen(
+            BACKEND.command(script_path),
+            stdout=logf.fd if isinstance(logf, LogStream) else logf,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            bufsize=1,
+            start_new_session=(os.name == "posix")
+        )
+    finally:
+        if previous is not None:
+            os.sched_setaffinity(0, previous)
+        if isinstance(logf, LogStream):
+            logf.close_writer()
+    process.script_path = script_path
+    process.pid_file = pid_file
+    process.started_at = time.time()
+    return process
+
+
+# -------------------------------------------------
+# Resource accounting
+# -------------------------------------------------
+def read_proc_io(pid):
+    """Storage I/O of a process and its reaped children from /proc/<pid>/io."""
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name.strip()] = int(value)
+    except (OSError, ValueError):
+        return {}
+    return {
+        "read_bytes": counters.get("read_bytes"),
+        "write_bytes": counters.get("write_bytes"),
+        "read_chars": counters.get("rchar"),
+        "write_chars": counters.get("wchar"),
+    }
+
+
+def wait_with_usage(process):
+    """Waits for a script started by spawn_script. Returns (exit code, usage).
+
+    On POSIX the exited script is left as a zombie (waitid WNOWAIT) long
+    enough to read its /proc I/O counters, then reaped with wait4 for its
+    rusage. Both cover every descendant the script waited for. Elsewhere
+    (the WSL backend on Windows) only wall time is reported.
+    """
+    usage = {}
+    if hasattr(os, "wait4") and hasattr(os, "waitid"):
+        try:
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            usage.update(read_proc_io(process.pid))
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usage.update({
+                "cpu_user_seconds": round(rusage.ru_utime, 3),
+                "cpu_system_seconds": round(rusage.ru_stime, 3),
+                "max_rss_kb": rusage.ru_maxrss,
+                "block_reads": rusage.ru_inblock,
+                "block_writes": rusage.ru_oublock,
+            })
+        except ChildProcessError:
+            # Already reaped elsewhere (e.g. a concurrent poll()).
+            pass
+    code = process.wait()
+    usage["wall_seconds"] = round(time.time() - getattr(process, "started_at", time.time()), 3)
+    return code, usage
+
+
+def discard_script(process):
+    """Removes the generated script (and pid file) of a finished process."""
+    for path in (getattr(process, "script_path", None), getattr(process, "pid_file", None)):
+        if not path:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def read_pid_file(pid_file):
+    """Returns (pgid, script path) from a pid file, or None."""
+    try:
+        with open(pid_file, "r", encoding="utf-8") as f:
+            pgid, _, script = f.read().strip().partition(" ")
+        return int(pgid), script
+    except (OSError, ValueError):
+        return None
+
+
+def signal_process(process, sig_name):
+    """Signals the process group of a script started by spawn_script."""
+    if process.poll() is not None:
+        return
+    recorded = read_pid_file(process.pid_file) if getattr(process, "pid_file", None) else None
+    if recorded and BACKEND.name != "native":
+        BACKEND.kill_group(recorded[0], sig_name)
+    elif os.name == "posix":
+        BACKEND.kill_group(process.pid, sig_name)
+    elif sig_name == "KILL":
+        process.kill()
+    else:
+        process.terminate()
+
+
+def terminate(process, grace=KILL_GRACE_SECONDS):
+    """SIGTERMs a script's process group, then SIGKILLs it after `grace` seconds."""
+    if process.poll() is not None:
+        return
+    signal_process(process, "TERM")
+
+    def escalate():
+        if process.poll() is None:
+            signal_process(process, "KILL")
+
+    timer = threading.Timer(grace, escalate)
+    timer.daemon = True
+    timer.start()
+
+
+def kill_run(run_dir, grace=KILL_GRACE_SECONDS, wait=False):
+    """Stops every script a run has recorded under <run_dir>/.pids.
+
+    Only that run's process groups are signalled (SIGTERM, then SIGKILL for
+    groups still alive after `grace` seconds). Works for processes left
+    over from a previous web process as well. With `wait`, blocks until
+    the groups are gone, e.g. before a recovered run reuses its directory.
+    Returns the number of groups signalled.
+    """
+    pid_dir = os.path.join(run_dir, PID_DIR)
+    try:
+        pid_files = [os.path.join(pid_dir, name) for name in os.listdir(pid_dir)]
+    except OSError:
+        return 0
+
+    groups = []
+    for pid_file in pid_files:
+        recorded = read_pid_file(pid_file)
+        if recorded and BACKEND.owns_group(*recorded):
+            groups.append((pid_file, recorded))
+            BACKEND.kill_group(recorded[0], "TERM")
+
+    def escalate():
+        for pid_file, recorded in groups:
+            if os.path.exists(pid_file) and BACKEND.owns_group(*recorded):
+                BACKEND.kill_group(recorded[0], "KILL")
+
+    if groups and wait:
+        wait_for_groups(groups, grace)
+        escalate()
+        if not wait_for_groups(groups, grace):
+            print(f"[EXECUTOR] Process groups of {run_dir} still running after SIGKILL")
+        for pid_file, recorded in groups:
+            if not BACKEND.owns_group(*recorded):
+                discard_pid_file(pid_file)
+    elif groups:
+        timer = threading.Timer(grace, escalate)
+        timer.daemon = True
+        timer.start()
+    return len(groups)
+
+
+def wait_for_groups(groups, timeout, interval=0.2):
+    """Waits up to `timeout` seconds for recorded groups to exit; True if they did."""
+    deadline = time.monotonic() + timeout
+    while any(BACKEND.owns_group(*recorded) for _, recorded in groups):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def discard_pid_file(pid_file):
+    try:
+        os.remove(pid_file)
+    except OSError:
+        pass
+
+
+def run_script_with_usage(script_contents, output_file, mode="a", cpus=None, pid_file=None):
+    """Like run_script, but returns (exit code, resource usage)."""
+    sink = LogSink(output_file, mode)
+    stream = sink.stream()
+    try:
+        process = spawn_script(script_contents, stream, cpus, pid_file)
+        try:
+            return wait_with_usage(process)
+        finally:
+            discard_script(process)
+    finally:
+        stream.close()
+        sink.close()
+
+
+def run_script(script_contents, output_file, mode="a", cpus=None, pid_file=None):
+    """Runs a bash script on the active backend, appending output to `output_file`.
+
+    Output is written through a LogSink (ANSI escapes stripped, progress
+    bars collapsed, events next to the log). Scripts are invoked as
+    `bash <script>`, so no chmod round trip is needed.
+    Returns the exit code.
+    """
+    return run_script_with_usage(script_contents, output_file, mode, cpus, pid_file)[0]
+
+
+def capture_script(script_contents):
+    """Runs a short bash script and returns (exit code, combined output)."""
+    script_path = write_script(script_contents)
+    try:
+        result = subprocess.run(
+            BACKEND.command(script_path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
+            errors="replace"
+        )
+    finally:
+        os.remove(script_path)
+    return result.returncode, result.stdout
@@ -0,0 +1,219 @@
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import threading
+
+ANSI_ESCAPE = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
+
+# Past this size the human log is moved to <log>.<n>.gz and started afresh
+ROTATE_BYTES = int(float(os.environ.get("LOG_ROTATE_MB", 64)) * 1024 * 1024)
+PROGRESS_SECONDS = 1.0
+READ_BYTES = 64 * 1024
+# How long to wait for a pipe still held open by a leftover descendant
+CLOSE_SECONDS = 30
+# Lines that are the pipeline's own messages (also sent to the event stream)
+MARKER_PREFIXES = ("[PIPELINE", "[BLAST", "[SYSTEM]")
+
+
+def events_path(log_path):
+    """pipeline_output.log -> pipeline_output.events.jsonl"""
+    return os.path.splitext(log_path)[0] + ".events.jsonl"
+
+
+def latest_segment(log_path):
+    """Number of the newest rotated segment of a log (0 if it never rotated)."""
+    prefix = os.path.basename(log_path) + "."
+    numbers = [0]
+    try:
+        names = os.listdir(os.path.dirname(log_path) or ".")
+    except OSError:
+        return 0
+    for name in names:
+        if name.startswith(prefix):
+            number = name[len(prefix):]
+            number = number[:-3] if number.endswith(".gz") else number
+            if number.isdigit():
+                numbers.append(int(number))
+    return max(numbers)
+
+
+def open_segment(log_path, number):
+    """Opens rotated segment `number` for reading in binary: <log>.<n> while
+    it is being compressed, else <log>.<n>.gz."""
+    try:
+        return open(f"{log_path}.{number}", "rb")
+    except FileNotFoundError:
+        # Compressed meanwhile: the plain file is removed only once the .gz is complete
+        return gzip.open(f"{log_path}.{number}.gz", "rb")
+
+
+class LineSplitter:
+    """Turns raw tool output into finished lines.
+
+    Carriage-return progress updates ("\\r 45%\\r 46%...") collapse into the
+    last state of the line; the latest state of a line still being
+    redrawn is available as `progress`.
+    """
+
+    def __init__(self):
+        self.pending = b""
+        self.progress = None
+
+    def feed(self, data):
+        """Returns the lines completed by `data` (bytes, without newline)."""
+        lines = []
+        *complete, self.pending = (self.pending + data).split(b"\n")
+        for line in complete:
+            line = line.rstrip(b"\r")
+            if b"\r" in line:
+                line = line.rsplit(b"\r", 1)[1]
+            if not line and self.progress is not None:
+                line = self.progress     # redrawn line ended by a bare "\r\n"
+            self.progress = None
+            lines.append(line)
+
+        if b"\r" in self.pending:
+            segments = self.pending.split(b"\r")
+            shown = [s for s in segments if s]
+            if shown:
+                self.progress = shown[-1]
+            self.pending = segments[-1]
+        return lines
+
+    def flush(self):
+        rest = self.pending or self.progress
+        self.pending, self.progress = b"", None
+        return [rest] if rest else []
+
+
+class LogStream:
+    """Pipe for one process's output, drained into a LogSink by a thread."""
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.read_fd, self.fd = os.pipe()
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        splitter = LineSplitter()
+        reported = 0
+        with os.fdopen(self.read_fd, "rb", buffering=0) as pipe:
+            while True:
+                data = pipe.read(READ_BYTES)
+                if not data:
+                    break
+                for line in splitter.feed(data):
+                    self.sink.write_line(line, self.name)
+                if splitter.progress is not None and time.time() - reported >= PROGRESS_SECONDS:
+                    reported = time.time()
+                    self.sink.progress(self.name, splitter.progress)
+        for line in splitter.flush():
+            self.sink.write_line(line, self.name)
+
+    def close_writer(self):
+        """Closes the parent's copy of the write end (the child keeps its own)."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        """Waits until everything the process wrote has reached the log."""
+        self.close_writer()
+        self.thread.join(CLOSE_SECONDS)
+
+
+class LogSink:
+    """The single writer of a run's log.
+
+    Tool output is normalised once, at write time: ANSI escapes are
+    stripped and carriage-return progress bars keep only their final state
+    (intermediate states go to the event stream, at most once a second).
+    Besides the human-readable log, a compact JSONL stream of the
+    pipeline's own messages and progress updates is written next to it
+    (events_path). The human log is gzip-rotated past ROTATE_BYTES.
+
+    `observer(stage, text)`, if given, sees every cleaned line and progress
+    update of a named stream (e.g. a ProgressTracker).
+    """
+
+    def __init__(self, path, mode="a", rotate_bytes=ROTATE_BYTES, observer=None):
+        self.path = path
+        self.rotate_bytes = rotate_bytes
+        self.observer = observer
+        self.lock = threading.Lock()
+        self.file = open(path, mode, encoding="utf-8", buffering=1)
+        self.events = open(events_path(path), mode, encoding="utf-8", buffering=1)
+
+    @staticmethod
+    def clean(line):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        return ANSI_ESCAPE.sub("", line)
+
+    def write_line(self, line, stage=None):
+        text = self.clean(line)
+        with self.lock:
+            if self.file.closed:
+                return     # a leftover descendant outlived the run
+            self.file.write(text + "\n")
+            if text.startswith(MARKER_PREFIXES):
+                self.write_event({"event": "log", "stage": stage, "text": text})
+            if self.file.tell() >= self.rotate_bytes:
+                self.rotate()
+        self.notify(stage, text)
+
+    def progress(self, stage, line):
+        """Latest state of a line a tool keeps redrawing."""
+        text = self.clean(line)
+        self.event("progress", stage=stage, text=text)
+        self.notify(stage, text)
+
+    def notify(self, stage, text):
+        if self.observer is None or stage is None:
+            return
+        try:
+            self.observer(stage, text)
+        except Exception as e:
+            # Never let the observer stop the pipe from being drained
+            print(f"[LOG] Observer failed for {self.path}: {e}")
+
+    def event(self, kind, **fields):
+        with self.lock:
+            if self.events.closed:
+                return
+            self.write_event(dict(event=kind, **fields))
+
+    def write_event(self, event):
+        event["t"] = round(time.time(), 3)
+        self.events.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def rotate(self):
+        """Moves the full log to <log>.<n>.gz (compressed in the background)."""
+        number = 1
+        while os.path.exists(f"{self.path}.{number}.gz") or os.path.exists(f"{self.path}.{number}"):
+            number += 1
+        self.file.close()
+        os.replace(self.path, f"{self.path}.{number}")
+        self.file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self.write_event({"event": "rotated", "segment": f"{os.path.basename(self.path)}.{number}.gz"})
+        threading.Thread(target=compress, args=(f"{self.path}.{number}",), daemon=True).start()
+
+    def stream(self, name=None):
+        """A pipe to hand to a child process as stdout/stderr."""
+        return LogStream(self, name)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.events.close()
+
+
+def compress(path):
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
@@ -0,0 +1,68 @@
+import os
+
+# Upper bound on what one poll sends; the client asks again while "more" is set.
+CHUNK_BYTES = 1024 * 1024
+
+
+def log_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def line_end(data):
+    """Length of `data` up to and including its last line break (0 if none)."""
+    return max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+
+
+def last_line_start(path, window=64 * 1024):
+    """Offset just after the last line break in the log (its size if it ends with one)."""
+    size = log_size(path)
+    if size == 0:
+        return 0
+    start = max(size - window, 0)
+    with open(path, "rb") as f:
+        f.seek(start)
+        return start + line_end(f.read(size - start))
+
+
+def read_log_bytes(path, offset=0, limit=CHUNK_BYTES, final=False):
+    """Raw form of read_log_chunk: (data, next_offset, more, reset)."""
+    size = log_size(path)
+    reset = offset < 0 or offset > size
+    if reset:
+        offset = 0
+
+    data = b""
+    if offset < size:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(min(limit, size - offset))
+
+    more = offset + len(data) < size
+    if data and not final:
+        end = line_end(data)
+        # A single line longer than the whole chunk has to be split anyway
+        if end or not more:
+            data = data[:end]
+
+    return data, offset + len(data), more, reset
+
+
+def read_log_chunk(path, offset=0, limit=CHUNK_BYTES, final=False):
+    """Reads the part of a log written after byte `offset`.
+
+    Returns {"log", "offset", "more", "reset"}: the new text, the offset to
+    ask for next, whether more is already waiting, and whether the log was
+    truncated/replaced (the client must then drop what it has). Unless
+    `final` (the run has ended), a trailing partial line is held back so a
+    chunk never ends inside a UTF-8 character or an escape sequence.
+    """
+    data, offset, more, reset = read_log_bytes(path, offset, limit, final)
+    return {
+        "log": data.decode("utf-8", errors="replace"),
+        "offset": offset,
+        "more": more,
+        "reset": reset,
+    }
@@ -0,0 +1,16 @@
+import os
+
+PIPELINE_RUNS_DIR = "pipeline_runs"
+
+
+def safe_username(email: str) -> str:
+    return email.replace("@", "_").replace(".", "_")
+
+
+def get_run_dir(username: str, run_id: str) -> str:
+    """pipeline_runs/<safe user>/<run_id>: where a user's run lives."""
+    return os.path.join(
+        PIPELINE_RUNS_DIR,
+        safe_username(username),
+        run_id
+    )
@@ -0,0 +1,197 @@
+import os
+import json
+import queue
+import threading
+import time
+
+from utils.log_tail import read_log_bytes, log_size, last_line_start, CHUNK_BYTES
+
+POLL_SECONDS = 0.5
+STATE_SECONDS = 2.0
+HEARTBEAT_SECONDS = 15
+# A tailer nobody listens to lingers this long in case the page reconnects
+IDLE_SECONDS = 30
+# Events buffered per viewer before a stalled connection is dropped
+# (the browser reconnects and catches up from the file)
+QUEUE_EVENTS = 500
+
+TERMINAL_STATES = ("completed", "failed", "cancelled")
+
+# Each open stream holds a server worker thread for as long as the page is
+# open; beyond this many, viewers are told to poll /get_log instead so that
+# logins and other requests always find a free thread.
+MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", max(1, int(os.environ.get("WAITRESS_THREADS", 32)) // 4)))
+
+_lock = threading.Lock()
+_tailers = {}
+_open_streams = 0
+
+
+class RunTailer:
+    """Follows one run's log and state on behalf of all of its viewers.
+
+    A single thread reads what was appended to the log and checks the run
+    state every STATE_SECONDS, and fans both out to the subscribed
+    connections, so the cost of a run does not grow with its viewers.
+    """
+
+    def __init__(self, key, log_path, state_fn):
+        self.key = key
+        self.log_path = log_path
+        self.state_fn = state_fn
+        self.offset = last_line_start(log_path)
+        self.state = None
+        self.subscribers = []
+        self.idle_since = time.time()
+
+    def broadcast(self, event):
+        for sub in list(self.subscribers):
+            try:
+                sub.put_nowait(event)
+            except queue.Full:
+                self.subscribers.remove(sub)
+                sub.dropped = True
+
+    def read_state(self):
+        try:
+            return self.state_fn()
+        except Exception as e:
+            print(f"[EVENTS] State check for {self.key} failed: {e}")
+            return self.state
+
+    def run(self):
+        checked_at = 0
+        while True:
+            now = time.time()
+            if now - checked_at >= STATE_SECONDS:
+                checked_at = now
+                state = self.read_state()
+                if state != self.state:
+                    with _lock:
+                        self.state = state
+                        self.broadcast({"event": "status", "data": state})
+
+            final = bool(self.state) and self.state["status"] in TERMINAL_STATES
+            data, offset, more, reset = read_log_bytes(self.log_path, self.offset, final=final)
+            with _lock:
+                if reset:
+                    self.broadcast({"event": "reset"})
+                if data:
+                    self.broadcast({"event": "log", "start": offset - len(data), "raw": data})
+                self.offset = offset
+
+                if final and not more:
+                    self.broadcast({"event": "end", "data": self.state})
+                    _tailers.pop(self.key, None)
+                    return
+
+                if self.subscribers:
+                    self.idle_since = now
+                elif now - self.idle_since > IDLE_SECONDS:
+                    _tailers.pop(self.key, None)
+                    return
+
+            if not more:
+                time.sleep(POLL_SECONDS)
+
+
+def open_stream():
+    """Reserves one of the MAX_STREAMS stream slots; False if none is free.
+
+    A reserved slot is given back with close_stream once the response is done.
+    """
+    global _open_streams
+    with _lock:
+        if _open_streams >= MAX_STREAMS:
+            return False
+        _open_streams += 1
+        return True
+
+
+def close_stream():
+    global _open_streams
+    with _lock:
+        _open_streams = max(0, _open_streams - 1)
+
+
+class Subscription(queue.Queue):
+    def __init__(self):
+        super().__init__(QUEUE_EVENTS)
+        self.dropped = False
+
+
+def format_event(event, data=None):
+    lines = [f"event: {event}"]
+    if event == "log":
+        # Browsers send it back as Last-Event-ID when they reconnect
+        lines.append(f"id: {data['offset']}")
+    lines.append("data: " + json.dumps(data))
+    return "\n".join(lines) + "\n\n"
+
+
+def log_event(raw, end, clean=None):
+    text = raw.decode("utf-8", errors="replace")
+    return format_event("log", {"log": clean(text) if clean else text, "offset": end})
+
+
+def stream(key, log_path, state_fn, offset=0, clean=None):
+    """SSE text for one viewer: the log from byte `offset`, then live updates.
+
+    `state_fn` returns {"status": ..., ...} for the run and `clean` is
+    applied to log text before it is sent. The stream ends once the run is
+    in a terminal state and all of its log has been sent.
+    """
+    sub = Subscription()
+    with _lock:
+        tailer = _tailers.get(key)
+        if tailer is None:
+            tailer = _tailers[key] = RunTailer(key, log_path, state_fn)
+            threading.Thread(target=tailer.run, daemon=True).start()
+        tailer.subscribers.append(sub)
+        caught_up_to = tailer.offset
+        state = tailer.state
+
+    try:
+        yield "retry: 3000\n\n"
+        if state is not None:
+            yield format_event("status", state)
+
+        if offset > log_size(log_path):
+            offset = 0
+            yield format_event("reset")
+        # Catch up from the file; the tailer's events start at `caught_up_to`
+        while offset < caught_up_to:
+            data, end, _, _ = read_log_bytes(log_path, offset, min(CHUNK_BYTES, caught_up_to - offset), final=True)
+            if not data:
+                break
+            offset = end
+            yield log_event(data, end, clean)
+
+        while not sub.dropped:
+            try:
+                event = sub.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+
+            kind = event["event"]
+            if kind == "reset":
+                offset = 0
+                yield format_event("reset")
+            elif kind == "log":
+                raw, start = event["raw"], event["start"]
+                end = start + len(raw)
+                if end <= offset:
+                    continue
+                # Both offsets are line starts, so this never splits a character
+                raw = raw[max(offset - start, 0):]
+                offset = end
+                yield log_event(raw, end, clean)
+            else:
+                yield format_event(kind, event.get("data"))
+                if kind == "end":
+                    return
+    finally:
+        with _lock:
+            if sub in tailer.subscribers:
+                tailer.subscribers.remove(sub)
@@ -0,0 +1,37 @@
+import os
+import zlib
+import tarfile
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def stream_tar_gz(files):
+    """Yields a gzipped tar of `files` ((path, archive name) pairs) chunk by chunk.
+
+    Like stream_zip, nothing is written to disk. A file that grows while
+    it is sent is cut at the size it had when its header went out; one
+    that shrinks is padded with zeros.
+    """
+    # wbits 31: a gzip container around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for path, arcname in files:
+        try:
+            src = open(path, "rb")
+            info = tarfile.TarInfo(arcname)
+            st = os.fstat(src.fileno())
+        except OSError as e:
+            print(f"[TAR] Skipping {path}: {e}")
+            continue
+        info.size, info.mtime, info.mode = st.st_size, int(st.st_mtime), st.st_mode & 0o777
+        with src:
+            yield compressor.compress(info.tobuf(tarfile.PAX_FORMAT))
+            left = info.size
+            while left:
+                data = src.read(min(CHUNK_BYTES, left)) or b"\0" * min(CHUNK_BYTES, left)
+                left -= len(data)
+                yield compressor.compress(data)
+        padding = -info.size % tarfile.BLOCKSIZE
+        yield compressor.compress(b"\0" * padding)
+    # End of archive: two empty blocks
+    yield compressor.compress(b"\0" * tarfile.BLOCKSIZE * 2)
+    yield compressor.flush()
@@ -0,0 +1,94 @@
+import os
+import zipfile
+
+CHUNK_BYTES = 1024 * 1024
+# Bytes looked at to decide on files whose extension says nothing
+SNIFF_BYTES = 8192
+
+# Already compressed, binary, or reads (FASTQ deflates slowly for little gain)
+STORED_EXTENSIONS = {
+    ".gz", ".bgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".tar",
+    ".bam", ".cram", ".bai", ".crai", ".csi", ".tbi",
+    ".fastq", ".fq", ".fast5", ".pod5", ".sam",
+    ".png", ".jpg", ".jpeg", ".gif", ".svgz", ".pdf",
+    ".sqlite", ".db", ".npy", ".pkl",
+}
+TEXT_EXTENSIONS = {
+    ".txt", ".log", ".jsonl", ".json", ".csv", ".tsv", ".tab", ".html", ".htm",
+    ".xml", ".svg", ".md", ".yaml", ".yml", ".sh", ".py",
+    ".fasta", ".fa", ".fna", ".faa", ".ffn", ".gfa", ".gff", ".gff3", ".gtf",
+    ".gbk", ".gb", ".vcf", ".bed", ".paf", ".out",
+}
+
+
+class ChunkBuffer:
+    """Write-only target for ZipFile whose output is collected by the caller.
+
+    It has no tell/seek, so zipfile writes sizes and CRCs after each
+    file's data instead of going back to patch its header.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def is_text(path):
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return False
+    return b"\0" not in head
+
+
+def compression_for(path):
+    """ZIP_DEFLATED for text artifacts, ZIP_STORED for everything else."""
+    name = os.path.basename(path).lower()
+    ext = os.path.splitext(name)[1]
+    if ext in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    if ext in TEXT_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_DEFLATED if is_text(path) else zipfile.ZIP_STORED
+
+
+def stream_zip(files):
+    """Yields a ZIP archive of `files` ((path, archive name) pairs) chunk by chunk.
+
+    Nothing is written to disk and the first bytes go out as soon as the
+    first file is opened. Files that disappear or cannot be read while the
+    archive is being sent are left out.
+    """
+    buffer = ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for path, arcname in files:
+            try:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, "rb")
+            except OSError as e:
+                print(f"[ZIP] Skipping {path}: {e}")
+                continue
+            info.compress_type = compression_for(path)
+            with src, archive.open(info, "w") as dst:
+                while True:
+                    data = src.read(CHUNK_BYTES)
+                    if not data:
+                        break
+                    dst.write(data)
+                    if buffer.chunks:
+                        yield buffer.take()
+            if buffer.chunks:
+                yield buffer.take()
+    yield buffer.take()     # central directory